@@ -0,0 +1,246 @@
+"""
+api.py
+
+API HTTP asynchrone (FastAPI) sur le même index que l'interface Gradio d'app.py.
+
+    POST /search   {"question": ..., "filters": {...}}  segments retenus, sans LLM
+    POST /ask      {"question": ..., "stream": true}    réponse RAG (NDJSON si stream)
+    GET  /health   état de l'index et des lots
+    GET  /metrics  compteurs et histogrammes au format Prometheus (metrics.py)
+    GET  /traces   dernières requêtes échantillonnées (TRACE_SAMPLE_RATE)
+
+Les questions reçues à quelques millisecondes d'intervalle sont encodées en un
+seul appel `embed_documents` et cherchées en une seule recherche FAISS
+matricielle (micro_batcher.py). Les générations passent par la passerelle
+Ollama d'app.py (llm_gateway.py) : une question identique (mêmes extraits)
+déjà en cours de génération partage son flux, au plus OLLAMA_MAX_CONCURRENT
+générations tournent à la fois, et au-delà de OLLAMA_MAX_QUEUE en attente la
+requête est refusée (503, Retry-After).
+
+`filters` (optionnel) limite la recherche par métadonnées, ex.
+{"directory": "PLUi", "extension": [".pdf", ".docx"], "year": "2024"} : la
+sélection est appliquée dans FAISS et BM25 (metadata_index.py). Les questions
+filtrées sont encodées avec le lot mais cherchées chacune avec leur sélecteur.
+
+Lancement (dans le conteneur) :
+    uvicorn api:api --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, Response
+from pydantic import BaseModel
+
+import app as rag
+import metrics
+from context_packing import pack_context, build_prompt
+from llm_streaming import ThinkFilter
+from llm_gateway import Overloaded
+from micro_batcher import MicroBatcher
+
+
+class Question(BaseModel):
+    question: str
+    stream: bool = True
+    filters: dict[str, str | int | list[str | int]] | None = None
+
+
+# ✅ Un lot = un appel au modèle d'embeddings + une recherche FAISS pour toutes les questions non filtrées
+# (items : (question, filtrée ?) ; une question filtrée est cherchée ensuite avec son sélecteur).
+# Chaque résultat porte l'instantané d'index sur lequel ses positions ont été calculées : un
+# rechargement survenu avant select_docs ne les fait pas pointer vers d'autres segments.
+def embed_and_search(items):
+    rag.refresh_index()
+    served = rag.current_index()
+    metrics.BATCH_SIZE.observe(len(items))
+    with metrics.timed(metrics.QUERY_STAGE_SECONDS, stage="batch_embed"):
+        query_vectors = rag.embed_questions([question for question, _ in items])
+    dense = [None] * len(items)
+    unfiltered = [i for i, (_, filtered) in enumerate(items) if not filtered]
+    if unfiltered:
+        with metrics.timed(metrics.QUERY_STAGE_SECONDS, stage="batch_faiss_search"):
+            rows = rag.dense_search_many(np.stack([query_vectors[i] for i in unfiltered]),
+                                         rag.dense_search_k(served), served=served)
+        for i, row in zip(unfiltered, rows):
+            dense[i] = row
+    return [(query_vector, row, served) for query_vector, row in zip(query_vectors, dense)]
+
+
+batcher = MicroBatcher(
+    embed_and_search,
+    max_batch_size=int(os.getenv("EMBED_BATCH_MAX", "32")),
+    max_wait_ms=float(os.getenv("EMBED_BATCH_WAIT_MS", "5")),
+)
+
+api = FastAPI(title="RAG AGAM")
+
+
+def serialize_docs(docs):
+    return [
+        {
+            "chunk_id": doc.metadata.get("chunk_id"),
+            "source": doc.metadata.get("source", "Source inconnue"),
+            "page": doc.metadata.get("page", "N/A"),
+            "text": doc.page_content,
+        }
+        for doc in docs
+    ]
+
+
+def serialize_passages(passages):
+    return [
+        {"number": number, "source": p["source"], "page": p["page"], "chunk_ids": p["chunk_ids"]}
+        for number, p in enumerate(passages, start=1)
+    ]
+
+
+def request_selection(body, served, trace):
+    """Sélection des segments autorisés par `body.filters` dans l'instantané `served` (None sans filtre) ;
+    400 si filtre invalide."""
+    try:
+        return rag.select_filters(body.filters, served)
+    except ValueError as e:
+        trace.finish("bad_filters")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def join_generation(question, chunk_ids, query_vector, passages, prompt, trace):
+    """Génération partagée de ce prompt (en cours ou nouvelle) ; 503 si la file d'Ollama est pleine."""
+    try:
+        flight = rag.llm_gateway.join(
+            rag.query_caches.answers.key(question, chunk_ids), prompt,
+            on_complete=lambda answer: rag.query_caches.answers.put(question, chunk_ids, query_vector, answer,
+                                                                    passages))
+    except Overloaded as e:
+        trace.finish("overloaded")
+        raise HTTPException(status_code=503, detail=f"{rag.OVERLOADED_MESSAGE} ({e})",
+                            headers={"Retry-After": os.getenv("OVERLOADED_RETRY_AFTER", "5")})
+    trace.annotate(coalesced=flight.subscribers > 1)
+    return flight
+
+
+def ndjson(event):
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+def answer_response(body, answer, sources, chunk_ids, cached):
+    """Réponse complète : JSON, ou flux NDJSON d'un seul tenant si `stream`."""
+    if not body.stream:
+        return {"answer": answer, "sources": sources, "chunk_ids": chunk_ids, "cached": cached}
+
+    async def replay():
+        yield ndjson({"type": "sources", "sources": sources})
+        yield ndjson({"type": "done", "answer": answer, "cached": cached})
+    return StreamingResponse(replay(), media_type="application/x-ndjson")
+
+
+@api.post("/search")
+async def search(body: Question):
+    trace = rag.tracer.start("search")
+    with trace.span("embed_search"):  # attente du lot comprise
+        query_vector, dense, served = await batcher.submit((body.question, bool(body.filters)))
+    selection = request_selection(body, served, trace)
+    chunk_ids, docs = await asyncio.to_thread(rag.select_docs, body.question, query_vector, dense, trace,
+                                              selection, served)
+    trace.finish()
+    return {"question": body.question, "chunk_ids": chunk_ids, "results": serialize_docs(docs)}
+
+
+@api.post("/ask")
+async def ask(body: Question):
+    question = body.question
+    trace = rag.tracer.start("ask")
+    with trace.span("embed_search"):  # attente du lot comprise
+        query_vector, dense, served = await batcher.submit((question, bool(body.filters)))
+    selection = request_selection(body, served, trace)
+
+    # ⚡ Question quasi identique déjà traitée (si le hit sémantique est activé ; pas avec des filtres),
+    #    renvoyée avec ses sources
+    cached = rag.query_caches.answers.get_semantic(query_vector) if selection is None else None
+    if cached is not None:
+        trace.finish("semantic_cache")
+        return answer_response(body, rag.display_answer(cached["answer"]), serialize_passages(cached["passages"]),
+                               cached["chunk_ids"], True)
+
+    chunk_ids, docs = await asyncio.to_thread(rag.select_docs, question, query_vector, dense, trace, selection,
+                                              served)
+    if not docs:
+        trace.finish("no_documents")
+        return answer_response(body, "❌ Aucun document pertinent trouvé.", [], [], False)
+
+    with trace.span("context"):
+        retrieved_text, passages, context_tokens = await asyncio.to_thread(
+            pack_context, docs, token_budget=rag.context_token_budget)
+    trace.annotate(segments=len(docs), passages=len(passages), context_tokens=context_tokens)
+    sources = serialize_passages(passages)
+
+    # ⚡ Même question, mêmes extraits : la réponse est déjà connue
+    cached_answer = rag.query_caches.answers.get(question, chunk_ids)
+    if cached_answer is not None:
+        trace.finish("answer_cache")
+        return answer_response(body, rag.display_answer(cached_answer), sources, chunk_ids, True)
+
+    # 🎯 Génération partagée avec les requêtes identiques en cours (réponse mise en cache à la fin)
+    prompt = build_prompt(question, retrieved_text)
+    flight = join_generation(question, chunk_ids, query_vector, passages, prompt, trace)
+    metrics.PROMPT_TOKENS.observe(rag.count_tokens(prompt))
+    if not body.stream:
+        llm_start = time.perf_counter()
+        # Réponse complète : seule la durée de génération est mesurée (pas de premier token)
+        response = "".join([fragment async for fragment in flight.aiter_fragments()])
+        trace.record("llm_generation", time.perf_counter() - llm_start)
+        metrics.ANSWER_TOKENS.observe(rag.count_tokens(response))
+        trace.finish()
+        return {"answer": rag.display_answer(response), "sources": sources, "chunk_ids": chunk_ids,
+                "cached": False}
+
+    async def generate():
+        # 📚 Les sources partent avant la génération, puis les tokens visibles au fil de l'eau
+        yield ndjson({"type": "sources", "sources": sources})
+        response = ""
+        think_filter = ThinkFilter()
+        llm_start = time.perf_counter()
+        first_token = True
+        async for fragment in flight.aiter_fragments():
+            if first_token:
+                trace.record("llm_first_token", time.perf_counter() - llm_start)
+                first_token = False
+            response += fragment
+            visible = think_filter.feed(fragment) if rag.hide_think else fragment
+            if visible:
+                yield ndjson({"type": "token", "text": visible})
+        trace.record("llm_generation", time.perf_counter() - llm_start)
+        metrics.ANSWER_TOKENS.observe(rag.count_tokens(response))
+        trace.finish()
+        tail = think_filter.flush() if rag.hide_think else ""
+        if tail:
+            yield ndjson({"type": "token", "text": tail})
+        yield ndjson({"type": "done", "answer": rag.display_answer(response), "cached": False})
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@api.get("/health")
+async def health():
+    return {"vectors": rag.vectorstore.index.ntotal, "hybrid": rag.bm25_index is not None,
+            "filters": rag.metadata_index is not None, "batcher": batcher.stats(),
+            "llm": rag.llm_gateway.stats()}
+
+
+@api.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@api.get("/traces")
+async def traces():
+    return rag.tracer.recent()
+
+
+if __name__ == "__main__":
+    uvicorn.run(api, host="0.0.0.0", port=int(os.getenv("API_PORT", "8000")))
@@ -1,89 +1,401 @@
 import gradio as gr
 import os
+import threading
+import time
+from collections import namedtuple
 import numpy as np
+import faiss
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_ollama.llms import OllamaLLM
 from langchain.chains import RetrievalQA
 
+from embedding_backends import EMBEDDING_MODEL, DEFAULT_ONNX_DIR, make_embeddings
+from query_cache import QueryCaches, normalize_question
+from faiss_index_factory import search_parameters
+from vector_backends import FaissBackend, QdrantBackend
+from metadata_index import MetadataIndex, has_metadata_index, parse_filters
+from bm25_index import BM25Index, has_bm25_index, reciprocal_rank_fusion
+from context_packing import pack_context, build_prompt, get_encoding
+from llm_streaming import ThinkFilter, strip_think, format_sources
+from llm_gateway import OllamaGateway, Overloaded
+import metrics
+
 # Charger les variables d'environnement
 load_dotenv()
 
-# ✅ Charger les embeddings Hugging Face (BAAI/bge-large-en)
-bge_embeddings = HuggingFaceEmbeddings(
-    model_name="BAAI/bge-large-en",
-    encode_kwargs={'normalize_embeddings': True}
+# ✅ Charger les embeddings BAAI/bge-large-en (EMBEDDING_BACKEND=onnx-int8 : graphe quantifié sur CPU,
+#    à valider avec bench_embedding_backend.py)
+embedding_backend = os.getenv("EMBEDDING_BACKEND", "torch")
+embedding_threads = os.getenv("EMBEDDING_THREADS")
+bge_embeddings = make_embeddings(
+    embedding_backend,
+    EMBEDDING_MODEL,
+    onnx_dir=os.getenv("ONNX_MODEL_DIR", DEFAULT_ONNX_DIR),
+    threads=int(embedding_threads) if embedding_threads else None,
 )
 
-# ✅ Charger l'index FAISS avec les bons embeddings
+# ✅ Charger l'index construit par script_rag2.py (FAISS plat / approché / shards, ou Qdrant) avec les bons embeddings
 index_path = "index_agam"
-vectorstore = FAISS.load_local(index_path, bge_embeddings, allow_dangerous_deserialization=True)
+faiss_nprobe = os.getenv("FAISS_NPROBE")          # index IVF : listes visitées par requête
+faiss_ef_search = os.getenv("FAISS_EF_SEARCH")    # index HNSW : taille de la file de recherche
+# Index en shards (script_rag2.py --shards N) : cherchés en parallèle, lus à la première recherche
+shard_threads = os.getenv("SHARD_THREADS")
+# VECTOR_BACKEND=qdrant : vecteurs dans la collection synchronisée par script_rag2.py --vector-backend qdrant
+if os.getenv("VECTOR_BACKEND", "faiss") == "qdrant":
+    qdrant_hnsw_ef = os.getenv("QDRANT_HNSW_EF")
+    vector_backend = QdrantBackend(
+        index_path,
+        os.getenv("QDRANT_URL", "http://host.docker.internal:6333"),
+        collection=os.getenv("QDRANT_COLLECTION"),
+        api_key=os.getenv("QDRANT_API_KEY"),
+        hnsw_ef=int(qdrant_hnsw_ef) if qdrant_hnsw_ef else None,
+    )
+else:
+    vector_backend = FaissBackend(
+        index_path,
+        nprobe=int(faiss_nprobe) if faiss_nprobe else None,
+        ef_search=int(faiss_ef_search) if faiss_ef_search else None,
+        use_shards=os.getenv("FAISS_SHARDS", "1") == "1",
+        shard_threads=int(shard_threads) if shard_threads else None,
+        shard_lazy=os.getenv("SHARD_LAZY", "1") == "1",
+    )
+
+def open_vectorstore(previous=None):
+    return vector_backend.open(bge_embeddings, previous)
+
+vectorstore = open_vectorstore()
+
+# ✅ Index lexical BM25 construit sur les mêmes segments (recherche hybride, HYBRID_SEARCH=0 pour désactiver)
+hybrid_search = os.getenv("HYBRID_SEARCH", "1") == "1"
+retrieval_k = int(os.getenv("RETRIEVAL_K", "10"))              # segments envoyés au LLM
+hybrid_candidates = int(os.getenv("HYBRID_CANDIDATES", "30"))  # candidats par recherche avant fusion
+def open_bm25():
+    if hybrid_search and has_bm25_index(index_path):
+        return BM25Index(index_path)
+    return None
+
+bm25_index = open_bm25()
+
+# ✅ Bitmaps de métadonnées (source, dossier, extension, page, année) : filtres appliqués dans FAISS
+def open_metadata_index():
+    return MetadataIndex(index_path) if has_metadata_index(index_path) else None
+
+metadata_index = open_metadata_index()
+
+# ✅ Index servis (vecteurs, BM25, métadonnées) remplacés ensemble par refresh_index : une requête
+#    prend l'instantané une fois et y résout ses positions, même si l'index est rechargé entre-temps
+ServedIndex = namedtuple("ServedIndex", ["vectorstore", "bm25", "metadata"])
+served_index = ServedIndex(vectorstore, bm25_index, metadata_index)
+
+def current_index():
+    return served_index
+
+search_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_THREADS", "4")))
 
 # ✅ Vérifier la dimension de l'index FAISS
 faiss_dim = vectorstore.index.d
 print(f"📊 Dimension des vecteurs FAISS : {faiss_dim}")
 
 # ✅ Configurer le modèle LLM Ollama avec DeepSeek-R1
+ollama_model = os.getenv("OLLAMA_MODEL", "deepseek-r1")
+ollama_base_url = os.getenv("OLLAMA_BASE_URL", "http://host.docker.internal:11434")  # URL pour accéder à Ollama depuis le conteneur Docker
 llm = OllamaLLM(
-    model="deepseek-r1",
-    base_url="http://host.docker.internal:11434",  # URL pour accéder à Ollama depuis le conteneur Docker
+    model=ollama_model,
+    base_url=ollama_base_url,
     request_timeout=60  # Timeout augmenté à 60 secondes
 )
 
+# ✅ Générations des réponses : requêtes identiques simultanées mutualisées, connexions keep-alive,
+#    au plus OLLAMA_MAX_CONCURRENT générations et OLLAMA_MAX_QUEUE en attente (au-delà : refus)
+llm_gateway = OllamaGateway(
+    ollama_base_url,
+    ollama_model,
+    max_concurrent=int(os.getenv("OLLAMA_MAX_CONCURRENT", "4")),
+    max_queue=int(os.getenv("OLLAMA_MAX_QUEUE", "32")),
+    timeout=float(os.getenv("OLLAMA_TIMEOUT", "60")),
+)
+OVERLOADED_MESSAGE = "⏳ Trop de questions en cours de traitement, réessayez dans un instant."
+
 
 qa_chain = RetrievalQA.from_chain_type(llm, retriever=vectorstore.as_retriever(search_kwargs={"k": 15}))
 
-# ✅ Fonction améliorée pour inclure les sources
-def chatbot(question):
-    # 🔍 Vérifier la dimension du vecteur de la requête
-    query_vector = np.array(bge_embeddings.embed_query(question), dtype=np.float32).reshape(1, -1)
-    print(f"📊 Dimension du vecteur de la requête : {query_vector.shape}")
+# ✅ Reclassement optionnel par cross-encoder (RERANKER=1) : on sur-échantillonne puis on garde les meilleurs
+reranker = None
+rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "40"))
+if os.getenv("RERANKER", "0") == "1":
+    from reranker import CrossEncoderReranker, DEFAULT_RERANKER_MODEL
+    min_score = os.getenv("RERANK_MIN_SCORE")
+    reranker = CrossEncoderReranker(
+        model_name=os.getenv("RERANKER_MODEL", DEFAULT_RERANKER_MODEL),
+        top_n=int(os.getenv("RERANK_TOP_N", "5")),
+        min_score=float(min_score) if min_score else None,
+        max_concurrent=int(os.getenv("RERANK_MAX_CONCURRENT", "2")),
+    )
 
-    # 🔍 Récupérer les documents pertinents avec FAISS
-    retrieved_docs = vectorstore.similarity_search_by_vector(query_vector[0], k=10)
+# ✅ Réponse diffusée au fil des tokens (STREAM_RESPONSES=0 : réponse complète d'un bloc)
+stream_responses = os.getenv("STREAM_RESPONSES", "1") == "1"
+hide_think = os.getenv("HIDE_THINK", "1") == "1"
 
-    if not retrieved_docs:
-        return "❌ Aucun document pertinent trouvé."
+# ✅ Budget de tokens (cl100k_base) pour les extraits insérés dans le prompt
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
 
+# ✅ Caches de requête : vecteurs des questions + réponses (invalidés si index_agam est reconstruit)
+semantic_threshold = os.getenv("ANSWER_CACHE_SEMANTIC_THRESHOLD")
+query_caches = QueryCaches(
+    index_path,
+    query_cache_size=int(os.getenv("QUERY_CACHE_SIZE", "1024")),
+    answer_cache_size=int(os.getenv("ANSWER_CACHE_SIZE", "256")),
+    answer_ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    semantic_threshold=float(semantic_threshold) if semantic_threshold else None,
+)
 
-    # 📄 Construire un texte consolidé à partir des documents récupérés
-    retrieved_text = "\n".join(
-        f"[{i+1}] {doc.metadata.get('source', 'Source inconnue')}: {doc.page_content}"
-        for i, doc in enumerate(retrieved_docs[:10])
-    )
-    print(f"Retour du FAISS  avant: {retrieved_text}")
+# ✅ Instrumentation : histogrammes par étape (/metrics) et traces échantillonnées (TRACE_SAMPLE_RATE)
+tracer = metrics.tracer_from_env()
 
-    retrieved_text = retrieved_text.replace("•", "").replace("", "").replace("\n\n", "\n").strip()
-    print(f"Retour du FAISS après : {retrieved_text}")
+def cache_metrics():
+    caches = {"query_vectors": query_caches.vectors.stats(), "answers": query_caches.answers.stats()}
+    yield ("rag_cache_hits_total", "counter", {(("cache", name),): stats["hits"] for name, stats in caches.items()})
+    yield ("rag_cache_misses_total", "counter", {(("cache", name),): stats["misses"] for name, stats in caches.items()})
+    yield ("rag_cache_hit_ratio", "gauge", {(("cache", name),): stats["hit_rate"] for name, stats in caches.items()})
+    yield ("rag_answer_cache_semantic_hits_total", "counter", {(): query_caches.answers.stats()["semantic_hits"]})
+    llm_stats = llm_gateway.stats()
+    yield ("rag_llm_generations_total", "counter", {(("result", name),): llm_stats[name]
+                                                    for name in ("started", "coalesced", "shed", "failed")})
+    yield ("rag_llm_inflight", "gauge", {(("state", name),): llm_stats[name] for name in ("active", "queued")})
+    if reranker is not None:
+        rerank = reranker.stats()
+        yield ("rag_rerank_total", "counter", {(("result", "reranked"),): rerank["calls"],
+                                               (("result", "fallback"),): rerank["fallbacks"]})
 
+metrics.REGISTRY.add_collector(cache_metrics)
 
-    # 🎯 Générer une réponse avec Ollama en incluant les sources
-    prompt = (
-        f"Tu es un expert en urbanisme et tu as la connaissance de tous les documents.\n"
-        f"Réponds précisément à la question posée en t'appuyant uniquement sur les extraits ci-dessous.\n"
-        f"N'oublie pas d'ajouter des références aux documents d'où proviennent les informations.\n"
-        f"\nExtraits des documents :\n{retrieved_text}\n\n"
-        f"Question : {question}\n"
-        f"Réponse détaillée avec sources :"
-    )
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
 
-    response = llm.invoke(prompt)
+# ✅ Recharger l'index si script_rag2.py l'a reconstruit depuis le démarrage (un seul thread à la fois ;
+#    les autres requêtes continuent sur l'index chargé pendant ce temps)
+refresh_lock = threading.Lock()
 
-    # ✅ Extraire uniquement le texte généré sans les métadonnées
-    print(response)
+def refresh_index():
+    global vectorstore, bm25_index, metadata_index, served_index
+    fingerprint = query_caches.pending_fingerprint()
+    if fingerprint is None or not refresh_lock.acquire(blocking=False):
+        return
+    try:
+        reloaded = ServedIndex(open_vectorstore(vectorstore), open_bm25(), open_metadata_index())
+        served_index = reloaded
+        vectorstore, bm25_index, metadata_index = reloaded
+        # Empreinte enregistrée seulement après un rechargement réussi
+        query_caches.index_reloaded(fingerprint)
+        print("🔄 Index rechargé, caches de requête vidés.")
+    except Exception as e:
+        # Index en cours d'écriture : on garde l'ancien, réessai à la prochaine requête
+        print(f"⚠️ Rechargement de l'index impossible pour l'instant : {e}")
+    finally:
+        refresh_lock.release()
 
-    return response["choices"][0]["message"]["content"]
+# ✅ Encoder les questions (ou relire leurs vecteurs dans le cache) en un seul appel au modèle
+def embed_questions(questions):
+    keys = [normalize_question(question) for question in questions]
+    query_vectors = [query_caches.vectors.get(key) for key in keys]
+    missing = [i for i, vector in enumerate(query_vectors) if vector is None]
+    if missing:
+        computed = bge_embeddings.embed_documents([questions[i] for i in missing])
+        for i, vector in zip(missing, computed):
+            query_vectors[i] = np.array(vector, dtype=np.float32)
+            query_caches.vectors.put(keys[i], query_vectors[i])
+    return query_vectors
 
-# ✅ Interface Gradio améliorée
-iface = gr.Interface(
-    fn=chatbot,
-    inputs="text",
-    outputs="text",
-    title="Chatbot RAG - AGAM",
-    description="Pose une question sur les documents de l'AGAM et obtiens une réponse détaillée avec les sources.",
-    theme="default"
-)
+def embed_question(question):
+    return embed_questions([question])[0]
+
+# ✅ Filtres de métadonnées → sélection des positions autorisées (None sans filtre)
+def select_filters(filters, served=None):
+    if not filters:
+        return None
+    served = served or current_index()
+    if served.metadata is None or served.metadata.n_docs != served.vectorstore.index.ntotal:
+        raise ValueError("❌ Filtres indisponibles : index des métadonnées absent ou périmé (relancer script_rag2.py).")
+    return served.metadata.select(filters)
+
+# ✅ Recherche dense (FAISS ou Qdrant) : positions des k plus proches voisins, pour une ou plusieurs requêtes.
+# Avec une sélection, les segments exclus sont écartés pendant la recherche (sélecteur FAISS,
+# filtre de payload Qdrant). `served` : instantané de l'index (current_index() par défaut).
+def dense_search_many(query_vectors, k, selection=None, served=None):
+    queries = np.asarray(query_vectors, dtype=np.float32).reshape(-1, faiss_dim)
+    index = (served or current_index()).vectorstore.index
+    if selection is None:
+        _, indices = index.search(queries, k)
+    elif isinstance(index, faiss.Index):
+        _, indices = index.search(queries, k, params=search_parameters(index, selection.selector()))
+    else:
+        # Façades ShardedIndex / QdrantIndex : la sélection est traduite par l'index
+        _, indices = index.search(queries, k, selection=selection)
+    return [[int(i) for i in row if i != -1] for row in indices]
+
+def dense_search(query_vector, k, selection=None, served=None):
+    return dense_search_many(query_vector, k, selection, served)[0]
+
+# ✅ Nombre de voisins FAISS nécessaires à select_docs (candidats du reranker, de la fusion RRF...)
+def dense_search_k(served=None):
+    k = rerank_candidates if reranker is not None else retrieval_k
+    return k if (served or current_index()).bm25 is None else hybrid_candidates
+
+# ✅ Recherche hybride (BM25 + FAISS en parallèle, fusion RRF) renvoyant aussi les identifiants des chunks.
+# `dense` : positions FAISS déjà calculées (recherche groupée de api.py), sinon la recherche est faite ici.
+def timed_bm25_search(bm25, question, k, allowed=None):
+    start = time.perf_counter()
+    return bm25.search(question, k, allowed=allowed), time.perf_counter() - start
+
+def retrieve(question, query_vector, k=retrieval_k, dense=None, trace=metrics.NO_TRACE, selection=None,
+             served=None):
+    if selection is not None and not selection.count:
+        return [], []
+    served = served or current_index()
+    if served.bm25 is None:
+        if dense is None:
+            with trace.span("faiss_search"):
+                dense = dense_search(query_vector, k, selection, served)
+        positions = dense[:k]
+    else:
+        allowed = selection.mask() if selection is not None else None
+        lexical = search_pool.submit(timed_bm25_search, served.bm25, question, hybrid_candidates, allowed)
+        if dense is None:
+            with trace.span("faiss_search"):
+                dense = dense_search(query_vector, hybrid_candidates, selection, served)
+        lexical_positions, lexical_seconds = lexical.result()
+        trace.record("bm25_search", lexical_seconds)
+        positions = reciprocal_rank_fusion([dense[:hybrid_candidates], lexical_positions], k=k)
+
+    with trace.span("fetch_chunks"):
+        store = served.vectorstore
+        docs = [store.docstore.search(store.index_to_docstore_id[p]) for p in positions]
+    return [doc.metadata["chunk_id"] for doc in docs], docs
+
+# ✅ Segments envoyés au LLM : recherche puis reclassement optionnel
+def select_docs(question, query_vector, dense=None, trace=metrics.NO_TRACE, selection=None, served=None):
+    if reranker is None:
+        return retrieve(question, query_vector, dense=dense, trace=trace, selection=selection, served=served)
+
+    _, candidates = retrieve(question, query_vector, k=rerank_candidates, dense=dense, trace=trace,
+                             selection=selection, served=served)
+    with trace.span("rerank"):
+        retrieved_docs, _, reranked = reranker.rerank(question, candidates)
+    trace.annotate(rerank_candidates=len(candidates), reranked=reranked)
+    return [doc.metadata["chunk_id"] for doc in retrieved_docs], retrieved_docs
+
+# ✅ Affichage de la réponse : section <think> de deepseek-r1 masquée si demandé
+def display_answer(response):
+    return strip_think(response).strip() if hide_think else response
+
+# ✅ Fonction améliorée pour inclure les sources (générateur : la réponse s'affiche au fil des tokens)
+def chatbot(question, filters=""):
+    trace = tracer.start("chatbot")
+    refresh_index()
+    served = current_index()
+
+    # 🗂 Filtres optionnels (ex. « directory=PLUi; extension=.pdf; year=2024 »)
+    try:
+        selection = select_filters(parse_filters(filters or ""), served)
+    except ValueError as e:
+        trace.finish("bad_filters")
+        yield str(e)
+        return
+    if selection is not None:
+        trace.annotate(filters=selection.filters, filtered_segments=selection.count)
+
+    # 🔍 Vecteur de la requête (cache LRU par question normalisée)
+    with trace.span("embed"):
+        query_vector = embed_question(question)
+
+    # ⚡ Question quasi identique déjà traitée (si le hit sémantique est activé ; pas avec des filtres),
+    #    renvoyée avec ses sources
+    cached = query_caches.answers.get_semantic(query_vector) if selection is None else None
+    if cached is not None:
+        trace.finish("semantic_cache")
+        yield f"{display_answer(cached['answer'])}\n\n{format_sources(cached['passages'])}"
+        return
+
+    # 🔍 Récupérer les documents pertinents (FAISS + BM25, reranking optionnel)
+    chunk_ids, retrieved_docs = select_docs(question, query_vector, trace=trace, selection=selection,
+                                            served=served)
+
+    if not retrieved_docs:
+        trace.finish("no_documents")
+        yield "❌ Aucun document pertinent trouvé."
+        return
+
+    # 📄 Construire le contexte : fusion des segments qui se chevauchent, phrases répétées
+    # retirées, passages par pertinence dans la limite du budget de tokens
+    with trace.span("context"):
+        retrieved_text, passages, context_tokens = pack_context(retrieved_docs, token_budget=context_token_budget)
+    trace.annotate(segments=len(retrieved_docs), passages=len(passages), context_tokens=context_tokens)
+    sources = format_sources(passages)
+
+    # ⚡ Même question, mêmes extraits : la réponse est déjà connue
+    cached_answer = query_caches.answers.get(question, chunk_ids)
+    if cached_answer is not None:
+        trace.finish("answer_cache")
+        yield f"{display_answer(cached_answer)}\n\n{sources}"
+        return
+
+    # 🎯 Générer une réponse avec Ollama en incluant les sources ; une génération identique déjà
+    # en cours (même question, mêmes extraits) est partagée au lieu d'être relancée
+    prompt = build_prompt(question, retrieved_text)
+    try:
+        flight = llm_gateway.join(query_caches.answers.key(question, chunk_ids), prompt,
+                                  on_complete=lambda answer: query_caches.answers.put(
+                                      question, chunk_ids, query_vector, answer, passages))
+    except Overloaded:
+        trace.finish("overloaded")
+        yield f"{OVERLOADED_MESSAGE}\n\n{sources}"
+        return
+    trace.annotate(coalesced=flight.subscribers > 1)
+    metrics.PROMPT_TOKENS.observe(count_tokens(prompt))
+
+    # 📚 Les sources s'affichent dès la fin de la recherche
+    yield f"⏳ Génération en cours…\n\n{sources}"
+
+    llm_start = time.perf_counter()
+    if not stream_responses:
+        # Pas de premier token observable : seule la durée de génération est mesurée
+        response = "".join(flight.iter_fragments())
+    else:
+        # 🔁 Diffusion au fil des tokens ; la réflexion <think> est masquée pendant le flux
+        response = ""
+        visible = ""
+        think_filter = ThinkFilter()
+        first_token = True
+        for fragment in flight.iter_fragments():
+            if first_token:
+                trace.record("llm_first_token", time.perf_counter() - llm_start)
+                first_token = False
+            response += fragment
+            visible += think_filter.feed(fragment) if hide_think else fragment
+            thinking = think_filter.in_think or not think_filter.started
+            status = "💭 Réflexion en cours…" if hide_think and thinking else visible.lstrip()
+            yield f"{status}\n\n{sources}"
+
+    trace.record("llm_generation", time.perf_counter() - llm_start)
+    metrics.ANSWER_TOKENS.observe(count_tokens(response))
+    trace.finish()
+    yield f"{display_answer(response)}\n\n{sources}"
+
+# ✅ Interface Gradio améliorée (api.py importe ce module sans lancer Gradio)
+if __name__ == "__main__":
+    iface = gr.Interface(
+        fn=chatbot,
+        inputs=["text", gr.Textbox(label="Filtres (optionnel)",
+                                   placeholder="directory=PLUi; extension=.pdf,.docx; year=2024")],
+        outputs="text",
+        title="Chatbot RAG - AGAM",
+        description="Pose une question sur les documents de l'AGAM et obtiens une réponse détaillée avec les sources.",
+        theme="default"
+    )
 
-# ✅ Lancer l'interface avec les paramètres pour Docker
-iface.launch(server_name="0.0.0.0", server_port=7860)
+    # ✅ Lancer l'interface avec les paramètres pour Docker (file d'attente requise pour le streaming)
+    iface.queue()
+    # 📈 /metrics (Prometheus) et /traces servis à part, l'interface Gradio n'ayant pas de route libre
+    metrics.start_http_server(int(os.getenv("METRICS_PORT", "9100")), tracer=tracer)
+    iface.launch(server_name="0.0.0.0", server_port=7860)
@@ -0,0 +1,289 @@
+"""
+batch_qa.py
+
+Réponses à une liste de questions, hors interface : contrôles de non-régression, rapports.
+
+Entrée JSONL, une question par ligne (seul "question" est obligatoire ; sans
+"id", la question normalisée sert d'identifiant) :
+    {"id": "q1", "question": "...", "filters": {"directory": "PLUi"}, "expected_sources": ["reglement.pdf"]}
+
+Les questions sont traitées par lots, avec l'index et les réglages d'app.py
+(variables d'environnement) : un appel `embed_documents` et une recherche FAISS
+matricielle par lot (une question filtrée est cherchée avec son sélecteur),
+puis BM25, fusion et reranking par question. Les prompts partent vers Ollama
+par la passerelle d'app.py (llm_gateway.py), --concurrency questions à la fois.
+Chaque résultat est ajouté au JSONL de sortie dès qu'il est prêt : réponse,
+chunk_ids, segments retenus et durées par étape (ms).
+
+Reprise : les questions déjà présentes sans erreur dans le fichier de sortie
+sont sautées ; relancer la même commande après une interruption termine le travail.
+
+--retrieval-only : pas de LLM. Pour les questions avec "expected_sources", le
+résultat porte le recall@k (part des sources attendues parmi celles des k
+premiers segments retenus, sources des doublons fusionnés comprises) et le
+résumé final donne le recall@k moyen.
+
+Usage :
+    python batch_qa.py questions.jsonl --output reponses.jsonl
+    python batch_qa.py questions.jsonl --output recall.jsonl --retrieval-only --k 10
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+import numpy as np
+
+import metrics
+from context_packing import pack_context, build_prompt
+from llm_gateway import Overloaded
+from query_cache import normalize_question
+
+
+def read_questions(path):
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item.setdefault("id", normalize_question(item["question"]))
+            items.append(item)
+    return items
+
+
+def read_results(path):
+    """Dernier résultat de chaque identifiant déjà écrit dans le fichier de sortie."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # ligne tronquée par une interruption
+            results[result["id"]] = result
+    return results
+
+
+def ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if not f.tell():
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def open_output(path, restart=False):
+    if restart or not os.path.exists(path):
+        return open(path, "w", encoding="utf-8")
+    f = open(path, "a", encoding="utf-8")
+    # Dernière ligne tronquée par une interruption : la suite repart sur une ligne neuve
+    if not ends_with_newline(path):
+        f.write("\n")
+    return f
+
+
+def source_matches(source, expected):
+    source, expected = source.replace("\\", "/"), expected.replace("\\", "/").lstrip("/")
+    return source == expected or source.endswith("/" + expected)
+
+
+def source_recall(docs, expected, k):
+    """Part des sources attendues présentes parmi les k premiers segments."""
+    sources = set()
+    for doc in docs[:k]:
+        sources.add(doc.metadata.get("source", ""))
+        sources.update(duplicate["source"] for duplicate in doc.metadata.get("duplicate_sources", []))
+    found = [source for source in expected if any(source_matches(s, source) for s in sources)]
+    return len(found) / len(expected)
+
+
+def search_batch(rag, items, errors):
+    """Vecteurs et positions FAISS d'un lot : un encodage, une recherche matricielle pour les non filtrés."""
+    start = time.perf_counter()
+    query_vectors = rag.embed_questions([item["question"] for item in items])
+    embed_ms = (time.perf_counter() - start) * 1000
+
+    selections = []
+    for item in items:
+        try:
+            selections.append(rag.select_filters(item.get("filters")))
+        except ValueError as e:
+            errors[item["id"]] = str(e)
+            selections.append(None)
+    dense = [None] * len(items)
+    unfiltered = [i for i, item in enumerate(items) if selections[i] is None and item["id"] not in errors]
+    start = time.perf_counter()
+    if unfiltered:
+        rows = rag.dense_search_many(np.stack([query_vectors[i] for i in unfiltered]), rag.dense_search_k())
+        for i, row in zip(unfiltered, rows):
+            dense[i] = row
+    timings = {"batch_embed": round(embed_ms, 3), "batch_search": round((time.perf_counter() - start) * 1000, 3)}
+    return query_vectors, dense, selections, timings
+
+
+def generate(rag, question, chunk_ids, query_vector, passages, prompt, trace):
+    """Réponse d'Ollama par la passerelle d'app.py (génération partagée si déjà en cours)."""
+    while True:
+        try:
+            flight = rag.llm_gateway.join(
+                rag.query_caches.answers.key(question, chunk_ids), prompt,
+                on_complete=lambda answer: rag.query_caches.answers.put(question, chunk_ids, query_vector, answer,
+                                                                        passages))
+            break
+        except Overloaded:
+            time.sleep(1.0)  # file de la passerelle pleine (--concurrency > OLLAMA_MAX_CONCURRENT + OLLAMA_MAX_QUEUE)
+    start = time.perf_counter()
+    fragments = []
+    for fragment in flight.iter_fragments():
+        if not fragments:
+            trace.record("llm_first_token", time.perf_counter() - start)
+        fragments.append(fragment)
+    trace.record("llm_generation", time.perf_counter() - start)
+    return "".join(fragments)
+
+
+def answer(rag, item, query_vector, dense, selection, batch_timings, args):
+    """Résultat d'une question : segments retenus, réponse (sauf --retrieval-only), durées par étape."""
+    question = item["question"]
+    trace = metrics.Trace(None, "batch_qa", sampled=True)
+    chunk_ids, docs = rag.select_docs(question, query_vector, dense=dense, trace=trace, selection=selection)
+    result = {
+        "id": item["id"], "question": question, "chunk_ids": chunk_ids,
+        "retrieved": [{"chunk_id": doc.metadata.get("chunk_id"), "source": doc.metadata.get("source"),
+                       "page": doc.metadata.get("page")} for doc in docs],
+    }
+    if item.get("expected_sources"):
+        result[f"recall@{args.k}"] = round(source_recall(docs, item["expected_sources"], args.k), 4)
+
+    if not args.retrieval_only:
+        if not docs:
+            result["answer"], result["cached"] = "❌ Aucun document pertinent trouvé.", False
+        else:
+            with trace.span("context"):
+                retrieved_text, passages, _ = pack_context(docs, token_budget=rag.context_token_budget)
+            response = rag.query_caches.answers.get(question, chunk_ids)
+            result["cached"] = response is not None
+            if response is None:
+                prompt = build_prompt(question, retrieved_text)
+                response = generate(rag, question, chunk_ids, query_vector, passages, prompt, trace)
+            result["answer"] = rag.display_answer(response)
+            result["sources"] = [{"number": number, "source": p["source"], "page": p["page"]}
+                                 for number, p in enumerate(passages, start=1)]
+
+    result["timings_ms"] = {**batch_timings, **{span["stage"]: span["duration_ms"] for span in trace.spans},
+                            "total": round((time.perf_counter() - trace.start) * 1000, 3)}
+    return result
+
+
+def summarize(items, results, k):
+    answered = [results[item["id"]] for item in items if item["id"] in results]
+    failed = [result for result in answered if "error" in result]
+    print(f"📊 {len(answered) - len(failed)}/{len(items)} question(s) traitée(s), {len(failed)} en erreur")
+    recalls = [result[f"recall@{k}"] for result in answered if f"recall@{k}" in result]
+    if recalls:
+        print(f"🎯 Recall@{k} moyen des sources attendues : {np.mean(recalls):.4f} "
+              f"({len(recalls)} question(s), {sum(r == 1.0 for r in recalls)} complète(s))")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Répond à une liste de questions (JSONL) avec l'index d'app.py.")
+    parser.add_argument("input", help="Fichier JSONL des questions.")
+    parser.add_argument("--output", default="batch_qa_results.jsonl",
+                        help="Fichier JSONL des résultats (complété en cas de reprise).")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="Questions encodées et cherchées ensemble.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Questions traitées en parallèle après la recherche (générations Ollama comprises).")
+    parser.add_argument("--retrieval-only", action="store_true",
+                        help="Sans LLM : segments retenus et recall@k des sources attendues.")
+    parser.add_argument("--k", type=int, default=None,
+                        help="k du recall@k (défaut : RETRIEVAL_K, nombre de segments retenus par app.py).")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore les résultats déjà écrits et recommence le fichier de sortie.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    items = read_questions(args.input)
+    previous = {} if args.restart else read_results(args.output)
+    todo = [item for item in items if item["id"] not in previous or "error" in previous[item["id"]]]
+    print(f"📂 {len(items)} question(s), {len(items) - len(todo)} déjà traitée(s), {len(todo)} à traiter")
+    if not todo:
+        summarize(items, previous, args.k or int(os.getenv("RETRIEVAL_K", "10")))
+        return
+
+    # Chargé ici : modèle d'embedding, index et passerelle Ollama, configurés comme app.py
+    import app as rag
+    args.k = args.k or rag.retrieval_k
+    if args.k > rag.retrieval_k:
+        print(f"⚠️ k={args.k} > RETRIEVAL_K={rag.retrieval_k} : recall calculé sur {rag.retrieval_k} segments.")
+
+    start = time.perf_counter()
+    done = 0
+    output = open_output(args.output, restart=args.restart)
+
+    def write(result):
+        nonlocal done
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+        done += 1
+        status = "❌" if "error" in result else "✅"
+        print(f"{status} {done}/{len(todo)} {result['id']}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch-qa") as pool:
+            pending = {}
+
+            def drain(limit):
+                while len(pending) > limit:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        write(result_or_error(future, pending.pop(future)))
+
+            for batch_start in range(0, len(todo), args.batch_size):
+                batch = todo[batch_start:batch_start + args.batch_size]
+                if rag.query_caches.index_changed():
+                    # Index reconstruit : les lots en cours finissent sur l'ancien (leurs positions
+                    # FAISS s'y rapportent) avant le rechargement
+                    drain(0)
+                    rag.refresh_index()
+                errors = {}
+                query_vectors, dense, selections, batch_timings = search_batch(rag, batch, errors)
+                for i, item in enumerate(batch):
+                    if item["id"] in errors:
+                        write({"id": item["id"], "question": item["question"], "error": errors[item["id"]]})
+                        continue
+                    future = pool.submit(answer, rag, item, query_vectors[i], dense[i], selections[i],
+                                         batch_timings, args)
+                    pending[future] = item
+
+                # Au plus un lot d'avance : les résultats sont écrits pendant l'encodage du lot suivant
+                drain(args.batch_size)
+            for future in as_completed(list(pending)):
+                write(result_or_error(future, pending.pop(future)))
+    finally:
+        output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"⏱ {done} question(s) en {elapsed:.1f} s ({done / elapsed:.2f} question(s)/s)")
+    summarize(items, read_results(args.output), args.k)
+
+
+def result_or_error(future, item):
+    try:
+        return future.result()
+    except Exception as e:
+        # En erreur : écrit pour le suivi, mais retraité à la prochaine reprise
+        print(f"❌ {item['id']} : {e}", file=sys.stderr)
+        return {"id": item["id"], "question": item["question"], "error": str(e)}
+
+
+if __name__ == "__main__":
+    main()
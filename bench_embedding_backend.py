@@ -0,0 +1,153 @@
+"""
+bench_embedding_backend.py
+
+Parité d'un backend d'embedding (onnx, onnx-int8) avec les vecteurs fp32 d'index_agam.
+
+Mesures, sur un échantillon de segments et de requêtes :
+  * dérive cosinus : 1 - cos(vecteur du backend, vecteur stocké dans l'index) ;
+  * recall@k requêtes seules : questions encodées par le backend, cherchées dans
+    l'index complet, comparées aux résultats des questions encodées en fp32 ;
+  * recall@k ingestion + requêtes : segments et questions encodés par le
+    backend (sous-index de l'échantillon), comparés au même sous-index fp32 ;
+  * débit d'encodage des segments et latence d'une question, pour les deux backends.
+
+Sans fichier de questions, les requêtes sont le début de segments tirés au hasard.
+Le code de sortie est 1 si un recall passe sous --min-recall.
+
+Usage :
+    python bench_embedding_backend.py --backend onnx-int8 --onnx-dir onnx_bge
+    python bench_embedding_backend.py --questions questions.txt --sample 2000 --output parite.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from bench_faiss_index import recall_at_k
+from chunk_store import ChunkStore
+from embedding_backends import BACKENDS, DEFAULT_ONNX_DIR, EMBEDDING_MODEL, embedding_id, make_embeddings
+from faiss_index_factory import flat_vectors
+from index_manifest import manifest_embedding_model
+
+
+def pseudo_questions(texts, n_queries, words=12, seed=0):
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(texts), size=min(n_queries, len(texts)), replace=False)
+    return [" ".join(texts[i].split()[:words]) for i in picked]
+
+
+def encode(embeddings, texts):
+    start = time.perf_counter()
+    vectors = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    return vectors, time.perf_counter() - start
+
+
+def query_latency_ms(embeddings, questions, n=50):
+    """Latence médiane d'une question encodée seule (comme dans app.py)."""
+    latencies = []
+    for question in questions[:n]:
+        start = time.perf_counter()
+        embeddings.embed_query(question)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return float(np.median(latencies))
+
+
+def search(vectors, queries, k):
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    return index.search(queries, k)[1]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Dérive cosinus et recall@k d'un backend d'embedding face au fp32.")
+    parser.add_argument("--index-path", default="index_agam")
+    parser.add_argument("--backend", choices=BACKENDS, default="onnx-int8")
+    parser.add_argument("--onnx-dir", default=DEFAULT_ONNX_DIR)
+    parser.add_argument("--threads", type=int, default=None, help="Threads onnxruntime (défaut : tous les cœurs).")
+    parser.add_argument("--sample", type=int, default=1000, help="Segments ré-encodés par le backend.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--questions", default=None, help="Fichier texte : une question par ligne.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    parser.add_argument("--output", default=None, help="Fichier JSON des résultats.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    indexed_with = manifest_embedding_model(args.index_path)
+    if indexed_with != EMBEDDING_MODEL:
+        print(f"⚠️ index_agam a été encodé avec {indexed_with}, pas avec la référence fp32 {EMBEDDING_MODEL}.")
+
+    flat_index = faiss.read_index(os.path.join(args.index_path, "index.faiss"))
+    stored = flat_vectors(flat_index)
+    store = ChunkStore(args.index_path)
+    rng = np.random.default_rng(0)
+    positions = np.sort(rng.choice(len(stored), size=min(args.sample, len(stored)), replace=False))
+    texts = [record["text"] for record in store.get_many(positions)]
+    store.close()
+
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()][:args.queries]
+    else:
+        questions = pseudo_questions(texts, args.queries)
+    print(f"📊 {len(stored)} vecteurs, {len(texts)} segments échantillonnés, {len(questions)} requêtes")
+
+    reference = make_embeddings("torch")
+    candidate = make_embeddings(args.backend, onnx_dir=args.onnx_dir, threads=args.threads)
+
+    # Dérive des vecteurs de segments par rapport aux vecteurs stockés
+    doc_vectors, candidate_seconds = encode(candidate, texts)
+    cosines = np.sum(doc_vectors * stored[positions], axis=1)
+    drift = 1.0 - cosines
+
+    # Requêtes seules : l'index complet reste celui d'index_agam
+    reference_queries, _ = encode(reference, questions)
+    candidate_queries, _ = encode(candidate, questions)
+    _, reference_found = flat_index.search(reference_queries, args.k)
+    _, candidate_found = flat_index.search(candidate_queries, args.k)
+    query_recall = recall_at_k(reference_found, candidate_found, args.k)
+
+    # Ingestion + requêtes avec le backend, sur le sous-index de l'échantillon
+    sample_recall = recall_at_k(search(stored[positions], reference_queries, args.k),
+                                search(doc_vectors, candidate_queries, args.k), args.k)
+
+    # Débit de la référence sur les mêmes segments (une partie suffit)
+    reference_texts = texts[:min(len(texts), 200)]
+    _, reference_seconds = encode(reference, reference_texts)
+
+    result = {
+        "backend": embedding_id(args.backend),
+        "segments": len(texts),
+        "queries": len(questions),
+        "cosine_drift_mean": round(float(drift.mean()), 6),
+        "cosine_drift_p99": round(float(np.percentile(drift, 99)), 6),
+        "cosine_drift_max": round(float(drift.max()), 6),
+        f"recall@{args.k}_queries": round(query_recall, 4),
+        f"recall@{args.k}_queries_and_chunks": round(sample_recall, 4),
+        "chunks_per_s": round(len(texts) / candidate_seconds, 1),
+        "reference_chunks_per_s": round(len(reference_texts) / reference_seconds, 1),
+        "query_ms_p50": round(query_latency_ms(candidate, questions), 2),
+        "reference_query_ms_p50": round(query_latency_ms(reference, questions), 2),
+    }
+    for key, value in result.items():
+        print(f"   {key:<32} {value}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=1)
+        print(f"✅ Résultats enregistrés dans '{args.output}'.")
+
+    if min(query_recall, sample_recall) < args.min_recall:
+        print(f"❌ Recall@{args.k} sous {args.min_recall} : garder le backend fp32.")
+        sys.exit(1)
+    print(f"✅ Recall@{args.k} ≥ {args.min_recall} : {args.backend} peut remplacer le fp32.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+bench_faiss_index.py
+
+Compare les types d'index FAISS sur les vecteurs réels d'index_agam :
+recall@10 par rapport à l'index plat, latence de recherche et taille de l'index.
+
+Les requêtes sont des vecteurs du corpus légèrement bruités puis renormalisés
+(pas besoin du modèle d'embedding). La vérité terrain est la recherche exacte.
+
+Usage :
+    python bench_faiss_index.py
+    python bench_faiss_index.py --types ivf-pq hnsw --nprobe 8 32 --ef-search 64 256 \
+        --output bench_faiss.json
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from faiss_index_factory import INDEX_TYPES, factory_spec, build_index, set_search_params, flat_vectors
+
+
+def make_queries(vectors, n_queries, noise=0.05, seed=0):
+    """Requêtes proches du corpus : vecteurs tirés au hasard + bruit gaussien, renormalisés."""
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)].copy()
+    queries += rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def recall_at_k(ground_truth, found, k):
+    hits = sum(len(set(gt[:k]) & set(row[:k])) for gt, row in zip(ground_truth, found))
+    return hits / (len(ground_truth) * k)
+
+
+def time_search(index, queries, k):
+    """Latences par requête (ms), recherches une à une comme dans app.py."""
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(ids[0])
+    return np.array(latencies), np.array(found)
+
+
+def index_size_bytes(index):
+    return len(faiss.serialize_index(index))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark recall / latence / taille des types d'index FAISS.")
+    parser.add_argument("--index-path", default="index_agam")
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--train-size", type=int, default=50000)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 128])
+    parser.add_argument("--output", default=None, help="Fichier JSON des résultats.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    flat_index = faiss.read_index(f"{args.index_path}/index.faiss")
+    vectors = flat_vectors(flat_index)
+    queries = make_queries(vectors, args.queries)
+    print(f"📊 {flat_index.ntotal} vecteurs de dimension {flat_index.d}, {len(queries)} requêtes")
+
+    _, ground_truth = flat_index.search(queries, args.k)
+
+    results = []
+    for index_type in args.types:
+        spec = factory_spec(index_type, len(vectors), vectors.shape[1],
+                            nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+        start = time.perf_counter()
+        index = flat_index if index_type == "flat" else build_index(vectors, spec, train_size=args.train_size)
+        build_seconds = time.perf_counter() - start
+
+        # Un point de mesure par valeur du réglage de recherche propre au type
+        if index_type.startswith("ivf"):
+            settings = [{"nprobe": n} for n in args.nprobe]
+        elif index_type == "hnsw":
+            settings = [{"ef_search": ef} for ef in args.ef_search]
+        else:
+            settings = [{}]
+
+        size = index_size_bytes(index)
+        for setting in settings:
+            set_search_params(index, **setting)
+            latencies, found = time_search(index, queries, args.k)
+            result = {
+                "type": index_type,
+                "spec": spec,
+                **setting,
+                f"recall@{args.k}": round(recall_at_k(ground_truth, found, args.k), 4),
+                "latency_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+                "latency_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+                "size_mb": round(size / 1024 / 1024, 2),
+                "bytes_per_vector": round(size / max(1, index.ntotal), 1),
+                "build_s": round(build_seconds, 2),
+            }
+            results.append(result)
+            print(" | ".join(f"{key}={value}" for key, value in result.items()))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+        print(f"✅ Résultats enregistrés dans '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
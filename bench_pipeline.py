@@ -0,0 +1,291 @@
+"""
+bench_pipeline.py
+
+Benchmark de bout en bout, hors ligne, du pipeline RAG :
+
+* ingestion (fonctions de script_rag2.py) sur un corpus synthétique :
+  débit de chaque étape — chargement, clean_text, découpage, déduplication,
+  embeddings, indexation (FAISS + chunks.bin + BM25) ;
+* requêtes (mêmes briques qu'app.py) : latences p50 / p95 / p99 par étape —
+  embedding de la question, recherche hybride, construction du prompt, premier
+  token, réponse complète — puis débit en requêtes concurrentes ;
+* pic de mémoire résidente (RSS) après chaque phase.
+
+Le modèle d'embedding et Ollama sont remplacés par les doublures de
+bench_stubs.py : les chiffres mesurent le code du pipeline, pas les modèles
+(`--embed-ms-per-text` et `--tokens-per-s` simulent leur coût). Aucune clé
+OpenAI n'est nécessaire.
+
+clean_text est déjà appliqué aux pages PDF pendant le chargement ; l'étape
+clean_text le mesure à part, sur le texte chargé.
+
+Usage :
+    python bench_pipeline.py --output bench_results.json
+    python bench_pipeline.py --files 200 --queries 100 --concurrency 8 \
+        --baseline bench_results.json --output bench_new.json
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_ollama.llms import OllamaLLM
+
+from bench_stubs import FakeEmbeddings, StubOllamaServer, write_corpus, sample_questions
+from bm25_index import BM25Index, build_bm25_index, reciprocal_rank_fusion
+from chunk_store import save_vectorstore
+from context_packing import pack_context, build_prompt
+from faiss_index_factory import load_vectorstore, write_approximate_index
+from index_manifest import scan_files, file_sha256, chunk_ids_for
+from near_duplicates import NearDuplicateIndex
+from script_rag2 import load_file, clean_text, split_documents, iter_dedup
+
+
+def peak_rss_mb():
+    # ru_maxrss est en Ko sous Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def stage_result(seconds, items, unit):
+    return {"seconds": round(seconds, 4), unit: items,
+            f"{unit}_per_s": round(items / seconds, 1) if seconds else None}
+
+
+def percentiles(values_ms):
+    values = np.array(values_ms)
+    return {"p50_ms": round(float(np.percentile(values, 50)), 2),
+            "p95_ms": round(float(np.percentile(values, 95)), 2),
+            "p99_ms": round(float(np.percentile(values, 99)), 2),
+            "mean_ms": round(float(values.mean()), 2)}
+
+
+# --- Ingestion -------------------------------------------------------------------
+
+def bench_ingestion(args, data_dir, index_path, embeddings):
+    stages = {}
+    paths = scan_files(data_dir)
+
+    start = time.perf_counter()
+    loaded = [(path, load_file(path)) for path in paths]
+    n_chars = sum(len(doc.page_content) for _, docs in loaded for doc in docs)
+    stages["load"] = {**stage_result(time.perf_counter() - start, len(paths), "files"),
+                      "mb_per_s": round(n_chars / 1e6 / (time.perf_counter() - start), 2)}
+
+    start = time.perf_counter()
+    for _, docs in loaded:
+        for doc in docs:
+            clean_text(doc.page_content)
+    stages["clean_text"] = stage_result(time.perf_counter() - start, n_chars, "chars")
+
+    start = time.perf_counter()
+    units = []
+    for path, docs in loaded:
+        chunks = split_documents(docs)
+        units.append(({"path": path}, chunks, chunk_ids_for(path, file_sha256(path), len(chunks))))
+    n_chunks = sum(len(chunks) for _, chunks, _ in units)
+    stages["split"] = stage_result(time.perf_counter() - start, n_chunks, "chunks")
+
+    if args.dedup_threshold > 0:
+        start = time.perf_counter()
+        dedup = NearDuplicateIndex(threshold=args.dedup_threshold)
+        units = list(iter_dedup(units, dedup))
+        stages["dedup"] = {**stage_result(time.perf_counter() - start, n_chunks, "chunks"),
+                           "duplicates": dedup.matches}
+
+    docs = [doc for _, chunks, _ in units for doc in chunks]
+    ids = [chunk_id for _, _, chunk_ids in units for chunk_id in chunk_ids]
+
+    start = time.perf_counter()
+    vectors = []
+    for i in range(0, len(docs), args.batch_size):
+        vectors.extend(embeddings.embed_documents([doc.page_content for doc in docs[i:i + args.batch_size]]))
+    stages["embed"] = stage_result(time.perf_counter() - start, len(docs), "chunks")
+
+    start = time.perf_counter()
+    vectorstore = FAISS.from_embeddings(list(zip([doc.page_content for doc in docs], vectors)), embeddings,
+                                        metadatas=[doc.metadata for doc in docs], ids=ids)
+    save_vectorstore(vectorstore, index_path)
+    write_approximate_index(index_path, vectorstore.index, "flat")
+    build_bm25_index(index_path, (doc.page_content for doc in docs))
+    stages["index"] = stage_result(time.perf_counter() - start, len(docs), "chunks")
+
+    return stages, [doc.page_content for doc in docs]
+
+
+# --- Requêtes --------------------------------------------------------------------
+
+def answer_question(question, vectorstore, bm25, embeddings, llm, args):
+    """Une requête complète, chronométrée étape par étape comme dans chatbot()."""
+    timings = {}
+    start = time.perf_counter()
+    query_vector = np.array(embeddings.embed_query(question), dtype=np.float32)
+    timings["embed"] = time.perf_counter()
+
+    _, indices = vectorstore.index.search(query_vector.reshape(1, -1), args.hybrid_candidates)
+    dense = [int(i) for i in indices[0] if i != -1]
+    positions = reciprocal_rank_fusion([dense, bm25.search(question, args.hybrid_candidates)], k=args.k)
+    docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[p]) for p in positions]
+    timings["search"] = time.perf_counter()
+
+    retrieved_text, _, _ = pack_context(docs, token_budget=args.context_token_budget)
+    prompt = build_prompt(question, retrieved_text)
+    timings["prompt"] = time.perf_counter()
+
+    for fragment in llm.stream(prompt):
+        if "first_token" not in timings and fragment:
+            timings["first_token"] = time.perf_counter()
+    timings["answer"] = time.perf_counter()
+
+    # Durée de chaque étape ; premier token et réponse complète depuis le début de la requête
+    stages, previous = {}, start
+    for name in ("embed", "search", "prompt"):
+        stages[name] = (timings[name] - previous) * 1000
+        previous = timings[name]
+    stages["first_token"] = (timings.get("first_token", timings["answer"]) - start) * 1000
+    stages["answer"] = (timings["answer"] - start) * 1000
+    return stages
+
+
+def bench_queries(args, index_path, embeddings, texts, stub_url):
+    vectorstore = load_vectorstore(index_path, embeddings)
+    bm25 = BM25Index(index_path)
+    llm = OllamaLLM(model="deepseek-r1", base_url=stub_url)
+    questions = sample_questions(texts, args.queries, seed=args.seed)
+
+    samples = [answer_question(q, vectorstore, bm25, embeddings, llm, args) for q in questions]
+    latency = {stage: percentiles([s[stage] for s in samples]) for stage in samples[0]}
+
+    throughput = None
+    if args.concurrency > 1:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(lambda q: answer_question(q, vectorstore, bm25, embeddings, llm, args), questions))
+        elapsed = time.perf_counter() - start
+        throughput = {"concurrency": args.concurrency, "queries": len(questions),
+                      "seconds": round(elapsed, 3), "queries_per_s": round(len(questions) / elapsed, 2)}
+    return latency, throughput
+
+
+# --- Comparaison avec un run précédent -----------------------------------------
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """Métriques dégradées de plus de `tolerance` (débits en baisse, durées / mémoire en hausse)."""
+    current, previous = flatten(results["ingestion"]), flatten(baseline.get("ingestion", {}))
+    current.update(flatten(results["query"], "query."))
+    previous.update(flatten(baseline.get("query", {}), "query."))
+    current.update(flatten(results["peak_rss_mb"], "rss."))
+    previous.update(flatten(baseline.get("peak_rss_mb", {}), "rss."))
+
+    regressions = []
+    for name, value in current.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        higher_is_better = name.endswith("_per_s")
+        lower_is_better = name.endswith(("_ms", "seconds")) or name.startswith("rss.")
+        change = (value - old) / old
+        if (higher_is_better and change < -tolerance) or (lower_is_better and change > tolerance):
+            regressions.append({"metric": name, "baseline": old, "current": value,
+                                "change_pct": round(change * 100, 1)})
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne ingestion + requêtes du pipeline RAG.")
+    parser.add_argument("--files", type=int, default=40, help="Nombre de fichiers du corpus synthétique.")
+    parser.add_argument("--paragraphs", type=int, default=30, help="Paragraphes par fichier.")
+    parser.add_argument("--pdf-share", type=float, default=0.5)
+    parser.add_argument("--republished-share", type=float, default=0.2)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4, help="Requêtes simultanées (mesure du débit).")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--hybrid-candidates", type=int, default=30)
+    parser.add_argument("--context-token-budget", type=int, default=3000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--dedup-threshold", type=float, default=0.9)
+    parser.add_argument("--embed-dim", type=int, default=1024)
+    parser.add_argument("--embed-ms-per-text", type=float, default=0.0,
+                        help="Coût simulé du modèle d'embedding par texte (ms).")
+    parser.add_argument("--tokens-per-s", type=float, default=200.0, help="Débit du faux Ollama.")
+    parser.add_argument("--first-token-ms", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="Dossier de travail (défaut : temporaire, supprimé).")
+    parser.add_argument("--output", default=None, help="fichier JSON des résultats")
+    parser.add_argument("--baseline", default=None, help="résultats JSON d'un run précédent à comparer")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Écart toléré avant de signaler une régression.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_rag_")
+    data_dir, index_path = os.path.join(workdir, "data"), os.path.join(workdir, "index")
+    os.makedirs(index_path, exist_ok=True)
+    embeddings = FakeEmbeddings(dim=args.embed_dim, ms_per_text=args.embed_ms_per_text)
+
+    try:
+        write_corpus(data_dir, n_files=args.files, paragraphs_per_file=args.paragraphs,
+                     pdf_share=args.pdf_share, republished_share=args.republished_share, seed=args.seed)
+        print(f"📄 Corpus synthétique : {args.files} fichiers dans {data_dir}")
+        rss = {"start": peak_rss_mb()}
+
+        ingestion, texts = bench_ingestion(args, data_dir, index_path, embeddings)
+        rss["after_ingestion"] = peak_rss_mb()
+        for stage, result in ingestion.items():
+            print(f"⚙️ {stage} : " + " | ".join(f"{key}={value}" for key, value in result.items()))
+
+        with StubOllamaServer(tokens_per_s=args.tokens_per_s, first_token_ms=args.first_token_ms,
+                              answer_tokens=args.answer_tokens) as stub:
+            latency, throughput = bench_queries(args, index_path, embeddings, texts, stub.url)
+        rss["after_queries"] = peak_rss_mb()
+        for stage, result in latency.items():
+            print(f"⏱ {stage} : " + " | ".join(f"{key}={value}" for key, value in result.items()))
+        if throughput:
+            print(f"🚀 {throughput['queries_per_s']} requêtes/s à {throughput['concurrency']} en parallèle")
+        print(f"📊 Pic RSS : {rss['after_queries']} Mo")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "config": vars(args),
+        "ingestion": ingestion,
+        "query": {"latency": latency, "throughput": throughput or {}},
+        "peak_rss_mb": rss,
+    }
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            results["regressions"] = compare(results, json.load(f), args.tolerance)
+        for regression in results["regressions"]:
+            print(f"⚠️ Régression {regression['metric']} : {regression['baseline']} → "
+                  f"{regression['current']} ({regression['change_pct']:+}%)")
+        if not results["regressions"]:
+            print("✅ Aucune régression par rapport au run de référence.")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"✅ Résultats enregistrés dans '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
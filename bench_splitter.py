@@ -0,0 +1,99 @@
+"""
+bench_splitter.py
+
+Compare l'ancien découpage en deux passes (RecursiveCharacterTextSplitter de
+2000 caractères puis TokenTextSplitter) au découpage en une passe de
+token_chunker.py : segments par seconde, taille des segments en tokens et
+part du texte couverte.
+
+Usage :
+    python bench_splitter.py
+    python bench_splitter.py --files documents_transformes.txt --repeat 3 --output bench_splitter.json
+"""
+import argparse
+import json
+import time
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TokenTextSplitter
+
+from context_packing import get_encoding
+from token_chunker import TokenChunker
+
+
+def two_stage_split(documents):
+    """Découpage d'origine de script_rag2.py (avant token_chunker)."""
+    structured_splitter = RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", ".", " "], chunk_size=2000, chunk_overlap=300)
+    token_splitter = TokenTextSplitter(encoding_name="cl100k_base", chunk_size=300, chunk_overlap=50)
+    chunks = []
+    for doc in documents:
+        for large_chunk in structured_splitter.split_text(doc.page_content):
+            chunks.extend(token_splitter.split_text(large_chunk))
+    return chunks
+
+
+def one_pass_split(documents):
+    return [chunk.page_content for chunk in TokenChunker().split_documents(documents)]
+
+
+def coverage(documents, chunks):
+    """Part des lignes non vides du corpus retrouvées dans au moins un segment."""
+    lines = [line.strip() for doc in documents for line in doc.page_content.splitlines() if line.strip()]
+    joined = "\n".join(chunks)
+    return sum(line in joined for line in lines) / len(lines) if lines else 1.0
+
+
+def measure(name, split, documents, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = split(documents)
+        timings.append(time.perf_counter() - start)
+    encoding = get_encoding("cl100k_base")
+    sizes = [len(encoding.encode(chunk, disallowed_special=())) for chunk in chunks]
+    best = min(timings)
+    return {
+        "splitter": name,
+        "chunks": len(chunks),
+        "best_s": round(best, 3),
+        "chunks_per_s": round(len(chunks) / best, 1) if best else None,
+        "avg_tokens": round(sum(sizes) / len(sizes), 1) if sizes else 0,
+        "max_tokens": max(sizes, default=0),
+        "line_coverage": round(coverage(documents, chunks), 4),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark du découpage en segments (deux passes vs une passe).")
+    parser.add_argument("--files", nargs="+", default=["documents_transformes.txt"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="fichier JSON des résultats")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    documents = []
+    for path in args.files:
+        with open(path, "r", encoding="utf-8") as f:
+            documents.append(Document(page_content=f.read(), metadata={"source": path}))
+    n_chars = sum(len(doc.page_content) for doc in documents)
+    print(f"📊 {len(documents)} document(s), {n_chars} caractères, {args.repeat} répétition(s)")
+
+    get_encoding("cl100k_base")  # chargement de l'encodage hors chronométrage
+    results = [measure("deux passes", two_stage_split, documents, args.repeat),
+               measure("une passe", one_pass_split, documents, args.repeat)]
+    for result in results:
+        print(" | ".join(f"{key}={value}" for key, value in result.items()))
+    if results[0]["chunks_per_s"] and results[1]["chunks_per_s"]:
+        print(f"⚡ Accélération : x{results[1]['chunks_per_s'] / results[0]['chunks_per_s']:.2f} (segments/s)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"✅ Résultats enregistrés dans '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+bench_stubs.py
+
+Doublures locales pour mesurer le pipeline sans GPU, sans modèle et sans réseau :
+
+* `write_corpus`     corpus synthétique en français (fichiers .txt et .pdf, avec
+                     une part de versions republiées pour la déduplication) ;
+* `FakeEmbeddings`   embeddings déterministes (sac de mots haché, normalisé),
+                     avec un coût simulé optionnel par texte ;
+* `StubOllamaServer` serveur HTTP qui imite /api/generate d'Ollama, avec un débit
+                     de tokens et un délai avant le premier token configurables.
+
+Utilisé par bench_pipeline.py.
+"""
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fitz  # PyMuPDF
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# --- Corpus synthétique --------------------------------------------------------
+
+SUJETS = [
+    "Le plan local d'urbanisme intercommunal", "Le schéma de cohérence territoriale",
+    "La métropole Aix-Marseille-Provence", "Le programme local de l'habitat",
+    "L'orientation d'aménagement et de programmation", "Le plan de déplacements urbains",
+    "La commune de Marseille", "Le projet d'aménagement et de développement durables",
+    "L'agence d'urbanisme de l'agglomération marseillaise", "Le quartier prioritaire",
+]
+VERBES = [
+    "prévoit", "encadre", "fixe", "identifie", "renforce", "limite", "organise",
+    "favorise", "précise", "protège",
+]
+COMPLEMENTS = [
+    "la densification autour des pôles d'échanges", "la consommation d'espaces naturels et agricoles",
+    "la production de logements sociaux", "les continuités écologiques de la trame verte et bleue",
+    "la hauteur maximale des constructions en zone UA", "le stationnement des vélos dans les immeubles neufs",
+    "la desserte en transports collectifs", "la mixité fonctionnelle des centres anciens",
+    "les zones d'activités économiques du littoral", "la gestion du risque inondation",
+]
+PRECISIONS = [
+    "conformément à l'article L.151-1 du code de l'urbanisme", "à l'horizon 2030",
+    "dans le respect de la loi Climat et résilience", "sur l'ensemble du territoire métropolitain",
+    "selon les objectifs chiffrés du document d'orientation", "en lien avec les communes concernées",
+    "d'ici la prochaine révision", "pour la période 2020-2026",
+]
+
+
+def french_sentence(rng):
+    return f"{rng.choice(SUJETS)} {rng.choice(VERBES)} {rng.choice(COMPLEMENTS)} {rng.choice(PRECISIONS)}."
+
+
+def french_paragraph(rng, sentences=(3, 7)):
+    return " ".join(french_sentence(rng) for _ in range(rng.randint(*sentences)))
+
+
+def write_pdf(path, pages):
+    doc = fitz.open()
+    for text in pages:
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), text, fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def write_corpus(data_dir, n_files=40, paragraphs_per_file=30, pdf_share=0.5, republished_share=0.2, seed=0):
+    """
+    Écrit un corpus synthétique dans `data_dir` et retourne la liste des fichiers.
+
+    Une part `republished_share` des fichiers reprend le texte d'un fichier
+    précédent avec quelques paragraphes modifiés (versions successives d'un rapport).
+    """
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    contents, paths = [], []
+    for number in range(n_files):
+        if contents and rng.random() < republished_share:
+            paragraphs = list(rng.choice(contents))
+            for _ in range(max(1, len(paragraphs) // 10)):
+                paragraphs[rng.randrange(len(paragraphs))] = french_paragraph(rng)
+        else:
+            paragraphs = [french_paragraph(rng) for _ in range(paragraphs_per_file)]
+        contents.append(paragraphs)
+
+        if rng.random() < pdf_share:
+            path = os.path.join(data_dir, f"rapport_{number:04d}.pdf")
+            write_pdf(path, ["\n\n".join(paragraphs[i:i + 4]) for i in range(0, len(paragraphs), 4)])
+        else:
+            path = os.path.join(data_dir, f"note_{number:04d}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n\n".join(paragraphs))
+        paths.append(path)
+    return paths
+
+
+def sample_questions(texts, n_questions, seed=0):
+    """Questions tirées du corpus : un fragment de phrase d'un segment au hasard."""
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(n_questions):
+        words = rng.choice(texts).split()
+        start = rng.randrange(max(1, len(words) - 8))
+        questions.append("Que dit le document sur " + " ".join(words[start:start + 8]) + " ?")
+    return questions
+
+
+# --- Embeddings déterministes -------------------------------------------------
+
+class FakeEmbeddings(Embeddings):
+    """Sac de mots haché en `dim` composantes, normalisé : des textes proches donnent des vecteurs proches."""
+
+    def __init__(self, dim=1024, ms_per_text=0.0):
+        self.dim = dim
+        self.ms_per_text = ms_per_text  # coût simulé du modèle
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            h = zlib.crc32(word.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & (1 << 31) else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        if self.ms_per_text:
+            time.sleep(self.ms_per_text * len(texts) / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# --- Serveur Ollama simulé ----------------------------------------------------
+
+class StubOllamaServer:
+    """
+    Imite POST /api/generate (flux NDJSON ou réponse unique) à `tokens_per_s` tokens/s.
+
+    La réponse commence par une courte section <think> comme deepseek-r1.
+    `active` / `max_active` comptent les générations simultanées. Avec `error`,
+    le flux s'interrompt après la section <think> sur une ligne {"error": ...},
+    comme Ollama quand la génération échoue.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, tokens_per_s=50.0, first_token_ms=200.0, answer_tokens=120,
+                 error=None):
+        self.tokens_per_s = tokens_per_s
+        self.first_token_ms = first_token_ms
+        self.answer_tokens = answer_tokens
+        self.error = error
+        self.requests = self.active = self.max_active = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tokens(self, prompt):
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        words = ["<think>", "Je", "cherche", "dans", "les", "extraits.", "</think>"]
+        words += [rng.choice(COMPLEMENTS).split()[rng.randrange(3)] for _ in range(self.answer_tokens)]
+        return [word + " " for word in words]
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, flux en chunked
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path == "/api/version":
+                    self._send_json({"version": "0.0.0-stub"})
+                elif self.path == "/api/tags":
+                    self._send_json({"models": [{"name": "deepseek-r1:latest", "model": "deepseek-r1:latest"}]})
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path != "/api/generate":
+                    self._send_json({"error": "not found"}, status=404)
+                    return
+
+                with stub._lock:
+                    stub.requests += 1
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    self._generate(request)
+                finally:
+                    with stub._lock:
+                        stub.active -= 1
+
+            def _generate(self, request):
+                model = request.get("model", "deepseek-r1")
+                tokens = stub.tokens(request.get("prompt", ""))
+                delay = 1.0 / stub.tokens_per_s if stub.tokens_per_s else 0.0
+                time.sleep(stub.first_token_ms / 1000)
+                final = {"model": model, "created_at": "1970-01-01T00:00:00Z", "response": "", "done": True,
+                         "done_reason": "stop", "prompt_eval_count": len(request.get("prompt", "").split()),
+                         "eval_count": len(tokens)}
+
+                if not request.get("stream", True):
+                    if stub.error:
+                        self._send_json({"error": stub.error}, status=500)
+                        return
+                    time.sleep(delay * len(tokens))
+                    self._send_json({**final, "response": "".join(tokens)})
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for token in tokens:
+                    line = {"model": model, "created_at": "1970-01-01T00:00:00Z", "response": token, "done": False}
+                    self._chunk(json.dumps(line).encode("utf-8") + b"\n")
+                    time.sleep(delay)
+                    if stub.error and token == "</think> ":
+                        final = {"error": stub.error}
+                        break
+                self._chunk(json.dumps(final).encode("utf-8") + b"\n")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
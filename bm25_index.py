@@ -0,0 +1,251 @@
+"""
+bm25_index.py
+
+Index lexical BM25 sur les mêmes segments qu'index_agam (mêmes positions que
+FAISS / chunks.idx), pour retrouver les termes exacts que bge-large-en rate sur
+du texte français : noms de plans, de communes, sigles, numéros d'articles.
+
+Fichiers (index_agam/) :
+    bm25_vocab.json      terme → [début, df] dans les listes de postings, + N, avgdl
+    bm25_docs.u32        positions des segments, listes de postings concaténées
+    bm25_tfs.u16         fréquences du terme, alignées sur bm25_docs.u32
+    bm25_doclen.u32      longueur (en tokens) de chaque segment
+    bm25_chunks.u64      offsets dans chunks.bin des segments indexés (mises à jour incrémentales)
+
+Les tableaux sont ouverts en mmap : une requête ne lit que les listes de ses termes.
+Après une ingestion incrémentale, seuls les segments nouveaux ou modifiés sont
+tokenisés : les listes des autres sont renumérotées (update_bm25_index).
+"""
+import json
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+
+VOCAB_NAME = "bm25_vocab.json"
+DOCS_NAME = "bm25_docs.u32"
+TFS_NAME = "bm25_tfs.u16"
+DOCLEN_NAME = "bm25_doclen.u32"
+OFFSETS_NAME = "bm25_chunks.u64"
+
+# Mots outils français (sans accents, après normalisation)
+STOPWORDS = frozenset("""
+a au aux avec ce ces cet cette dans de des du elle en est et etre il ils je la le les leur leurs
+lui mais me meme mes moi mon ne nos notre nous on ou par pas pour qu que qui sa se ses son sont
+sur ta te tes toi ton tu un une vos votre vous y ete ont sans sous entre plus dont ainsi aussi
+""".split())
+
+# Élisions : l'aménagement → aménagement, d'urbanisme → urbanisme
+ELISION = re.compile(r"\b(?:l|d|j|m|n|s|t|c|qu|jusqu|lorsqu|puisqu)['’]", re.IGNORECASE)
+# Mots, sigles et références composées (L.151-1, R111-2, 2020-2030)
+TOKEN = re.compile(r"[0-9a-z]+(?:[.\-/][0-9a-z]+)*")
+
+
+def strip_accents(text):
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def light_stem(token):
+    """Racinisation légère : pluriels en -s / -x des mots assez longs, nombres intacts."""
+    if len(token) > 4 and not token[-1].isdigit() and token[-1] in "sx":
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Tokens BM25 d'un texte français ; les références composées sont aussi éclatées."""
+    text = strip_accents(ELISION.sub(" ", text)).lower()
+    tokens = []
+    for match in TOKEN.findall(text):
+        parts = re.split(r"[.\-/]", match)
+        if len(parts) > 1:
+            tokens.append(match)  # référence complète : « l.151-1 »
+        for part in parts:
+            if part and part not in STOPWORDS and (len(part) > 1 or part.isdigit()):
+                tokens.append(light_stem(part))
+    return tokens
+
+
+def _write_bm25_index(index_path, terms, term_ids, docs, tfs, doc_lengths, store=None):
+    """Écrit l'index à partir des postings (terme, position, tf) ; `terms` est trié, `docs` croissant par terme."""
+    df = np.bincount(term_ids, minlength=len(terms)) if len(terms) else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(df)[:-1]]) if len(terms) else df
+    vocab = {term: [int(start), int(count)] for term, start, count in zip(terms, starts, df)}
+
+    n_docs = len(doc_lengths)
+    meta = {"n_docs": n_docs, "avgdl": (int(np.sum(doc_lengths, dtype=np.int64)) / n_docs) if n_docs else 0.0,
+            "vocab": vocab}
+    arrays = [(DOCS_NAME, np.asarray(docs, dtype=np.uint32)), (TFS_NAME, np.asarray(tfs, dtype=np.uint16)),
+              (DOCLEN_NAME, np.asarray(doc_lengths, dtype=np.uint32))]
+    if store is not None:
+        # Empreinte et offsets du ChunkStore indexé : point de départ de la prochaine mise à jour
+        meta["chunk_store"] = store.snapshot()
+        arrays.append((OFFSETS_NAME, np.asarray(store.table["offset"], dtype=np.uint64)))
+    for name, array in arrays:
+        array.tofile(os.path.join(index_path, name + ".tmp"))
+    with open(os.path.join(index_path, VOCAB_NAME + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    # Le vocabulaire est renommé en dernier : il sert de marqueur de version aux lecteurs
+    for name, _ in arrays + [(VOCAB_NAME, None)]:
+        os.replace(os.path.join(index_path, name + ".tmp"), os.path.join(index_path, name))
+    return n_docs, len(vocab)
+
+
+def build_bm25_index(index_path, texts, store=None):
+    """
+    Construit et écrit l'index BM25 pour `texts`, dans l'ordre des positions FAISS.
+
+    Avec `store` (le ChunkStore dont viennent les textes), son empreinte est
+    enregistrée pour `update_bm25_index`.
+    """
+    postings = defaultdict(list)
+    doc_lengths = []
+    for position, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        doc_lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings[term].append((position, min(tf, np.iinfo(np.uint16).max)))
+
+    terms, term_ids, docs, tfs = sorted(postings), [], [], []
+    for term_id, term in enumerate(terms):
+        entries = postings[term]
+        term_ids.extend([term_id] * len(entries))
+        docs.extend(position for position, _ in entries)
+        tfs.extend(tf for _, tf in entries)
+    return _write_bm25_index(index_path, terms, np.asarray(term_ids, dtype=np.int64), docs, tfs, doc_lengths,
+                             store=store)
+
+
+def update_bm25_index(index_path, store):
+    """
+    Met l'index BM25 à jour pour le ChunkStore `store`.
+
+    Seuls les segments nouveaux ou modifiés depuis la dernière écriture sont
+    tokenisés ; les postings des autres sont renumérotées, celles des segments
+    retirés supprimées. Reconstruction complète si l'index n'a pas d'empreinte
+    ou si chunks.bin a été réécrit. Retourne (segments, termes, segments
+    tokenisés), ou None si l'index est déjà à jour.
+    """
+    meta = None
+    if has_bm25_index(index_path):
+        with open(os.path.join(index_path, VOCAB_NAME), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    if meta is not None and meta.get("chunk_store") == store.snapshot():
+        return None
+    offsets_path = os.path.join(index_path, OFFSETS_NAME)
+    changes = store.changes_since(meta.get("chunk_store"), np.fromfile(offsets_path, dtype=np.uint64)) \
+        if meta is not None and os.path.exists(offsets_path) else None
+    if changes is None:
+        n_docs, n_terms = build_bm25_index(index_path, (record["text"] for record in store), store=store)
+        return n_docs, n_terms, n_docs
+    remap, added = changes
+
+    # Postings conservées, renumérotées (l'ordre des segments restants ne change pas)
+    terms = sorted(meta["vocab"], key=lambda term: meta["vocab"][term][0])
+    df = np.array([meta["vocab"][term][1] for term in terms], dtype=np.int64)
+    term_ids = np.repeat(np.arange(len(terms), dtype=np.int64), df)
+    docs = remap[np.fromfile(os.path.join(index_path, DOCS_NAME), dtype=np.uint32)]
+    tfs = np.fromfile(os.path.join(index_path, TFS_NAME), dtype=np.uint16)
+    kept = docs >= 0
+    term_ids, docs, tfs = term_ids[kept], docs[kept], tfs[kept]
+    old_lengths = np.fromfile(os.path.join(index_path, DOCLEN_NAME), dtype=np.uint32)
+    doc_lengths = np.zeros(len(store), dtype=np.uint32)
+    doc_lengths[remap[remap >= 0]] = old_lengths[remap >= 0]
+
+    # Segments nouveaux ou modifiés
+    term_index = {term: term_id for term_id, term in enumerate(terms)}
+    new_terms, new_docs, new_tfs = [], [], []
+    for position in added:
+        counts = Counter(tokenize(store.get(int(position))["text"]))
+        doc_lengths[position] = sum(counts.values())
+        for term, tf in counts.items():
+            if term not in term_index:
+                term_index[term] = len(terms)
+                terms.append(term)
+            new_terms.append(term_index[term])
+            new_docs.append(position)
+            new_tfs.append(min(tf, np.iinfo(np.uint16).max))
+    term_ids = np.concatenate([term_ids, np.asarray(new_terms, dtype=np.int64)])
+    docs = np.concatenate([docs, np.asarray(new_docs, dtype=np.int64)])
+    tfs = np.concatenate([tfs, np.asarray(new_tfs, dtype=np.uint16)])
+
+    # Vocabulaire trié, sans les termes qui n'apparaissent plus ; postings regroupées par terme
+    used = np.flatnonzero(np.bincount(term_ids, minlength=len(terms)))
+    sorted_terms = sorted(terms[term_id] for term_id in used)
+    rank = np.full(len(terms), -1, dtype=np.int64)
+    rank[[term_index[term] for term in sorted_terms]] = np.arange(len(sorted_terms))
+    term_ids = rank[term_ids]
+    order = np.lexsort((docs, term_ids))
+    n_docs, n_terms = _write_bm25_index(index_path, sorted_terms, term_ids[order], docs[order], tfs[order],
+                                        doc_lengths, store=store)
+    return n_docs, n_terms, len(added)
+
+
+def has_bm25_index(index_path):
+    return os.path.exists(os.path.join(index_path, VOCAB_NAME))
+
+
+def _open_array(path, dtype):
+    # np.memmap refuse les fichiers vides (corpus vide)
+    return np.memmap(path, dtype=dtype, mode="r") if os.path.getsize(path) else np.zeros(0, dtype=dtype)
+
+
+class BM25Index:
+    """Recherche BM25 (Okapi) en lecture seule sur l'index écrit par `build_bm25_index`."""
+
+    def __init__(self, index_path, k1=1.2, b=0.75):
+        with open(os.path.join(index_path, VOCAB_NAME), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.vocab = meta["vocab"]
+        self.n_docs = meta["n_docs"]
+        self.avgdl = meta["avgdl"] or 1.0
+        self.k1, self.b = k1, b
+        self.docs = _open_array(os.path.join(index_path, DOCS_NAME), np.uint32)
+        self.tfs = _open_array(os.path.join(index_path, TFS_NAME), np.uint16)
+        self.doc_lengths = _open_array(os.path.join(index_path, DOCLEN_NAME), np.uint32)
+
+    def search(self, query, k=20, allowed=None):
+        """
+        Positions des k meilleurs segments pour `query`, par score BM25 décroissant.
+
+        `allowed` : masque booléen par position (filtres de métadonnées), appliqué avant le top-k.
+        """
+        matched_docs, matched_scores = [], []
+        for term in set(tokenize(query)):
+            entry = self.vocab.get(term)
+            if entry is None:
+                continue
+            start, df = entry
+            docs = np.asarray(self.docs[start:start + df])
+            tfs = np.asarray(self.tfs[start:start + df], dtype=np.float32)
+            idf = np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avgdl)
+            matched_docs.append(docs)
+            matched_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not matched_docs:
+            return []
+
+        # Somme des contributions de chaque terme par segment
+        positions, inverse = np.unique(np.concatenate(matched_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(matched_scores))
+        if allowed is not None:
+            keep = allowed[positions]
+            positions, scores = positions[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return positions[top].tolist()
+
+
+def reciprocal_rank_fusion(rankings, k=None, rrf_k=60):
+    """Fusionne plusieurs listes de positions classées : score = Σ 1 / (rrf_k + rang)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, start=1):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (rrf_k + rank)
+    fused = sorted(scores, key=lambda position: -scores[position])
+    return fused[:k] if k else fused
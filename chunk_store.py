@@ -0,0 +1,512 @@
+"""
+chunk_store.py
+
+Stockage compact des segments d'index_agam, à la place du docstore picklé de
+LangChain (`index.pkl`).
+
+    index_agam/chunks.bin   enregistrements JSON {id, text, metadata} concaténés (UTF-8)
+    index_agam/chunks.idx   table (offset, longueur) par position FAISS
+
+`app.py` ouvre ces fichiers en lecture seule via mmap : seuls les k segments
+renvoyés par FAISS sont lus et décodés, le démarrage ne désérialise rien, et
+plusieurs processus serveurs partagent la même copie par le cache de pages.
+Aucun pickle n'est chargé.
+
+Côté `script_rag2.py`, `ChunkStoreWriter` sert de docstore pendant
+l'ingestion : les segments déjà écrits restent sur disque (lus par mmap à la
+demande), seuls ceux ajoutés ou modifiés depuis le dernier point de reprise
+sont en mémoire. Un point de reprise ajoute ces segments à la fin de chunks.bin
+et de chunks.idx, et les nouveaux vecteurs à la fin d'index.faiss, au lieu de
+tout réécrire. Après des suppressions (positions décalées), chunks.idx et
+index.faiss sont réécrits (fichier temporaire puis renommage : un lecteur garde
+l'ancienne version ouverte) ; chunks.bin est compacté quand plus de la moitié
+de son contenu ne sert plus.
+
+    index_agam/chunks.gen   génération de chunks.bin, renouvelée à chaque réécriture
+    index_agam/chunks.ids   chunk_id de chaque position, un par ligne (relu sans décoder les segments)
+    index_agam/chunks.pending   présent pendant une réécriture de chunks.* / index.faiss
+
+Entre deux réécritures, chunks.bin ne fait que grandir : un offset y désigne
+toujours le même enregistrement. Les index dérivés (BM25, métadonnées, index
+servi) mémorisent la génération et les offsets sur lesquels ils ont été
+construits, et ne retraitent que les segments nouveaux ou modifiés.
+
+Une réécriture (suppressions, compaction, écriture complète) remplace plusieurs
+fichiers l'un après l'autre : un arrêt entre deux renommages les désalignerait
+sans que le nombre de vecteurs le révèle. `chunks.pending` est créé avant et
+supprimé après ; s'il est présent au chargement, l'index est reconstruit.
+"""
+import hashlib
+import json
+import mmap
+import os
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_community.vectorstores import FAISS
+
+CHUNKS_BIN = "chunks.bin"
+CHUNKS_IDX = "chunks.idx"
+CHUNKS_GEN = "chunks.gen"
+CHUNKS_IDS = "chunks.ids"
+CHUNKS_PENDING = "chunks.pending"
+RECORD_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
+
+def encode_record(chunk_id, text, metadata):
+    return json.dumps({"id": chunk_id, "text": text, "metadata": metadata}, ensure_ascii=False).encode("utf-8")
+
+
+def store_generation(index_path):
+    """Génération actuelle de chunks.bin (chaîne vide pour un index antérieur à chunks.gen)."""
+    path = os.path.join(index_path, CHUNKS_GEN)
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def _new_generation(index_path):
+    # Écrite avant le remplacement de chunks.bin : interrompu entre les deux, on reconstruit juste pour rien
+    path = os.path.join(index_path, CHUNKS_GEN)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(os.urandom(8).hex())
+    os.replace(path + ".tmp", path)
+
+
+@contextmanager
+def _rewriting(index_path, operation):
+    """Marque une réécriture en plusieurs fichiers : le marqueur ne disparaît que si elle va au bout."""
+    path = os.path.join(index_path, CHUNKS_PENDING)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(operation)
+    yield
+    os.remove(path)
+
+
+def interrupted_rewrite(index_path):
+    """Réécriture interrompue (fichiers possiblement désalignés), ou None."""
+    path = os.path.join(index_path, CHUNKS_PENDING)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip() or "réécriture"
+
+
+def _encode_ids(ids):
+    return b"".join(chunk_id.encode("utf-8") + b"\n" for chunk_id in ids)
+
+
+def _write_ids(index_path, ids):
+    path = os.path.join(index_path, CHUNKS_IDS)
+    with open(path + ".tmp", "wb") as f:
+        f.write(_encode_ids(ids))
+    os.replace(path + ".tmp", path)
+
+
+def read_chunk_ids(index_path, count):
+    """
+    Les `count` premiers chunk_ids de chunks.ids, sans décoder les segments, et la taille qu'ils y occupent.
+
+    None si chunks.ids est absent (index antérieur) ou en contient moins.
+    """
+    path = os.path.join(index_path, CHUNKS_IDS)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        lines = f.read().split(b"\n")[:-1]
+    if len(lines) < count:
+        return None
+    lines = lines[:count]
+    return [line.decode("utf-8") for line in lines], sum(map(len, lines)) + count
+
+
+def write_chunk_store(index_path, records):
+    """Écrit les enregistrements (chunk_id, texte, métadonnées), dans l'ordre des positions FAISS."""
+    bin_path = os.path.join(index_path, CHUNKS_BIN)
+    idx_path = os.path.join(index_path, CHUNKS_IDX)
+    table, ids = [], []
+    offset = 0
+    with open(bin_path + ".tmp", "wb") as f:
+        for chunk_id, text, metadata in records:
+            data = encode_record(chunk_id, text, metadata)
+            f.write(data)
+            table.append((offset, len(data)))
+            ids.append(chunk_id)
+            offset += len(data)
+    np.array(table, dtype=RECORD_DTYPE).tofile(idx_path + ".tmp")
+    _write_ids(index_path, ids)
+    _new_generation(index_path)
+    os.replace(bin_path + ".tmp", bin_path)
+    os.replace(idx_path + ".tmp", idx_path)
+
+
+def has_chunk_store(index_path):
+    return os.path.exists(os.path.join(index_path, CHUNKS_IDX))
+
+
+class ChunkStore:
+    """Accès en lecture seule, par position FAISS, aux segments d'index_agam."""
+
+    def __init__(self, index_path, table=None):
+        # `table` : table déjà en mémoire (ChunkStoreWriter), sinon chunks.idx
+        self.table = table if table is not None else np.fromfile(os.path.join(index_path, CHUNKS_IDX),
+                                                                 dtype=RECORD_DTYPE)
+        self.generation = store_generation(index_path)
+        self._file = open(os.path.join(index_path, CHUNKS_BIN), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.table)
+
+    def raw(self, position):
+        offset, length = self.table[position]
+        return self._blob[int(offset):int(offset) + int(length)]
+
+    def get(self, position):
+        """Enregistrement {id, text, metadata} à la position FAISS donnée."""
+        return json.loads(self.raw(position).decode("utf-8"))
+
+    def get_many(self, positions):
+        return [self.get(position) for position in positions]
+
+    def snapshot(self, count=None):
+        """Empreinte des `count` premières positions (toutes par défaut) : génération et SHA-1 de la table."""
+        return {"generation": self.generation, "digest": hashlib.sha1(self.table[:count].tobytes()).hexdigest()}
+
+    def changes_since(self, snapshot, offsets):
+        """
+        Différence avec l'état (`snapshot`, offsets par position) sur lequel un index dérivé a été construit.
+
+        Retourne (remap, added) : remap[ancienne position] = nouvelle position, ou -1
+        si le segment a été retiré ou modifié ; added = positions des segments
+        nouveaux ou modifiés. None si chunks.bin a été réécrit depuis (offsets
+        sans objet) : il faut tout reconstruire.
+        """
+        if snapshot is None or offsets is None or snapshot.get("generation") != self.generation:
+            return None
+        _, old_rows, new_rows = np.intersect1d(offsets, self.table["offset"], assume_unique=True,
+                                               return_indices=True)
+        remap = np.full(len(offsets), -1, dtype=np.int64)
+        remap[old_rows] = new_rows
+        kept = np.zeros(len(self), dtype=bool)
+        kept[new_rows] = True
+        return remap, np.flatnonzero(~kept)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.get(position)
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
+
+
+def record_to_document(record):
+    metadata = dict(record["metadata"])
+    metadata["chunk_id"] = record["id"]
+    return Document(page_content=record["text"], metadata=metadata)
+
+
+class ChunkStoreDocstore(Docstore):
+    """Docstore LangChain paresseux : les « identifiants » sont les positions FAISS."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def search(self, search):
+        try:
+            return record_to_document(self.store.get(int(search)))
+        except (IndexError, ValueError):
+            return f"ID {search} not found."
+
+
+class PositionIds(Mapping):
+    """index_to_docstore_id identité (position → position) sans matérialiser de dict."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise KeyError(position)
+        return position
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self):
+        return self.size
+
+
+def open_lazy_vectorstore(index, store, embeddings):
+    """Vectorstore LangChain en lecture seule sur un index FAISS et un ChunkStore."""
+    if index.ntotal != len(store):
+        raise ValueError(f"❌ Index FAISS ({index.ntotal}) et chunks.idx ({len(store)}) désalignés.")
+    return FAISS(embeddings, index, ChunkStoreDocstore(store), PositionIds(len(store)))
+
+
+# --- Côté ingestion (script_rag2.py) -----------------------------------------
+
+def _write_index(index, index_file):
+    faiss.write_index(index, index_file + ".tmp")
+    os.replace(index_file + ".tmp", index_file)
+
+
+def _flat_header(index, ntotal):
+    """En-tête écrit par `faiss.write_index` pour cet index plat avec `ntotal` vecteurs (None : autre type)."""
+    if type(index) not in (faiss.IndexFlatL2, faiss.IndexFlatIP):
+        return None
+    header = bytearray(faiss.serialize_index(type(index)(index.d)).tobytes())
+    # fourcc, d (int32), ntotal (int64), …, puis nombre de float32 des vecteurs (uint64) juste avant eux
+    header[8:16] = np.int64(ntotal).tobytes()
+    header[-8:] = np.uint64(ntotal * index.d).tobytes()
+    return bytes(header)
+
+
+def append_flat_vectors(index, index_file, saved):
+    """
+    Ajoute à la fin d'index.faiss les vecteurs de l'index plat à partir de la position `saved`.
+
+    Retourne False sans rien écrire si le fichier ne contient pas exactement les
+    `saved` premiers vecteurs d'un index de même type : il faut alors le réécrire.
+    """
+    header = _flat_header(index, saved)
+    if header is None or not os.path.exists(index_file) or \
+            os.path.getsize(index_file) != len(header) + saved * index.d * 4:
+        return False
+    with open(index_file, "r+b") as f:
+        if f.read(len(header)) != header:
+            return False
+        f.seek(0, os.SEEK_END)
+        f.write(index.reconstruct_n(saved, index.ntotal - saved).tobytes())
+        # En-tête mis à jour après les vecteurs : interrompu avant, le fichier se relit comme l'ancien index
+        f.seek(0)
+        f.write(_flat_header(index, index.ntotal))
+    return True
+
+
+class ChunkStoreWriter(Docstore, AddableMixin):
+    """
+    Docstore modifiable de l'ingestion, adossé à chunks.bin / chunks.idx.
+
+    Les identifiants sont les chunk_ids. `update` enregistre une modification des
+    métadonnées d'un segment (les documents relus sur disque sont des copies).
+    """
+
+    def __init__(self, index_path, ids=(), table=None, ids_size=None):
+        self.index_path = index_path
+        self.ids = list(ids)  # position → chunk_id
+        # Octets de chunks.ids occupés par les identifiants déjà écrits (None : fichier à réécrire)
+        self.ids_size = ids_size
+        self.rows = {chunk_id: position for position, chunk_id in enumerate(self.ids)}
+        # Entrées de chunks.idx déjà écrites (positions 0…len(table)-1), vecteurs déjà dans index.faiss
+        self.table = table if table is not None else np.zeros(0, dtype=RECORD_DTYPE)
+        self.saved_vectors = len(self.table)
+        self._new = {}      # segments ajoutés depuis le dernier point de reprise
+        self._updated = {}  # segments déjà écrits dont les métadonnées ont changé
+        self._fresh = table is None  # nouveau stockage : chunks.bin recommencé
+        self._shifted = False        # suppressions : positions décalées, chunks.idx et index.faiss réécrits
+        self._store = None
+        self._reopen()
+
+    def _path(self, name):
+        return os.path.join(self.index_path, name)
+
+    def _reopen(self):
+        if self._store is not None:
+            self._store.close()
+        self._store = ChunkStore(self.index_path, table=self.table) if len(self.table) else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, search):
+        for pending in (self._new, self._updated):
+            if search in pending:
+                return pending[search]
+        position = self.rows.get(search)
+        if position is None:
+            return f"ID {search} not found."
+        record = self._store.get(position)
+        return Document(page_content=record["text"], metadata=record["metadata"])
+
+    def add(self, texts):
+        for chunk_id, doc in texts.items():
+            if chunk_id in self.rows:
+                raise ValueError(f"Tried to add ids that already exist: {chunk_id}")
+            self.rows[chunk_id] = len(self.ids)
+            self.ids.append(chunk_id)
+            self._new[chunk_id] = doc
+
+    def update(self, chunk_id, doc):
+        if chunk_id in self._new:
+            self._new[chunk_id] = doc
+        elif chunk_id in self.rows:
+            self._updated[chunk_id] = doc
+
+    def delete(self, ids):
+        removed = np.zeros(len(self.ids), dtype=bool)
+        removed[[self.rows[chunk_id] for chunk_id in ids]] = True
+        for chunk_id in ids:
+            self._new.pop(chunk_id, None)
+            self._updated.pop(chunk_id, None)
+        self.table = self.table[~removed[:len(self.table)]]
+        self.ids = [chunk_id for chunk_id, gone in zip(self.ids, removed) if not gone]
+        self.rows = {chunk_id: position for position, chunk_id in enumerate(self.ids)}
+        self._shifted = True
+        self._reopen()
+
+    def save(self, index):
+        """Point de reprise : écrit les segments ajoutés / modifiés et les nouveaux vecteurs."""
+        os.makedirs(self.index_path, exist_ok=True)
+        if self._fresh or self._shifted:
+            # Positions nouvelles ou décalées : chunks.idx, chunks.ids et index.faiss réécrits ensemble
+            with _rewriting(self.index_path, "suppression" if self._shifted else "écriture complète"):
+                self._write(index)
+        else:
+            self._write(index)
+        self.saved_vectors = index.ntotal
+        self._new, self._updated = {}, {}
+        self._fresh = self._shifted = False
+        self._compact()
+        self._reopen()
+
+    def _write(self, index):
+        bin_path, idx_path, ids_path = self._path(CHUNKS_BIN), self._path(CHUNKS_IDX), self._path(CHUNKS_IDS)
+        rewrite = self._fresh or self._shifted
+        written = len(self.table)
+        table = np.concatenate([self.table, np.zeros(len(self._new), dtype=RECORD_DTYPE)])
+
+        # 1. Segments à la fin de chunks.bin (une entrée modifiée pointe vers sa nouvelle version)
+        with open(bin_path + ".tmp" if self._fresh else bin_path, "wb" if self._fresh else "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            for pending in (self._updated, self._new):
+                for chunk_id, doc in pending.items():
+                    data = encode_record(chunk_id, doc.page_content, doc.metadata)
+                    f.write(data)
+                    table[self.rows[chunk_id]] = (offset, len(data))
+                    offset += len(data)
+        if self._fresh:
+            _new_generation(self.index_path)
+            os.replace(bin_path + ".tmp", bin_path)
+
+        # 2. chunks.ids puis chunks.idx : entrées modifiées réécrites sur place, nouvelles ajoutées à la fin
+        if rewrite or self.ids_size is None:
+            _write_ids(self.index_path, self.ids)
+        else:
+            with open(ids_path, "r+b") as f:
+                f.seek(self.ids_size)
+                f.write(_encode_ids(self.ids[written:]))
+                f.truncate()
+        self.ids_size = os.path.getsize(ids_path)
+        if rewrite:
+            table.tofile(idx_path + ".tmp")
+            os.replace(idx_path + ".tmp", idx_path)
+        else:
+            size = RECORD_DTYPE.itemsize
+            with open(idx_path, "r+b") as f:
+                for position in sorted(self.rows[chunk_id] for chunk_id in self._updated):
+                    f.seek(position * size)
+                    f.write(table[position:position + 1].tobytes())
+                f.seek(written * size)
+                f.write(table[written:].tobytes())
+                f.truncate()
+        self.table = table
+
+        # 3. Vecteurs : ajoutés à la fin d'index.faiss quand c'est possible
+        index_file = self._path("index.faiss")
+        if rewrite or not append_flat_vectors(index, index_file, self.saved_vectors):
+            _write_index(index, index_file)
+
+    def _compact(self):
+        """Réécrit chunks.bin sans les anciennes versions quand elles en occupent plus de la moitié."""
+        bin_path, idx_path = self._path(CHUNKS_BIN), self._path(CHUNKS_IDX)
+        if os.path.getsize(bin_path) <= 2 * int(self.table["length"].sum()):
+            return
+        store = ChunkStore(self.index_path, table=self.table)
+        table = np.zeros(len(self.table), dtype=RECORD_DTYPE)
+        offset = 0
+        with open(bin_path + ".tmp", "wb") as f:
+            for position in range(len(table)):
+                data = store.raw(position)
+                f.write(data)
+                table[position] = (offset, len(data))
+                offset += len(data)
+        store.close()
+        table.tofile(idx_path + ".tmp")
+        with _rewriting(self.index_path, "compaction"):
+            _new_generation(self.index_path)
+            os.replace(bin_path + ".tmp", bin_path)
+            os.replace(idx_path + ".tmp", idx_path)
+        self.table = table
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+def save_vectorstore(vectorstore, index_path):
+    """Écrit l'index FAISS plat et le stockage des segments (sans pickle)."""
+    if isinstance(vectorstore.docstore, ChunkStoreWriter):
+        # Ingestion : seuls les segments et vecteurs ajoutés depuis le dernier appel sont écrits
+        vectorstore.docstore.save(vectorstore.index)
+        return
+
+    os.makedirs(index_path, exist_ok=True)
+
+    def records():
+        for position in range(vectorstore.index.ntotal):
+            chunk_id = vectorstore.index_to_docstore_id[position]
+            doc = vectorstore.docstore.search(chunk_id)
+            yield chunk_id, doc.page_content, doc.metadata
+
+    with _rewriting(index_path, "écriture complète"):
+        _write_index(vectorstore.index, os.path.join(index_path, "index.faiss"))
+        write_chunk_store(index_path, records())
+
+    # Ancien docstore picklé : remplacé par chunks.bin / chunks.idx
+    legacy_pickle = os.path.join(index_path, "index.pkl")
+    if os.path.exists(legacy_pickle):
+        os.remove(legacy_pickle)
+
+
+def new_vectorstore_for_update(index_path, embeddings, dim):
+    """Vectorstore vide (index plat L2, comme FAISS.from_embeddings) dont les segments vont dans index_path."""
+    return FAISS(embeddings, faiss.IndexFlatL2(dim), ChunkStoreWriter(index_path), {})
+
+
+def load_vectorstore_for_update(index_path, embeddings):
+    """Recharge l'index plat et un docstore modifiable adossé au stockage des segments (sans rien matérialiser)."""
+    if not has_chunk_store(index_path):
+        # Index produit avant chunks.bin : dernier chargement du pickle écrit par ce script, converti
+        save_vectorstore(FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True),
+                         index_path)
+
+    interrupted = interrupted_rewrite(index_path)
+    if interrupted is not None:
+        raise ValueError(f"❌ Index interrompu pendant une réécriture ({interrupted}) : relancer avec --full.")
+    index = faiss.read_index(os.path.join(index_path, "index.faiss"))
+    table = np.fromfile(os.path.join(index_path, CHUNKS_IDX), dtype=RECORD_DTYPE)
+    if len(table) < index.ntotal:
+        raise ValueError(f"❌ Index FAISS ({index.ntotal}) et chunks.idx ({len(table)}) désalignés : "
+                         f"relancer avec --full.")
+    # Entrées au-delà du dernier vecteur : arrêt pendant un point de reprise, segments ré-encodés
+    table = table[:index.ntotal].copy()
+    saved = read_chunk_ids(index_path, index.ntotal)
+    if saved is not None:
+        ids, ids_size = saved
+    else:
+        # Index antérieur à chunks.ids : identifiants relus une fois dans les segments,
+        # chunks.ids écrit au prochain point de reprise
+        store = ChunkStore(index_path, table=table)
+        ids, ids_size = [store.get(position)["id"] for position in range(index.ntotal)], None
+        store.close()
+    return FAISS(embeddings, index, ChunkStoreWriter(index_path, ids, table, ids_size), dict(enumerate(ids)))
@@ -0,0 +1,166 @@
+"""
+context_packing.py
+
+Assemblage du contexte envoyé au LLM à partir des segments récupérés.
+
+Les segments produits par `TokenChunker` se chevauchent de 50 tokens : collés
+tels quels, les mêmes phrases apparaissent deux ou trois fois dans le prompt. Ici :
+
+  1. les segments d'un même document dont les positions (start / end) se
+     chevauchent ou se touchent sont fusionnés en un seul passage ;
+  2. les phrases déjà présentes dans un passage mieux classé sont retirées
+     (cas des segments indexés sans positions, ou de documents republiés) ;
+  3. les passages, classés par pertinence (meilleur rang de leurs segments),
+     sont ajoutés jusqu'à épuisement d'un budget de tokens tiktoken, le
+     dernier étant tronqué si besoin ;
+  4. chaque passage garde sa référence [n] source (p. page).
+"""
+import re
+from functools import lru_cache
+
+import tiktoken
+
+# Écart maximal (caractères) entre deux segments pour les considérer contigus
+ADJACENT_GAP = 5
+# Les phrases plus courtes ne sont pas dédupliquées (titres, puces...)
+MIN_DEDUP_SENTENCE = 25
+# En dessous de ce reliquat de budget, on ne tronque pas un passage supplémentaire
+MIN_TRUNCATED_TOKENS = 40
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name="cl100k_base"):
+    return tiktoken.get_encoding(encoding_name)
+
+
+def clean_passage(text):
+    """Nettoyage léger hérité de chatbot() : puces et lignes vides."""
+    return text.replace("•", "").replace("\uf0d8", "").replace("\n\n", "\n").strip()
+
+
+def _merge_key(doc):
+    # start / end sont relatifs au document (part) : deux segments contigus d'un PDF
+    # peuvent être sur deux pages différentes
+    metadata = doc.metadata
+    return metadata.get("source"), metadata.get("part")
+
+
+def merge_overlapping(docs):
+    """
+    Regroupe les segments contigus d'un même document.
+
+    Retourne une liste de passages {text, rank, source, page, chunk_ids}, où rank
+    est le meilleur rang (0 = plus pertinent) des segments fusionnés.
+    """
+    passages = []
+    spans = {}  # clé document → liste de (start, end, rank, doc)
+    for rank, doc in enumerate(docs):
+        if "start" in doc.metadata and "end" in doc.metadata:
+            spans.setdefault(_merge_key(doc), []).append((doc.metadata["start"], doc.metadata["end"], rank, doc))
+        else:
+            passages.append(_passage(doc.page_content, rank, doc, [doc]))
+
+    for members in spans.values():
+        members.sort(key=lambda item: item[0])
+        group = [members[0]]
+        text, end = members[0][3].page_content, members[0][1]
+        for start, member_end, rank, doc in members[1:]:
+            if start <= end + ADJACENT_GAP:
+                if member_end > end:
+                    # On n'ajoute que la partie du segment au-delà de la fin courante
+                    text += (" " if start > end else "") + doc.page_content[max(0, end - start):]
+                    end = member_end
+                group.append((start, member_end, rank, doc))
+            else:
+                passages.append(_group_passage(text, group))
+                group, text, end = [(start, member_end, rank, doc)], doc.page_content, member_end
+        passages.append(_group_passage(text, group))
+
+    passages.sort(key=lambda passage: passage["rank"])
+    return passages
+
+
+def _passage(text, rank, doc, members):
+    return {
+        "text": text,
+        "rank": rank,
+        "source": doc.metadata.get("source", "Source inconnue"),
+        "page": doc.metadata.get("page", "N/A"),
+        "chunk_ids": [member.metadata.get("chunk_id") for member in members],
+        # Autres documents contenant le même texte (quasi-doublons fusionnés à l'ingestion)
+        "duplicate_sources": [d for member in members for d in member.metadata.get("duplicate_sources", [])],
+    }
+
+
+def _group_passage(text, group):
+    best = min(group, key=lambda item: item[2])
+    return _passage(text, best[2], best[3], [item[3] for item in group])
+
+
+def _normalize_sentence(sentence):
+    return re.sub(r"\W+", " ", sentence.lower()).strip()
+
+
+def drop_repeated_sentences(passages):
+    """Retire des passages les phrases déjà vues dans un passage mieux classé."""
+    seen = set()
+    kept = []
+    for passage in passages:
+        sentences = []
+        for sentence in SENTENCE_SPLIT.split(passage["text"]):
+            key = _normalize_sentence(sentence)
+            if len(key) >= MIN_DEDUP_SENTENCE:
+                if key in seen:
+                    continue
+                seen.add(key)
+            sentences.append(sentence)
+        text = " ".join(s for s in sentences if s.strip())
+        if text.strip():
+            kept.append({**passage, "text": text})
+    return kept
+
+
+def pack_context(docs, token_budget=3000, encoding_name="cl100k_base"):
+    """
+    Construit le bloc « Extraits des documents » du prompt.
+
+    `docs` est la liste des segments par pertinence décroissante. Retourne
+    (texte du contexte, passages retenus, nombre de tokens du contexte).
+    """
+    encoding = get_encoding(encoding_name)
+    passages = drop_repeated_sentences(merge_overlapping(docs))
+
+    lines, used, total = [], [], 0
+    for passage in passages:
+        reference = f"[{len(used) + 1}] {passage['source']}"
+        if passage["page"] not in (None, "N/A"):
+            reference += f" (p. {passage['page']})"
+        line = f"{reference}: {clean_passage(passage['text'])}"
+        tokens = encoding.encode(line, disallowed_special=())
+        remaining = token_budget - total
+        if len(tokens) > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                break
+            tokens = tokens[:remaining]
+            line = encoding.decode(tokens) + "…"
+        lines.append(line)
+        used.append(passage)
+        total += len(tokens)
+        if total >= token_budget:
+            break
+
+    return "\n".join(lines), used, total
+
+
+def build_prompt(question, retrieved_text):
+    """Prompt envoyé à Ollama (app.py, api.py, bench_pipeline.py)."""
+    return (
+        f"Tu es un expert en urbanisme et tu as la connaissance de tous les documents.\n"
+        f"Réponds précisément à la question posée en t'appuyant uniquement sur les extraits ci-dessous.\n"
+        f"N'oublie pas d'ajouter des références aux documents d'où proviennent les informations.\n"
+        f"\nExtraits des documents :\n{retrieved_text}\n\n"
+        f"Question : {question}\n"
+        f"Réponse détaillée avec sources :"
+    )
@@ -0,0 +1,42 @@
+"""
+embedding_backends.py
+
+Backends d'embedding interchangeables pour BAAI/bge-large-en.
+
+* "torch"     : HuggingFaceEmbeddings (sentence-transformers, PyTorch fp32), la référence ;
+* "onnx"      : graphe ONNX exporté (onnx_embeddings.py), exécuté par onnxruntime sur CPU ;
+* "onnx-int8" : même graphe, poids quantifiés en int8 (quantification dynamique).
+
+Le nom du backend entre dans l'identifiant des vecteurs (`embedding_id`) : le
+cache d'embeddings et le manifeste d'index_agam ne mélangent jamais des
+vecteurs de backends différents (changer de backend à l'ingestion reconstruit
+l'index). Côté requêtes, app.py peut encoder les questions avec un autre
+backend que celui de l'index : bench_embedding_backend.py mesure l'écart avec
+les vecteurs fp32 d'index_agam avant de basculer.
+"""
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+EMBEDDING_MODEL = "BAAI/bge-large-en"
+BACKENDS = ("torch", "onnx", "onnx-int8")
+DEFAULT_ONNX_DIR = "onnx_bge"
+
+
+def embedding_id(backend="torch", model_name=EMBEDDING_MODEL):
+    """Identifiant des vecteurs produits : le nom du modèle, suffixé du backend hors référence."""
+    return model_name if backend == "torch" else f"{model_name}|{backend}"
+
+
+def make_embeddings(backend="torch", model_name=EMBEDDING_MODEL, onnx_dir=DEFAULT_ONNX_DIR, batch_size=32,
+                    threads=None):
+    """Modèle d'embeddings LangChain (vecteurs normalisés) pour le backend demandé."""
+    if backend == "torch":
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            encode_kwargs={'normalize_embeddings': True, 'batch_size': batch_size}
+        )
+    if backend not in BACKENDS:
+        raise ValueError(f"❌ Backend d'embedding inconnu : {backend} (attendu : {', '.join(BACKENDS)})")
+
+    from onnx_embeddings import OnnxEmbeddings
+    return OnnxEmbeddings(onnx_dir, model_name=model_name, quantized=backend == "onnx-int8",
+                          batch_size=batch_size, threads=threads)
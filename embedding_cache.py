@@ -0,0 +1,193 @@
+"""
+embedding_cache.py
+
+Cache disque des embeddings, adressé par le contenu des segments.
+
+Clé : (nom du modèle, normalisation, SHA-256 du texte). Un répertoire par couple
+(modèle, normalisation) contient :
+  * vectors.f32  : matrice float32 (capacité × dimension), mappée en mémoire
+  * keys.bin     : empreinte (16 octets) de la clé stockée dans chaque ligne
+  * last_used.i8 : compteur d'accès par ligne (0 = ligne libre), pour l'éviction LRU
+  * meta.json    : dimension et capacité courantes
+
+`script_rag2.py` l'utilise en lecture/écriture avant d'appeler
+HuggingFaceEmbeddings ; `app.py` l'ouvre en lecture seule. Comme chaque ligne
+porte l'empreinte de sa clé, un lecteur ne renvoie jamais un vecteur qui aurait
+été remplacé entre-temps par l'écrivain.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_CACHE_DIR = "embedding_cache"
+KEY_BYTES = 16
+INITIAL_CAPACITY = 1024
+# Part des lignes libérées d'un coup quand le cache est plein
+EVICTION_FRACTION = 0.01
+
+
+class EmbeddingCache:
+    """Matrice d'embeddings mappée en mémoire + index des clés, avec éviction par taille."""
+
+    def __init__(self, model_name, normalize=True, cache_dir=DEFAULT_CACHE_DIR,
+                 max_mb=2048, read_only=False):
+        self.namespace = f"{model_name}|normalize={bool(normalize)}"
+        subdir = hashlib.sha1(self.namespace.encode("utf-8")).hexdigest()[:12]
+        self.path = os.path.join(cache_dir, subdir)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.read_only = read_only
+
+        self.hits = self.misses = self.evictions = 0
+        self.dim = None
+        self.capacity = 0
+        self._slots = {}  # empreinte → ligne
+        self._free = []   # lignes libres
+        self._clock = 0
+        self._vectors = self._keys = self._last_used = None
+
+        if os.path.exists(os.path.join(self.path, "meta.json")):
+            self._open()
+
+    # --- Fichiers -------------------------------------------------------
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _open(self):
+        with open(self._file("meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dim, self.capacity = meta["dim"], meta["capacity"]
+        mode = "r" if self.read_only else "r+"
+        self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode=mode,
+                                  shape=(self.capacity, self.dim))
+        self._keys = np.memmap(self._file("keys.bin"), dtype=np.uint8, mode=mode,
+                               shape=(self.capacity, KEY_BYTES))
+        self._last_used = np.memmap(self._file("last_used.i8"), dtype=np.int64, mode=mode,
+                                    shape=(self.capacity,))
+
+        used = np.flatnonzero(self._last_used)
+        self._slots = {self._keys[slot].tobytes(): int(slot) for slot in used}
+        self._free = np.flatnonzero(self._last_used == 0)[::-1].tolist()
+        self._clock = int(self._last_used.max()) if self.capacity else 0
+
+    def _resize(self, capacity):
+        """Crée ou agrandit les fichiers jusqu'à `capacity` lignes."""
+        os.makedirs(self.path, exist_ok=True)
+        for name, row_bytes in (("vectors.f32", self.dim * 4), ("keys.bin", KEY_BYTES), ("last_used.i8", 8)):
+            with open(self._file(name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self._write_meta(capacity)
+        self._open()
+
+    def _write_meta(self, capacity):
+        tmp_path = self._file("meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"namespace": self.namespace, "dim": self.dim, "capacity": capacity}, f)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    @property
+    def max_entries(self):
+        return max(1, self.max_bytes // (self.dim * 4 + KEY_BYTES + 8))
+
+    # --- Accès ----------------------------------------------------------
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).digest()[:KEY_BYTES]
+
+    def get_many(self, texts):
+        """Retourne, pour chaque texte, son vecteur (np.ndarray) ou None s'il est absent."""
+        results = []
+        for text in texts:
+            digest = self.key(text)
+            slot = self._slots.get(digest)
+            if slot is None or self._keys[slot].tobytes() != digest:
+                self.misses += 1
+                results.append(None)
+                continue
+            self.hits += 1
+            if not self.read_only:
+                self._clock += 1
+                self._last_used[slot] = self._clock
+            results.append(np.array(self._vectors[slot]))
+        return results
+
+    def put_many(self, texts, vectors):
+        """Ajoute des vecteurs au cache, en évinçant les moins récemment utilisés si besoin."""
+        if self.read_only or not texts:
+            return
+        if self.dim is None:
+            self.dim = len(vectors[0])
+            self._resize(min(INITIAL_CAPACITY, self.max_entries))
+
+        for text, vector in zip(texts, vectors):
+            digest = self.key(text)
+            slot = self._slots.get(digest)
+            if slot is None:
+                slot = self._free_slot()
+                self._slots[digest] = slot
+                self._keys[slot] = np.frombuffer(digest, dtype=np.uint8)
+            self._vectors[slot] = np.asarray(vector, dtype=np.float32)
+            self._clock += 1
+            self._last_used[slot] = self._clock
+
+    def _free_slot(self):
+        if not self._free and self.capacity < self.max_entries:
+            self._resize(min(self.capacity * 2, self.max_entries))
+        if not self._free:
+            self._evict(max(1, int(self.capacity * EVICTION_FRACTION)))
+        return self._free.pop()
+
+    def _evict(self, count):
+        """Libère les `count` lignes les moins récemment utilisées."""
+        oldest = np.argpartition(self._last_used, count - 1)[:count]
+        for slot in oldest.tolist():
+            del self._slots[self._keys[slot].tobytes()]
+            self._last_used[slot] = 0
+            self._free.append(slot)
+        self.evictions += len(oldest)
+
+    def flush(self):
+        if self.read_only or self._vectors is None:
+            return
+        for array in (self._vectors, self._keys, self._last_used):
+            array.flush()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._slots),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Enveloppe un modèle d'embeddings LangChain : les segments déjà encodés sont lus dans le cache."""
+
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        cached = self.cache.get_many(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if missing:
+            # Un même texte peut apparaître plusieurs fois dans le lot : on ne l'encode qu'une fois
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            computed = dict(zip(unique_texts, self.embeddings.embed_documents(unique_texts)))
+            self.cache.put_many(unique_texts, [computed[text] for text in unique_texts])
+            for i in missing:
+                cached[i] = computed[texts[i]]
+        return [list(map(float, vector)) for vector in cached]
+
+    def embed_query(self, text):
+        vector = self.cache.get_many([text])[0]
+        if vector is None:
+            return self.embeddings.embed_query(text)
+        return list(map(float, vector))
@@ -0,0 +1,209 @@
+"""
+faiss_index_factory.py
+
+Types d'index FAISS approchés pour index_agam.
+
+L'index plat (`index.faiss`, recherche exacte) reste la référence : c'est lui que
+`script_rag2.py` met à jour de façon incrémentale. À la fin de chaque run, s'il
+est configuré, un index approché est construit à partir de ses vecteurs
+(entraînement sur un échantillon) et écrit à côté, avec les mêmes positions,
+donc le même docstore. Si des segments ont seulement été ajoutés en fin d'index
+depuis, leurs vecteurs sont ajoutés à l'index approché existant, sans
+ré-entraînement, tant que le corpus n'a pas doublé depuis l'entraînement ;
+après des suppressions ou modifications, il est reconstruit :
+
+    index_agam/index.faiss            index plat (référence)
+    index_agam/index_<type>.faiss     index approché servi par app.py
+    index_agam/index_config.json      type construit, spec FAISS, réglages, nombre de vecteurs, empreinte des segments
+
+Types disponibles :
+    flat      recherche exacte (4 Ko par vecteur bge-large)
+    ivf-flat  partitionnement IVF, vecteurs complets        (knob : nprobe)
+    ivf-pq    partitionnement IVF + quantification produit  (knob : nprobe)
+    hnsw      graphe HNSW, vecteurs complets                (knob : efSearch)
+    sq8       quantification scalaire 8 bits, recherche exhaustive
+
+Avec `script_rag2.py --shards N`, le type choisi s'applique à chacun des shards
+(sharded_index.py) et l'index unique servi reste plat.
+"""
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+
+from chunk_store import ChunkStore, open_lazy_vectorstore
+
+INDEX_TYPES = ("flat", "ivf-flat", "ivf-pq", "hnsw", "sq8")
+INDEX_CONFIG_NAME = "index_config.json"
+
+
+def default_nlist(n_vectors):
+    """Nombre de listes IVF : ~4·√n, en gardant au moins 39 points d'entraînement par liste."""
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def factory_spec(index_type, n_vectors, dim, nlist=None, pq_m=64, hnsw_m=32):
+    """Chaîne `faiss.index_factory` correspondant au type demandé."""
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m}"
+    nlist = nlist or default_nlist(n_vectors)
+    if index_type == "ivf-flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf-pq":
+        if dim % pq_m:
+            raise ValueError(f"❌ pq_m={pq_m} doit diviser la dimension {dim}.")
+        return f"IVF{nlist},PQ{pq_m}"
+    raise ValueError(f"❌ Type d'index inconnu : {index_type} (attendu : {', '.join(INDEX_TYPES)})")
+
+
+def flat_vectors(index):
+    """Tous les vecteurs d'un index plat, dans l'ordre des positions."""
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(vectors, spec, train_size=50000, seed=0, ids=None):
+    """
+    Construit l'index `spec` (métrique L2, comme l'index plat de LangChain) sur `vectors`.
+
+    Avec `ids`, l'index renvoie ces identifiants (IndexIDMap) au lieu des positions.
+    """
+    dim = vectors.shape[1]
+    index = faiss.index_factory(dim, spec, faiss.METRIC_L2)
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample_size = min(train_size, len(vectors))
+        sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+    if ids is None:
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+        return index
+    index = faiss.IndexIDMap(index)
+    index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Applique les réglages de recherche pertinents pour le type d'index."""
+    params = faiss.ParameterSpace()
+    if nprobe is not None and _is_ivf(index):
+        params.set_index_parameter(index, "nprobe", int(nprobe))
+    if ef_search is not None and isinstance(index, faiss.IndexHNSW):
+        params.set_index_parameter(index, "efSearch", int(ef_search))
+
+
+def search_parameters(index, selector):
+    """
+    SearchParameters portant `selector`, avec les réglages nprobe / efSearch de l'index.
+
+    Un objet par recherche : IndexIDMap modifie temporairement le sélecteur des paramètres.
+    """
+    if _is_ivf(index):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def _is_ivf(index):
+    try:
+        faiss.extract_index_ivf(index)
+        return True
+    except RuntimeError:
+        return False
+
+
+def write_approximate_index(index_path, flat_index, index_type, nlist=None, pq_m=64,
+                            hnsw_m=32, train_size=50000):
+    """Met à jour l'index approché depuis l'index plat (ajout en fin ou reconstruction) et index_config.json."""
+    config_path = os.path.join(index_path, INDEX_CONFIG_NAME)
+    store = ChunkStore(index_path)
+    previous = read_index_config(index_path)
+    options = build_options(nlist, pq_m, hnsw_m, train_size)
+    if index_type == "flat" or flat_index.ntotal == 0:
+        config = {"type": "flat", "spec": "Flat", "file": "index.faiss", "ntotal": flat_index.ntotal}
+    else:
+        file_name = f"index_{index_type}.faiss"
+        trained = previous.get("trained", 0)
+        saved = previous.get("ntotal", 0)
+        # Segments seulement ajoutés en fin d'index depuis la dernière écriture, mêmes réglages
+        appendable = previous["type"] == index_type and previous.get("options") == options \
+            and os.path.exists(os.path.join(index_path, file_name)) \
+            and 0 < saved <= flat_index.ntotal <= 2 * trained \
+            and previous.get("chunk_store") == store.snapshot(saved)
+        if appendable:
+            spec = previous["spec"]
+            index = faiss.read_index(os.path.join(index_path, file_name))
+            index.add(np.ascontiguousarray(flat_index.reconstruct_n(saved, flat_index.ntotal - saved),
+                                           dtype=np.float32))
+        else:
+            spec = factory_spec(index_type, flat_index.ntotal, flat_index.d, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+            index = build_index(flat_vectors(flat_index), spec, train_size=train_size)
+            trained = index.ntotal
+        faiss.write_index(index, os.path.join(index_path, file_name + ".tmp"))
+        os.replace(os.path.join(index_path, file_name + ".tmp"), os.path.join(index_path, file_name))
+        config = {"type": index_type, "spec": spec, "file": file_name, "ntotal": index.ntotal, "trained": trained,
+                  "options": options}
+    config["chunk_store"] = store.snapshot()
+    store.close()
+
+    with open(config_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=1)
+    os.replace(config_path + ".tmp", config_path)
+    return config
+
+
+def build_options(nlist=None, pq_m=64, hnsw_m=32, train_size=50000):
+    """Réglages de construction enregistrés dans la configuration de l'index (changés : reconstruction)."""
+    return {"nlist": nlist, "pq_m": pq_m, "hnsw_m": hnsw_m, "train_size": train_size}
+
+
+def approximate_index_current(index_path, index_type, nlist=None, pq_m=64, hnsw_m=32, train_size=50000):
+    """L'index servi est-il de ce type, avec ces réglages, et construit sur les segments actuels d'index_agam ?"""
+    config = read_index_config(index_path)
+    if config["type"] != index_type:
+        return False
+    if index_type != "flat" and config.get("options") != build_options(nlist, pq_m, hnsw_m, train_size):
+        return False
+    store = ChunkStore(index_path)
+    current = config.get("chunk_store") == store.snapshot()
+    store.close()
+    return current
+
+
+def read_index_config(index_path):
+    config_path = os.path.join(index_path, INDEX_CONFIG_NAME)
+    if not os.path.exists(config_path):
+        return {"type": "flat", "spec": "Flat", "file": "index.faiss"}
+    with open(config_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_vectorstore(index_path, embeddings, nprobe=None, ef_search=None):
+    """
+    Charge le vectorstore LangChain avec l'index construit (plat ou approché).
+
+    Seul le fichier d'index servi est lu : l'index plat de référence n'est pas
+    chargé en mémoire quand un index approché existe. Les segments restent sur
+    disque (ChunkStore, mmap) et ne sont lus que pour les résultats de recherche.
+    """
+    store = ChunkStore(index_path)
+
+    config = read_index_config(index_path)
+    if config["type"] != "flat" and config.get("chunk_store") != store.snapshot():
+        # Index approché pas encore reconstruit après une mise à jour (positions décalées, même à
+        # nombre de segments égal) : repli sur l'index plat, toujours aligné sur chunks.idx
+        print(f"⚠️ Index {config['type']} périmé, repli sur l'index plat.")
+        config = {"type": "flat", "spec": "Flat", "file": "index.faiss"}
+
+    index = faiss.read_index(os.path.join(index_path, config["file"]))
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+
+    print(f"📊 Index FAISS servi : {config['type']} ({config['spec']}), {index.ntotal} vecteurs")
+    return open_lazy_vectorstore(index, store, embeddings)
@@ -1,45 +1,80 @@
 """
 gemma_image_describe.py
 
-Analyse une image et génère une description en français avec Gemma‑3‑4B‑PT.
-
-Usage (dans le conteneur) :
-    python gemma_image_describe.py \
-        --prompt "Décris l'image."
-
-Prérequis :
-  * Variable d'environnement HF_TOKEN (jeton Hugging Face avec licence Gemma).
-  * GPU CUDA compatible (≥ 12 GB VRAM recommandé, ex. RTX 4070 Ti).
+Analyse des images et génère une description en français avec Gemma‑3‑4B‑PT.
+
+Le modèle est chargé une seule fois, puis les images sont décrites par lots.
+Les descriptions sont ajoutées à un fichier JSONL indexé par l'empreinte
+SHA-256 du contenu de l'image : une image déjà décrite avec le même prompt et
+le même modèle n'est pas recalculée (même si elle a été renommée ou copiée).
+
+Usage (dans le conteneur) :
+    python gemma_image_describe.py                       # /app/images/test.jpg
+    python gemma_image_describe.py images/ autre.png \
+        --prompt "Décris l'image." --batch-size 8 --output image_descriptions.jsonl
+    python gemma_image_describe.py --list a_decrire.txt --device cpu --dtype float32
+
+Prérequis :
+  * Variable d'environnement HF_TOKEN (jeton Hugging Face avec licence Gemma).
+  * GPU CUDA compatible (≥ 12 GB VRAM recommandé, ex. RTX 4070 Ti) ; sinon
+    `--device cpu` (beaucoup plus lent, float32 ou bfloat16).
 """
+import argparse
+import hashlib
+import io
+import json
 import os
+import threading
+import time
 from pathlib import Path
 
 import torch
 from PIL import Image
 from transformers import pipeline
 
-# ID du modèle Hugging Face
+# ID du modèle Hugging Face
 MODEL_ID = "google/gemma-3-4b-pt"
 
-# Chemin codé en dur de l'image à analyser
+# Image décrite quand aucun chemin n'est donné
 IMAGE_PATH = Path("/app/images/test.jpg")
 
 # Prompt par défaut
 DEFAULT_PROMPT = "Décris l'image en détail."
 
+# Fichier des descriptions (une ligne JSON par image / prompt / modèle)
+DEFAULT_OUTPUT = "image_descriptions.jsonl"
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff"}
+
+DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+
+
+def resolve_device(device="auto"):
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
 
-def load_gemma_pipe():
-    """Initialise le pipeline Gemma 3 pour vision + texte."""
-    return pipeline(
+
+def load_gemma_pipe(model_id=MODEL_ID, device="auto", dtype="auto"):
+    """Initialise le pipeline Gemma 3 pour vision + texte (GPU ou CPU)."""
+    device = resolve_device(device)
+    if dtype == "auto":
+        dtype = "bfloat16" if device == "cuda" else "float32"
+    pipe = pipeline(
         task="image-text-to-text",
-        model=MODEL_ID,
-        device=0 if torch.cuda.is_available() else -1,
-        torch_dtype=torch.bfloat16 if torch.cuda.is_available() else None,
+        model=model_id,
+        device=0 if device == "cuda" else -1,
+        torch_dtype=DTYPES[dtype],
     )
+    # Génération par lots : le padding doit être à gauche
+    tokenizer = getattr(getattr(pipe, "processor", None), "tokenizer", None) or pipe.tokenizer
+    if tokenizer is not None:
+        tokenizer.padding_side = "left"
+    return pipe
 
 
 def build_messages(img: Image.Image, prompt: str):
-    """Construit un message au format chat pour Gemma 3."""
+    """Construit un message au format chat pour Gemma 3."""
     return [
         {
             "role": "user",
@@ -51,26 +86,145 @@ def build_messages(img: Image.Image, prompt: str):
     ]
 
 
-def main():
-    # On utilise le chemin codé en dur
-    img_path = IMAGE_PATH
-    if not img_path.exists():
-        raise FileNotFoundError(f"Image introuvable : {img_path}")
-
-    # Lecture de l'image
-    img = Image.open(img_path).convert("RGB")
+def image_sha256(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _generated_text(output):
+    # Entrée en liste : une liste de sorties par conversation
+    if isinstance(output, list):
+        output = output[0]
+    generated = output.get("generated_text", [])
+    if isinstance(generated, str):
+        return generated
+    return generated[-1]["content"] if generated else ""
+
+
+def describe_images(pipe, images, prompt=DEFAULT_PROMPT, batch_size=4, max_new_tokens=120):
+    """Descriptions des images PIL `images`, générées par lots de `batch_size`."""
+    descriptions = []
+    for start in range(0, len(images), batch_size):
+        conversations = [build_messages(img, prompt) for img in images[start:start + batch_size]]
+        outputs = pipe(text=conversations, max_new_tokens=max_new_tokens, batch_size=len(conversations))
+        descriptions.extend(_generated_text(output).strip() for output in outputs)
+    return descriptions
+
+
+class DescriptionCache:
+    """Descriptions déjà produites, indexées par (empreinte de l'image, modèle, prompt), dans un JSONL."""
+
+    def __init__(self, path=DEFAULT_OUTPUT):
+        self.path = path
+        self._records = {}
+        self._lock = threading.Lock()  # ajouts depuis plusieurs workers (pdf_images.py)
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records[self.key(record["image_sha256"], record["model"], record["prompt"])] = record
+
+    @staticmethod
+    def key(sha256, model, prompt):
+        return sha256, model, prompt
+
+    def get(self, sha256, model, prompt):
+        return self._records.get(self.key(sha256, model, prompt))
+
+    def add_many(self, records):
+        """Ajoute les enregistrements au fichier (écriture immédiate : un arrêt ne perd que le lot en cours)."""
+        with self._lock:
+            for record in records:
+                self._records[self.key(record["image_sha256"], record["model"], record["prompt"])] = record
+            if self.path and records:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def collect_images(inputs, list_file=None):
+    """Chemins des images : fichiers donnés, contenu des dossiers (récursif) et lignes de `list_file`."""
+    candidates = [Path(p) for p in inputs]
+    if list_file:
+        with open(list_file, "r", encoding="utf-8") as f:
+            candidates.extend(Path(line.strip()) for line in f if line.strip())
+
+    paths = []
+    for candidate in candidates:
+        if candidate.is_dir():
+            paths.extend(sorted(p for p in candidate.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS))
+        elif candidate.exists():
+            paths.append(candidate)
+        else:
+            print(f"⚠️ Image introuvable : {candidate}")
+    return paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Décrit des images avec Gemma 3 (modèle chargé une fois, par lots).")
+    parser.add_argument("inputs", nargs="*", default=[str(IMAGE_PATH)], help="Images ou dossiers d'images.")
+    parser.add_argument("--list", default=None, help="Fichier texte : un chemin d'image par ligne.")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--model", default=MODEL_ID)
+    parser.add_argument("--batch-size", type=int, default=4, help="Images par appel au pipeline.")
+    parser.add_argument("--max-new-tokens", type=int, default=120)
+    parser.add_argument("--device", choices=["auto", "cuda", "cpu"], default="auto")
+    parser.add_argument("--dtype", choices=["auto", *DTYPES], default="auto",
+                        help="auto : bfloat16 sur GPU, float32 sur CPU.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Fichier JSONL des descriptions.")
+    parser.add_argument("--force", action="store_true", help="Redécrit aussi les images déjà en cache.")
+    return parser.parse_args()
 
-    # Chargement du pipeline et génération du message
-    pipe = load_gemma_pipe()
-    messages = build_messages(img, DEFAULT_PROMPT)
 
-    # Génère la description
-    output = pipe(text=messages, max_new_tokens=120)
-    generated = output[0].get("generated_text", [])
-    description = generated[-1]["content"] if generated else ""
-    print(description)
+def main():
+    args = parse_args()
+    paths = collect_images(args.inputs, args.list)
+    if not paths:
+        raise FileNotFoundError("Aucune image à décrire.")
+
+    # Images à décrire : une seule fois par contenu, hors cache
+    cache = DescriptionCache(args.output)
+    pending = {}  # empreinte → chemin (les octets sont relus lot par lot : mémoire bornée)
+    skipped = 0
+    for path in paths:
+        sha256 = image_sha256(path.read_bytes())
+        cached = None if args.force else cache.get(sha256, args.model, args.prompt)
+        if cached is not None or sha256 in pending:
+            skipped += 1
+            continue
+        pending[sha256] = path
+    print(f"🖼 {len(paths)} image(s) : {len(pending)} à décrire, {skipped} déjà décrite(s)")
+    if not pending:
+        return
+
+    # Chargement du pipeline, une seule fois pour toutes les images
+    start = time.perf_counter()
+    pipe = load_gemma_pipe(args.model, device=args.device, dtype=args.dtype)
+    print(f"✅ Modèle {args.model} chargé en {time.perf_counter() - start:.1f} s ({resolve_device(args.device)})")
+
+    items = list(pending.items())
+    described = 0
+    start = time.perf_counter()
+    for offset in range(0, len(items), args.batch_size):
+        batch = items[offset:offset + args.batch_size]
+        images = [Image.open(io.BytesIO(path.read_bytes())).convert("RGB") for _, path in batch]
+        batch_start = time.perf_counter()
+        descriptions = describe_images(pipe, images, args.prompt, batch_size=len(images),
+                                       max_new_tokens=args.max_new_tokens)
+        seconds = (time.perf_counter() - batch_start) / len(images)
+        cache.add_many([
+            {"image_sha256": sha256, "path": str(path), "model": args.model, "prompt": args.prompt,
+             "description": description, "seconds": round(seconds, 3)}
+            for (sha256, path), description in zip(batch, descriptions)
+        ])
+        described += len(batch)
+        for (_, path), description in zip(batch, descriptions):
+            print(f"📄 {path} : {description}")
+
+    elapsed = time.perf_counter() - start
+    print(f"📊 {described} image(s) décrite(s) en {elapsed:.1f} s — {described / elapsed:.2f} images/s")
+    print(f"✅ Descriptions enregistrées dans '{args.output}'.")
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,145 @@
+"""
+index_manifest.py
+
+Manifeste persistant de l'index FAISS `index_agam/`.
+
+Pour chaque fichier de `data/`, on mémorise sa taille, sa date de modification,
+son empreinte SHA-256 et la liste des identifiants de chunks qu'il a produits.
+`script_rag2.py` s'en sert pour ne recharger / redécouper / ré-encoder que les
+fichiers nouveaux ou modifiés, et pour supprimer de l'index les vecteurs des
+fichiers disparus. `duplicate_of` liste les segments d'autres fichiers avec
+lesquels des segments quasi identiques de ce fichier ont été fusionnés
+(near_duplicates.py) : si l'un d'eux disparaît, le fichier est ré-ingéré.
+`images` mémorise le réglage de description des images des PDF (pdf_images.py) :
+s'il change, les PDF sont ré-ingérés.
+
+Format (index_agam/manifest.json) :
+    {
+      "version": 2,
+      "embedding_model": "BAAI/bge-large-en",
+      "images": {"model": "google/gemma-3-4b-pt", "prompt": "..."},  (ou null)
+      "files": {
+        "data/rapport.pdf": {"size": 123, "mtime": 1713.0, "sha256": "...",
+                             "chunk_ids": ["...-00000", "...-00001"],
+                             "duplicate_of": ["...-00042"]}
+      }
+    }
+"""
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = "manifest.json"
+# v2 : découpage token_chunker (un index au manifeste v1 est reconstruit entièrement)
+MANIFEST_VERSION = 2
+
+
+def empty_manifest(embedding_model):
+    """Retourne un manifeste vide pour le modèle d'embedding donné."""
+    return {"version": MANIFEST_VERSION, "embedding_model": embedding_model, "files": {}}
+
+
+def load_manifest(index_path, embedding_model):
+    """Charge le manifeste de l'index, ou un manifeste vide s'il est absent / incompatible."""
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return empty_manifest(embedding_model)
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("embedding_model") != embedding_model:
+        return empty_manifest(embedding_model)
+    return manifest
+
+
+def manifest_embedding_model(index_path):
+    """Modèle d'embedding (et backend) enregistré dans le manifeste, ou None s'il n'y en a pas."""
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("embedding_model")
+
+
+def manifest_version(index_path):
+    """Version du format enregistrée dans le manifeste, ou None s'il n'y en a pas."""
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("version")
+
+
+def save_manifest(index_path, manifest):
+    """Écrit le manifeste de façon atomique (fichier temporaire puis renommage)."""
+    os.makedirs(index_path, exist_ok=True)
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_sha256(path, block_size=1 << 20):
+    """Calcule l'empreinte SHA-256 du contenu d'un fichier, par blocs."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_files(data_dir):
+    """Liste triée des fichiers de `data_dir` (ordre stable → identifiants stables)."""
+    paths = []
+    for root, _, files in os.walk(data_dir):
+        for file in files:
+            paths.append(os.path.join(root, file))
+    return sorted(paths)
+
+
+def chunk_id_prefix(path, sha256):
+    """Préfixe commun aux identifiants de chunks d'une version donnée d'un fichier."""
+    return hashlib.sha1(f"{path}|{sha256}".encode("utf-8")).hexdigest()[:16]
+
+
+def chunk_ids_for(path, sha256, count):
+    """Identifiants déterministes des `count` chunks produits par un fichier."""
+    prefix = chunk_id_prefix(path, sha256)
+    return [f"{prefix}-{i:05d}" for i in range(count)]
+
+
+def diff_manifest(manifest, paths):
+    """
+    Compare l'état du disque au manifeste.
+
+    Retourne (modifies, inchanges, supprimes) :
+      * modifies  : liste de dicts {path, size, mtime, sha256} à (ré)indexer
+      * inchanges : chemins dont le contenu n'a pas changé
+      * supprimes : chemins présents dans le manifeste mais plus sur le disque
+    La taille et le mtime servent de filtre rapide ; le hash n'est recalculé
+    que lorsqu'ils diffèrent.
+    """
+    known = manifest["files"]
+    modifies, inchanges = [], []
+
+    for path in paths:
+        stat = os.stat(path)
+        entry = known.get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            inchanges.append(path)
+            continue
+
+        sha256 = file_sha256(path)
+        if entry and entry["sha256"] == sha256:
+            # Fichier simplement "touché" : on rafraîchit les métadonnées, sans ré-encoder
+            entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+            inchanges.append(path)
+            continue
+
+        modifies.append({"path": path, "size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256})
+
+    present = set(paths)
+    supprimes = [path for path in known if path not in present]
+    return modifies, inchanges, supprimes
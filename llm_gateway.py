@@ -0,0 +1,207 @@
+"""
+llm_gateway.py
+
+Accès partagé à Ollama pour app.py et api.py : générations mutualisées,
+connexions persistantes, délestage.
+
+* Mutualisation (« single flight ») : deux requêtes identiques — même question
+  normalisée, mêmes segments retenus, donc même prompt — pendant qu'une
+  génération est en cours ne lancent pas une seconde génération deepseek-r1 :
+  la seconde s'abonne au flux de la première (elle reçoit les fragments déjà
+  produits, puis la suite au fil de l'eau).
+* Connexions : un client HTTP (httpx) avec un pool de connexions keep-alive
+  vers Ollama, au lieu d'une nouvelle connexion par appel.
+* Plafond et délestage : au plus `max_concurrent` générations à la fois ; les
+  suivantes attendent dans une file de `max_queue` places au plus. Au-delà, une
+  nouvelle génération est refusée (`Overloaded`) plutôt que d'allonger
+  l'attente de tout le monde ; s'abonner à une génération en cours reste
+  toujours possible (aucune charge en plus).
+
+Chaque génération tourne dans son propre thread et continue si le client qui
+l'a lancée se déconnecte : `on_complete` (mise en cache de la réponse) est
+appelé à la fin, avant que la génération ne quitte la table des vols en cours.
+"""
+import asyncio
+import json
+import threading
+
+import httpx
+
+
+class Overloaded(Exception):
+    """File des générations pleine : la requête est refusée (503 côté api.py)."""
+
+
+class Flight:
+    """Une génération en cours, partagée par toutes les requêtes de même clé."""
+
+    def __init__(self, key):
+        self.key = key
+        self.fragments = []
+        self.done = False
+        self.error = None
+        self.subscribers = 1
+        self._cond = threading.Condition()
+        self._listeners = []  # réveil des abonnés asyncio (appelé depuis le thread de génération)
+
+    def _publish(self, fragment=None, done=False, error=None):
+        with self._cond:
+            if fragment:
+                self.fragments.append(fragment)
+            self.done = self.done or done
+            self.error = self.error or error
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def _read(self, start):
+        with self._cond:
+            return self.fragments[start:], self.done, self.error
+
+    def iter_fragments(self):
+        """Fragments de la réponse depuis le début, jusqu'à la fin de la génération (threads)."""
+        position = 0
+        while True:
+            with self._cond:
+                while position == len(self.fragments) and not self.done:
+                    self._cond.wait()
+            fragments, done, error = self._read(position)
+            position += len(fragments)
+            yield from fragments
+            if done and position == len(self.fragments):
+                if error is not None:
+                    raise error
+                return
+
+    async def aiter_fragments(self):
+        """Même flux pour une coroutine, sans bloquer la boucle asyncio."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # boucle fermée : abonné parti
+
+        with self._cond:
+            self._listeners.append(wake)
+        try:
+            position = 0
+            while True:
+                event.clear()
+                fragments, done, error = self._read(position)
+                position += len(fragments)
+                for fragment in fragments:
+                    yield fragment
+                if done and position == len(self.fragments):
+                    if error is not None:
+                        raise error
+                    return
+                if not fragments:
+                    await event.wait()
+        finally:
+            with self._cond:
+                self._listeners.remove(wake)
+
+
+class OllamaGateway:
+    """Générations /api/generate d'Ollama mutualisées par clé, plafonnées et délestées."""
+
+    def __init__(self, base_url, model, max_concurrent=4, max_queue=32, timeout=60.0, options=None):
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.options = options or {}
+        # Connexions keep-alive réutilisées : une par génération simultanée au plus
+        self.client = httpx.Client(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=max_concurrent, max_keepalive_connections=max_concurrent),
+        )
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.active = self.queued = 0
+        self.started = self.coalesced = self.shed = self.failed = 0
+
+    def join(self, key, prompt, on_complete=None):
+        """
+        Génération de clé `key` : celle en cours, sinon une nouvelle pour `prompt`.
+
+        Lève Overloaded si la file d'attente est pleine. `on_complete(réponse)`
+        n'est appelé que par la génération lancée ici.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                self.coalesced += 1
+                return flight
+            if self.active + self.queued >= self.max_concurrent + self.max_queue:
+                self.shed += 1
+                raise Overloaded(f"{self.active} génération(s) en cours, {self.queued} en attente")
+            flight = Flight(key)
+            self._flights[key] = flight
+            self.queued += 1
+            self.started += 1
+        threading.Thread(target=self._run, args=(flight, prompt, on_complete), name="ollama-flight",
+                         daemon=True).start()
+        return flight
+
+    def stream(self, key, prompt, on_complete=None):
+        return self.join(key, prompt, on_complete).iter_fragments()
+
+    def generate(self, key, prompt, on_complete=None):
+        return "".join(self.stream(key, prompt, on_complete))
+
+    def _run(self, flight, prompt, on_complete):
+        error = None
+        with self._slots:
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                for fragment in self._generate(prompt):
+                    flight._publish(fragment)
+            except Exception as e:
+                error = e
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.failed += error is not None
+        if error is None and on_complete is not None:
+            try:
+                on_complete("".join(flight.fragments))
+            except Exception as e:
+                print(f"⚠️ Réponse générée mais non mise en cache : {e}")
+        # Fin publiée avant le retrait : une requête qui arrive entre-temps relit la réponse complète
+        flight._publish(done=True, error=error)
+        with self._lock:
+            del self._flights[flight.key]
+
+    def _generate(self, prompt):
+        """Fragments de la réponse d'Ollama (flux NDJSON de /api/generate)."""
+        payload = {"model": self.model, "prompt": prompt, "stream": True}
+        if self.options:
+            payload["options"] = self.options
+        with self.client.stream("POST", "/api/generate", json=payload) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(f"Ollama : {chunk['error']}")
+                # Flux lu jusqu'au bout, même après "done" : la connexion retourne au pool
+                if chunk.get("response"):
+                    yield chunk["response"]
+
+    def stats(self):
+        with self._lock:
+            return {"active": self.active, "queued": self.queued, "started": self.started,
+                    "coalesced": self.coalesced, "shed": self.shed, "failed": self.failed}
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,87 @@
+"""
+llm_streaming.py
+
+Outils pour diffuser la réponse de deepseek-r1 au fil des tokens.
+
+deepseek-r1 commence par un long raisonnement entre <think> et </think>.
+`ThinkFilter` le retire d'un flux de fragments de texte, même quand les
+balises sont coupées entre deux fragments, pour n'afficher que la réponse.
+Le début du flux n'est retenu que le temps de voir s'il commence par <think> :
+dès que ses premiers caractères (hors espaces) en diffèrent, il est diffusé.
+Certains modèles omettent la balise ouvrante : dans la réponse complète
+(`strip_think`), tout ce qui précède un premier </think> est alors traité
+comme du raisonnement.
+"""
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def strip_think(text):
+    """Retire les sections <think>…</think> d'une réponse complète (et ce qui précède un </think> isolé)."""
+    opening, closing = text.find(THINK_OPEN), text.find(THINK_CLOSE)
+    if closing != -1 and (opening == -1 or closing < opening):
+        # </think> sans <think> : ce qui précède est du raisonnement
+        text = text[closing + len(THINK_CLOSE):]
+    think_filter = ThinkFilter()
+    return think_filter.feed(text) + think_filter.flush()
+
+
+class ThinkFilter:
+    """Filtre incrémental : `feed(fragment)` retourne le texte visible nouvellement disponible."""
+
+    def __init__(self):
+        self.in_think = False
+        self.started = False  # début du flux vu : commence par <think> ou non
+        self._pending = ""  # fin de fragment qui pourrait être le début d'une balise
+
+    def feed(self, fragment):
+        text = self._pending + fragment
+        self._pending = ""
+        if not self.started:
+            head = text.lstrip()
+            if len(head) < len(THINK_OPEN) and THINK_OPEN.startswith(head):
+                # Encore trop court pour savoir si le flux commence par <think>
+                self._pending = text
+                return ""
+            self.started = True
+        visible = []
+        while text:
+            tag = THINK_CLOSE if self.in_think else THINK_OPEN
+            index = text.find(tag)
+            if index != -1:
+                if not self.in_think:
+                    visible.append(text[:index])
+                self.in_think = not self.in_think
+                text = text[index + len(tag):]
+                continue
+
+            # Garder de côté un éventuel début de balise coupé en fin de fragment
+            keep = 0
+            for size in range(min(len(tag) - 1, len(text)), 0, -1):
+                if tag.startswith(text[-size:]):
+                    keep = size
+                    break
+            if not self.in_think:
+                visible.append(text[:len(text) - keep])
+            self._pending = text[len(text) - keep:] if keep else ""
+            break
+        return "".join(visible)
+
+    def flush(self):
+        """Texte retenu en fin de flux (début de balise qui n'en était pas une)."""
+        pending, self._pending = self._pending, ""
+        return "" if self.in_think else pending
+
+
+def format_sources(passages):
+    """Liste des sources affichée dès la fin de la recherche."""
+    lines = []
+    for number, passage in enumerate(passages, start=1):
+        reference = f"[{number}] {passage['source']}"
+        if passage.get("page") not in (None, "N/A"):
+            reference += f" (p. {passage['page']})"
+        lines.append(reference)
+        also = sorted({d["source"] for d in passage.get("duplicate_sources", [])} - {passage["source"]})
+        if also:
+            lines.append(f"    ↳ aussi dans : {', '.join(also)}")
+    return "📚 Sources :\n" + "\n".join(lines)
@@ -0,0 +1,280 @@
+"""
+metadata_index.py
+
+Filtres de métadonnées appliqués pendant la recherche FAISS, et non après.
+
+`script_rag2.py` enregistre pour chaque segment : source, directory (dossier
+relatif à data/), extension, page et ingested_at (date d'ingestion). Après
+chaque écriture de l'index, on construit pour chaque valeur de ces champs
+l'ensemble des positions FAISS qui la portent :
+
+  * bitmap compacte (1 bit par segment) pour les valeurs fréquentes ;
+  * liste triée de positions (uint32) pour les valeurs rares (une source, une page),
+    plus petite que la bitmap tant que la valeur couvre moins d'1/32 des segments.
+
+Un filtre {champ: valeur ou [valeurs]} (OU entre les valeurs d'un champ, ET
+entre les champs) devient une bitmap par opérations bit à bit, puis un sélecteur
+FAISS passé à la recherche : les segments exclus ne sont jamais comparés, sans
+sur-échantillonnage ni filtrage en Python. Un dossier filtre aussi ses
+sous-dossiers ; `year` est l'année d'ingestion. Un segment qui porte des
+quasi-doublons rattachés (`duplicate_sources`, near_duplicates.py) répond aussi
+aux filtres sur leur source, leur dossier et leur extension.
+
+    index_agam/metadata_index.json   champs, valeurs, forme (bitmap / liste), décalage
+    index_agam/metadata_index.bin    bitmaps et listes concaténées (lu par mmap)
+    index_agam/metadata_chunks.u64   offsets dans chunks.bin des segments indexés
+
+Après une ingestion incrémentale, seules les métadonnées des segments nouveaux
+ou modifiés sont relues ; les positions des autres sont renumérotées
+(update_metadata_index).
+"""
+import json
+import os
+
+import faiss
+import numpy as np
+
+METADATA_JSON = "metadata_index.json"
+METADATA_BIN = "metadata_index.bin"
+METADATA_OFFSETS = "metadata_chunks.u64"
+FILTER_FIELDS = ("source", "directory", "extension", "page", "year", "ingested_at")
+# Champs dont les valeurs incluent celles des quasi-doublons rattachés (plusieurs valeurs par segment)
+DUPLICATE_FIELDS = ("source", "directory", "extension")
+
+
+def file_metadata(source, data_dir, ingested_at):
+    """Métadonnées structurées d'un fichier, ajoutées à chacun de ses segments."""
+    directory = os.path.dirname(os.path.relpath(source, data_dir)).replace(os.sep, "/")
+    return {"directory": directory or ".", "extension": os.path.splitext(source)[1].lower(),
+            "ingested_at": ingested_at}
+
+
+def normalize_value(field, value):
+    value = str(value).strip()
+    if field == "extension":
+        value = value.lower()
+        return value if value.startswith(".") else "." + value
+    if field == "directory":
+        return value.strip("/") or "."
+    return value
+
+
+def _own_values(metadata, field):
+    if field == "directory":
+        directory = metadata.get("directory")
+        if directory is None:
+            return []
+        parts = directory.split("/")
+        return ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    if field == "year":
+        ingested_at = metadata.get("ingested_at")
+        return [ingested_at[:4]] if ingested_at else []
+    value = metadata.get(field)
+    return [] if value is None else [normalize_value(field, value)]
+
+
+def field_values(metadata, field):
+    """
+    Valeurs d'un segment pour `field` (un dossier vaut aussi pour ses dossiers parents).
+
+    Pour source, directory et extension, les valeurs des quasi-doublons rattachés
+    suivent celles du segment lui-même.
+    """
+    values = _own_values(metadata, field)
+    if field in DUPLICATE_FIELDS:
+        for duplicate in metadata.get("duplicate_sources", []):
+            # Rattachements plus anciens (source et page seules) : extension déduite de la source
+            duplicate = {"extension": os.path.splitext(duplicate["source"])[1], **duplicate}
+            values.extend(value for value in _own_values(duplicate, field) if value not in values)
+    return values
+
+
+def parse_filters(text):
+    """« directory=PLUi; extension=.pdf,.docx; year=2024 » → {champ: [valeurs]} ; {} si vide."""
+    filters = {}
+    for clause in text.replace("\n", ";").split(";"):
+        if not clause.strip():
+            continue
+        field, sep, values = clause.partition("=")
+        if not sep:
+            raise ValueError(f"❌ Filtre invalide : « {clause.strip()} » (attendu champ=valeur).")
+        filters[field.strip()] = [value for value in values.split(",") if value.strip()]
+    return filters
+
+
+def _add_postings(postings, position, metadata):
+    for field in FILTER_FIELDS:
+        for value in field_values(metadata, field):
+            postings[field].setdefault(value, []).append(position)
+
+
+def _write_metadata_index(index_path, postings, n_docs, store=None):
+    n_bytes = (n_docs + 7) // 8
+    fields, offset = {}, 0
+    with open(os.path.join(index_path, METADATA_BIN) + ".tmp", "wb") as f:
+        for field, values in postings.items():
+            fields[field] = {}
+            for value, positions in sorted(values.items()):
+                positions = np.asarray(positions, dtype=np.uint32)
+                if len(positions) * 4 > n_bytes:
+                    bits = np.zeros(n_docs, dtype=bool)
+                    bits[positions] = True
+                    data, kind = np.packbits(bits, bitorder="little").tobytes(), "bitmap"
+                else:
+                    data, kind = positions.tobytes(), "list"
+                f.write(data)
+                fields[field][value] = [kind, offset, len(data), len(positions)]
+                offset += len(data)
+    meta = {"n_docs": n_docs, "fields": fields}
+    if store is not None:
+        # Empreinte et offsets du ChunkStore indexé : point de départ de la prochaine mise à jour
+        meta["chunk_store"] = store.snapshot()
+        np.asarray(store.table["offset"], dtype=np.uint64).tofile(
+            os.path.join(index_path, METADATA_OFFSETS) + ".tmp")
+        os.replace(os.path.join(index_path, METADATA_OFFSETS) + ".tmp", os.path.join(index_path, METADATA_OFFSETS))
+    with open(os.path.join(index_path, METADATA_JSON) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(os.path.join(index_path, METADATA_BIN) + ".tmp", os.path.join(index_path, METADATA_BIN))
+    os.replace(os.path.join(index_path, METADATA_JSON) + ".tmp", os.path.join(index_path, METADATA_JSON))
+    return n_docs, sum(len(values) for values in fields.values())
+
+
+def build_metadata_index(index_path, metadatas, store=None):
+    """
+    Écrit les bitmaps / listes de positions de chaque valeur, dans l'ordre des positions FAISS.
+
+    Avec `store` (le ChunkStore dont viennent les métadonnées), son empreinte est
+    enregistrée pour `update_metadata_index`.
+    """
+    postings = {field: {} for field in FILTER_FIELDS}
+    n_docs = 0
+    for position, metadata in enumerate(metadatas):
+        _add_postings(postings, position, metadata)
+        n_docs = position + 1
+    return _write_metadata_index(index_path, postings, n_docs, store=store)
+
+
+def update_metadata_index(index_path, store):
+    """
+    Met l'index des métadonnées à jour pour le ChunkStore `store`.
+
+    Seuls les segments nouveaux ou modifiés depuis la dernière écriture sont
+    relus ; les positions des autres sont renumérotées. Reconstruction complète
+    si l'index n'a pas d'empreinte ou si chunks.bin a été réécrit. Retourne
+    (segments, valeurs, segments relus), ou None si l'index est déjà à jour.
+    """
+    meta = None
+    if has_metadata_index(index_path):
+        with open(os.path.join(index_path, METADATA_JSON), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    if meta is not None and meta.get("chunk_store") == store.snapshot():
+        return None
+    offsets_path = os.path.join(index_path, METADATA_OFFSETS)
+    # Index écrit avec d'autres champs filtrables : les segments conservés n'auraient pas les bons
+    changes = store.changes_since(meta.get("chunk_store"), np.fromfile(offsets_path, dtype=np.uint64)) \
+        if meta is not None and os.path.exists(offsets_path) and list(meta["fields"]) == list(FILTER_FIELDS) \
+        else None
+    if changes is None:
+        n_docs, n_values = build_metadata_index(index_path, (record["metadata"] for record in store), store=store)
+        return n_docs, n_values, n_docs
+    remap, added = changes
+
+    # Positions conservées, renumérotées (l'ordre des segments restants ne change pas)
+    data = np.fromfile(os.path.join(index_path, METADATA_BIN), dtype=np.uint8)
+    postings = {field: {} for field in FILTER_FIELDS}
+    for field, values in meta["fields"].items():
+        for value, (kind, offset, length, _) in values.items():
+            chunk = data[offset:offset + length]
+            if kind == "bitmap":
+                positions = np.flatnonzero(np.unpackbits(chunk, count=meta["n_docs"], bitorder="little"))
+            else:
+                positions = chunk.view(np.uint32)
+            positions = remap[positions]
+            if (positions >= 0).any():
+                postings[field][value] = positions[positions >= 0]
+
+    # Segments nouveaux ou modifiés, fusionnés aux positions conservées (dans l'ordre)
+    added_postings = {field: {} for field in FILTER_FIELDS}
+    for position in added:
+        _add_postings(added_postings, int(position), store.get(int(position))["metadata"])
+    for field, values in added_postings.items():
+        for value, positions in values.items():
+            kept = postings[field].get(value, np.zeros(0, dtype=np.int64))
+            postings[field][value] = np.sort(np.concatenate([kept, positions]))
+    n_docs, n_values = _write_metadata_index(index_path, postings, len(store), store=store)
+    return n_docs, n_values, len(added)
+
+
+def has_metadata_index(index_path):
+    return os.path.exists(os.path.join(index_path, METADATA_JSON))
+
+
+class Selection:
+    """Segments retenus par un filtre : bitmap (bit i = position i), convertie à la demande."""
+
+    def __init__(self, bitmap, n_docs, filters):
+        self.bitmap = bitmap
+        self.n_docs = n_docs
+        self.filters = filters
+        self.count = int(np.unpackbits(bitmap).sum())
+        self._positions = None
+
+    def mask(self):
+        return np.unpackbits(self.bitmap, count=self.n_docs, bitorder="little").astype(bool)
+
+    def positions(self):
+        if self._positions is None:
+            self._positions = np.flatnonzero(self.mask())
+        return self._positions
+
+    def selector(self):
+        """Sélecteur FAISS sur les positions (la bitmap doit rester en vie : elle est portée par self)."""
+        return faiss.IDSelectorBitmap(self.n_docs, faiss.swig_ptr(self.bitmap))
+
+
+class MetadataIndex:
+    """Accès en lecture seule aux bitmaps écrites par `build_metadata_index`."""
+
+    def __init__(self, index_path):
+        with open(os.path.join(index_path, METADATA_JSON), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.n_docs = meta["n_docs"]
+        self.fields = meta["fields"]
+        path = os.path.join(index_path, METADATA_BIN)
+        self._data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, np.uint8)
+
+    def values(self, field):
+        """{valeur: nombre de segments} d'un champ."""
+        return {value: entry[3] for value, entry in self.fields.get(field, {}).items()}
+
+    def _value_bitmap(self, field, value, out):
+        entry = self.fields[field].get(normalize_value(field, value))
+        if entry is None:
+            return
+        kind, offset, length, _ = entry
+        data = self._data[offset:offset + length]
+        if kind == "bitmap":
+            np.bitwise_or(out, data, out=out)
+        else:
+            positions = data.view(np.uint32)
+            np.bitwise_or.at(out, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+
+    def select(self, filters):
+        """Selection des segments satisfaisant `filters`, ou None si aucun filtre."""
+        filters = {field: values if isinstance(values, (list, tuple)) else [values]
+                   for field, values in (filters or {}).items() if values not in (None, "", [])}
+        if not filters:
+            return None
+        unknown = set(filters) - set(FILTER_FIELDS)
+        if unknown:
+            raise ValueError(f"❌ Champ(s) de filtre inconnu(s) : {', '.join(sorted(unknown))} "
+                             f"(attendu : {', '.join(FILTER_FIELDS)}).")
+
+        n_bytes = (self.n_docs + 7) // 8
+        result = None
+        for field, values in filters.items():
+            field_bitmap = np.zeros(n_bytes, dtype=np.uint8)
+            for value in values:
+                self._value_bitmap(field, value, field_bitmap)
+            result = field_bitmap if result is None else np.bitwise_and(result, field_bitmap, out=result)
+        return Selection(result, self.n_docs, filters)
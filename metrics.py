@@ -0,0 +1,298 @@
+"""
+metrics.py
+
+Instrumentation du pipeline RAG : compteurs et histogrammes au format texte
+Prometheus, et traces échantillonnées des requêtes.
+
+* `Trace.span(stage)` chronomètre une étape (embedding, recherche FAISS,
+  assemblage du contexte, premier token, génération...) et l'ajoute à
+  l'histogramme `rag_query_stage_seconds{stage=...}` ; si la requête est
+  échantillonnée (TRACE_SAMPLE_RATE), l'étape est aussi gardée dans sa trace.
+* Les traces terminées sont conservées en mémoire (les N dernières) et, si
+  TRACE_FILE est défini, ajoutées en JSON Lines à ce fichier.
+* `render()` produit la page /metrics ; les collecteurs enregistrés par
+  `add_collector` y ajoutent des valeurs lues au moment de l'exposition
+  (taux de succès des caches...).
+
+`script_rag2.py` alimente les mêmes types de compteurs pour l'ingestion
+(`rag_ingest_stage_seconds`, `rag_ingest_items_total`).
+
+Aucune dépendance : le format d'exposition est écrit à la main.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bornes (secondes) : de la recherche FAISS (ms) à la génération complète (dizaines de s)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}  # labels → [compte par borne, somme, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        """labels → (nombre d'observations, somme)."""
+        with self._lock:
+            return {key: (entry[2], entry[1]) for key, entry in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(key + (("le", _format_value(float(bound))),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation):
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=SECONDS_BUCKETS):
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """`collect()` retourne des triplets (nom, type, {labels: valeur}) lus à chaque exposition."""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, values in collect():
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values.items():
+                    lines.append(f"{name}{_format_labels(tuple(sorted(labels)))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Chemin de requête (app.py, api.py) ---------------------------------------------
+
+QUERY_STAGE_SECONDS = REGISTRY.histogram("rag_query_stage_seconds", "Durée de chaque étape d'une requête RAG.")
+QUERY_SECONDS = REGISTRY.histogram("rag_query_seconds", "Durée totale d'une requête RAG.")
+QUERY_TOTAL = REGISTRY.counter("rag_queries_total", "Requêtes traitées, par point d'entrée et issue.")
+PROMPT_TOKENS = REGISTRY.histogram("rag_prompt_tokens", "Tokens (cl100k_base) du prompt envoyé au LLM.",
+                                   TOKEN_BUCKETS)
+ANSWER_TOKENS = REGISTRY.histogram("rag_answer_tokens", "Tokens (cl100k_base) de la réponse du LLM.",
+                                   TOKEN_BUCKETS)
+BATCH_SIZE = REGISTRY.histogram("rag_embed_batch_size", "Questions encodées par lot (micro-batching de l'API).",
+                                (1, 2, 4, 8, 16, 32, 64))
+
+# --- Ingestion (script_rag2.py) ------------------------------------------------
+
+INGEST_STAGE_SECONDS = REGISTRY.histogram("rag_ingest_stage_seconds", "Durée de chaque étape d'ingestion.")
+INGEST_ITEMS_TOTAL = REGISTRY.counter("rag_ingest_items_total", "Éléments traités par étape d'ingestion.")
+
+
+@contextmanager
+def timed(histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+# --- Traces ----------------------------------------------------------------------
+
+class Trace:
+    """Étapes d'une requête ; seules les requêtes échantillonnées gardent le détail."""
+
+    def __init__(self, tracer, name, sampled):
+        self.tracer = tracer
+        self.name = name
+        self.sampled = sampled
+        self.trace_id = uuid.uuid4().hex[:16] if sampled else None
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans = []
+        self.attributes = {}
+
+    def record(self, stage, seconds):
+        QUERY_STAGE_SECONDS.observe(seconds, stage=stage)
+        if self.sampled:
+            self.spans.append({"stage": stage, "start_ms": round((time.perf_counter() - self.start - seconds) * 1000, 3),
+                               "duration_ms": round(seconds * 1000, 3)})
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def annotate(self, **attributes):
+        if self.sampled:
+            self.attributes.update(attributes)
+
+    def finish(self, outcome="ok"):
+        elapsed = time.perf_counter() - self.start
+        QUERY_SECONDS.observe(elapsed, endpoint=self.name)
+        QUERY_TOTAL.inc(endpoint=self.name, outcome=outcome)
+        if self.sampled and self.tracer is not None:
+            self.tracer.collect({
+                "trace_id": self.trace_id, "name": self.name, "outcome": outcome,
+                "timestamp": self.wall_start, "duration_ms": round(elapsed * 1000, 3),
+                "spans": self.spans, "attributes": self.attributes,
+            })
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, max_traces=200, trace_file=None):
+        self.sample_rate = sample_rate
+        self.trace_file = trace_file
+        self._recent = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        return Trace(self, name, sampled=self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def collect(self, trace):
+        with self._lock:
+            self._recent.append(trace)
+            if self.trace_file:
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+    def recent(self):
+        with self._lock:
+            return list(self._recent)
+
+
+def tracer_from_env():
+    return Tracer(sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0")),
+                  max_traces=int(os.getenv("TRACE_BUFFER", "200")),
+                  trace_file=os.getenv("TRACE_FILE") or None)
+
+
+# Étapes mesurées hors requête (lot du micro-batcher...) : histogrammes seulement
+NO_TRACE = Trace(None, "untraced", sampled=False)
+
+
+# --- Exposition ----------------------------------------------------------------
+
+def start_http_server(port, tracer=None, host="0.0.0.0", registry=REGISTRY):
+    """Sert /metrics (et /traces si un tracer est fourni) dans un thread, pour l'interface Gradio."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith("/metrics"):
+                body, content_type = registry.render().encode("utf-8"), CONTENT_TYPE
+            elif self.path.startswith("/traces") and tracer is not None:
+                body, content_type = json.dumps(tracer.recent(), ensure_ascii=False).encode("utf-8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_metrics_file(path, registry=REGISTRY):
+    """Écrit l'exposition texte (collecteur « textfile » de node_exporter)."""
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(path + ".tmp", path)
+
+
+def stage_summary(histogram):
+    """Lignes lisibles « étape : total, nombre, moyenne » d'un histogramme à label stage."""
+    lines = []
+    for key, (count, total) in sorted(histogram.snapshot().items(), key=lambda item: -item[1][1]):
+        stage = dict(key).get("stage", "?")
+        lines.append(f"   {stage:<14} {total:9.2f} s  ({count} × {total / count * 1000:.1f} ms)")
+    return lines
@@ -0,0 +1,88 @@
+"""
+micro_batcher.py
+
+Regroupement des requêtes concurrentes en lots, pour l'API asynchrone (api.py).
+
+Chaque requête HTTP encodait sa question seule : sous charge, le CPU enchaîne
+des passes bge-large-en de taille 1. `MicroBatcher` collecte les éléments
+soumis pendant quelques millisecondes (ou jusqu'à `max_batch_size`) et les
+traite en un seul appel à `process_batch`, exécuté dans un thread pour ne pas
+bloquer la boucle asyncio. Pendant qu'un lot est traité, les suivants
+s'accumulent : la taille des lots augmente avec la charge.
+"""
+import asyncio
+
+
+class MicroBatcher:
+    """`await submit(item)` retourne le résultat de `process_batch([... item ...])` pour cet élément."""
+
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=5.0, executor=None):
+        self.process_batch = process_batch  # liste d'éléments → liste de résultats, même ordre
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self._queue = None
+        self._worker = None
+
+        self.batches = self.items = 0
+        self.max_seen = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            # File et tâche créées dans la boucle du serveur, au premier appel
+            self._queue = self._queue or asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        """Attend un premier élément, puis ceux qui arrivent pendant `max_wait`."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Requêtes abandonnées (client déconnecté) pendant l'attente : inutile de les calculer
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            self.max_seen = max(self.max_seen, len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch,
+                                                     [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_seen,
+        }
@@ -0,0 +1,169 @@
+"""
+near_duplicates.py
+
+Détection des segments quasi identiques avant l'encodage (MinHash + LSH).
+
+Les rapports de l'AGAM sont souvent republiés en plusieurs versions : le même
+texte serait encodé, stocké et renvoyé plusieurs fois. Pour chaque segment, on
+calcule une signature MinHash sur ses n-grammes de mots ; la signature est
+découpée en bandes (LSH) pour ne comparer un segment qu'aux candidats qui
+partagent au moins une bande. Un candidat dont la similarité de Jaccard estimée
+dépasse le seuil est considéré comme le même segment : `script_rag2.py` ne
+l'encode pas et ajoute sa source aux métadonnées du segment déjà indexé.
+
+Les signatures des segments indexés sont conservées dans index_agam/minhash.npz
+pour les passages incrémentaux ; les bandes sont reconstruites au chargement.
+"""
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+SIGNATURES_NAME = "minhash.npz"
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+WORD = re.compile(r"\w+")
+
+
+def optimal_bands(threshold, num_perm, false_positive_weight=0.1, steps=200):
+    """
+    (bandes, lignes par bande) minimisant faux positifs + faux négatifs autour du seuil.
+
+    Probabilité qu'un couple de similarité s soit candidat : 1 - (1 - s^r)^b.
+    Les faux positifs pèsent peu : chaque candidat est vérifié sur la signature entière.
+    """
+    def area(r, b, start, end, positive):
+        s = np.linspace(start, end, steps)
+        probability = 1 - (1 - s ** r) ** b
+        values = probability if positive else 1 - probability
+        return float(values.mean() * (end - start))
+
+    best, best_error = (1, num_perm), None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        error = (false_positive_weight * area(rows, bands, 0.0, threshold, True)
+                 + (1 - false_positive_weight) * area(rows, bands, threshold, 1.0, False))
+        if best_error is None or error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class MinHasher:
+    """Signatures MinHash (num_perm entiers 32 bits) sur les n-grammes de mots d'un texte."""
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        # a·x + b mod p avec a, x < 2^32 : pas de dépassement en uint64
+        self.a = rng.randint(1, int(MAX_HASH), size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, int(MAX_HASH), size=num_perm, dtype=np.uint64)
+
+    def shingle_hashes(self, text):
+        words = WORD.findall(text.lower())
+        size = min(self.shingle_size, len(words))
+        if not size:
+            return np.zeros(0, dtype=np.uint64)
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        return np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64,
+                           count=len(shingles))
+
+    def signature(self, text):
+        """Signature du texte, ou None s'il ne contient aucun mot."""
+        hashes = self.shingle_hashes(text)
+        if not len(hashes):
+            return None
+        permuted = np.bitwise_and((np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME, MAX_HASH)
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """Index LSH des segments déjà retenus : chaque nouveau segment est soit ajouté, soit rattaché à un existant."""
+
+    def __init__(self, threshold=0.9, num_perm=128, shingle_size=5, seed=1):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size, seed=seed)
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        self.ids, self.signatures = [], []
+        self._buckets = [{} for _ in range(self.bands)]
+        self._lock = threading.Lock()  # ajouts (thread du pipeline) / sauvegarde (point de reprise)
+        self.matches = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _band_keys(self, signature):
+        return [hash(signature[i * self.rows:(i + 1) * self.rows].tobytes()) for i in range(self.bands)]
+
+    def _insert(self, chunk_id, signature):
+        row = len(self.ids)
+        self.ids.append(chunk_id)
+        self.signatures.append(signature)
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(row)
+
+    def _best_match(self, signature):
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        best, best_score = None, self.threshold
+        for row in candidates:
+            score = float(np.mean(self.signatures[row] == signature))
+            if score >= best_score:
+                best, best_score = self.ids[row], score
+        return best
+
+    def add_or_match(self, chunk_id, text):
+        """Retourne l'identifiant du segment quasi identique déjà retenu, ou None (segment ajouté)."""
+        signature = self.hasher.signature(text)
+        with self._lock:
+            if signature is not None:
+                match = self._best_match(signature)
+                if match is not None:
+                    self.matches += 1
+                    return match
+                self._insert(chunk_id, signature)
+            return None
+
+    # --- Persistance ------------------------------------------------------
+
+    def save(self, index_path):
+        with self._lock:
+            live = list(zip(self.ids, self.signatures))
+        ids = np.array([chunk_id for chunk_id, _ in live], dtype=str)
+        matrix = (np.stack([signature for _, signature in live]) if live
+                  else np.zeros((0, self.hasher.num_perm), dtype=np.uint32))
+        path = os.path.join(index_path, SIGNATURES_NAME)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, ids=ids, signatures=matrix,
+                     params=np.array([self.hasher.num_perm, self.hasher.shingle_size, self.hasher.seed]))
+        os.replace(path + ".tmp", path)
+
+    def restore(self, index_path, chunk_ids, get_text):
+        """
+        Recharge les signatures des segments `chunk_ids` présents dans l'index.
+
+        Les signatures absentes du fichier (index antérieur, paramètres modifiés)
+        sont recalculées à partir du texte renvoyé par `get_text(chunk_id)`.
+        """
+        saved = {}
+        path = os.path.join(index_path, SIGNATURES_NAME)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                params = [self.hasher.num_perm, self.hasher.shingle_size, self.hasher.seed]
+                if data["params"].tolist() == params:
+                    saved = dict(zip(data["ids"].tolist(), data["signatures"]))
+
+        computed = 0
+        for chunk_id in chunk_ids:
+            signature = saved.get(chunk_id)
+            if signature is None:
+                signature = self.hasher.signature(get_text(chunk_id))
+                computed += 1
+            if signature is not None:
+                self._insert(chunk_id, signature)
+        return computed
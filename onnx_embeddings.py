@@ -0,0 +1,129 @@
+"""
+onnx_embeddings.py
+
+bge-large-en sur CPU avec onnxruntime, en fp32 ou quantifié int8.
+
+Encodage : tous les textes d'un appel sont tokenisés une fois, triés par
+longueur, puis regroupés en lots dont le remplissage (padding) s'arrête au plus
+long texte du lot — un segment de 40 tokens ne paie pas pour 512. Le vecteur
+est celui du token [CLS], normalisé, comme la configuration sentence-transformers
+de bge ; les vecteurs sont rendus dans l'ordre d'origine.
+
+Export (une fois, sur une machine avec torch) :
+    python onnx_embeddings.py                  # onnx_bge/model.onnx + model_int8.onnx
+    python onnx_embeddings.py --output onnx_bge --no-quantize
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import onnxruntime as ort
+from langchain_core.embeddings import Embeddings
+from transformers import AutoTokenizer
+
+from embedding_backends import EMBEDDING_MODEL, DEFAULT_ONNX_DIR
+
+MODEL_FILE = "model.onnx"
+INT8_MODEL_FILE = "model_int8.onnx"
+CONFIG_FILE = "export.json"
+
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, model_name=EMBEDDING_MODEL, quantized=True, batch_size=32,
+                 max_length=512, threads=None):
+        with open(os.path.join(model_dir, CONFIG_FILE), "r", encoding="utf-8") as f:
+            exported = json.load(f)["model_name"]
+        if exported != model_name:
+            raise ValueError(f"❌ {model_dir} contient un export de {exported}, pas de {model_name}.")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        model_file = os.path.join(model_dir, INT8_MODEL_FILE if quantized else MODEL_FILE)
+        self.session = ort.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def _encode_batch(self, input_ids):
+        padded = self.tokenizer.pad({"input_ids": input_ids}, padding="longest", return_tensors="np")
+        inputs = {"input_ids": padded["input_ids"].astype(np.int64),
+                  "attention_mask": padded["attention_mask"].astype(np.int64)}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(inputs["input_ids"])
+        hidden = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+        cls = hidden[:, 0, :]
+        return cls / np.linalg.norm(cls, axis=1, keepdims=True)
+
+    def embed_array(self, texts):
+        """Matrice float32 (len(texts) × dim) des vecteurs normalisés, dans l'ordre de `texts`."""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        input_ids = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)["input_ids"]
+        order = np.argsort([len(ids) for ids in input_ids], kind="stable")
+        vectors = None
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            batch = self._encode_batch([input_ids[i] for i in rows])
+            if vectors is None:
+                vectors = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            vectors[rows] = batch
+        return vectors
+
+    def embed_documents(self, texts):
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text):
+        return self.embed_array([text])[0].tolist()
+
+
+def export_onnx(model_name=EMBEDDING_MODEL, output_dir=DEFAULT_ONNX_DIR, quantize=True, opset=17):
+    """Exporte le modèle Hugging Face en ONNX (axes batch / séquence dynamiques), puis en int8."""
+    import torch
+    from transformers import AutoModel
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(output_dir)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(["Le plan local d'urbanisme intercommunal."], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    model_path = os.path.join(output_dir, MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in input_names), model_path,
+                          input_names=input_names, output_names=["last_hidden_state"],
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+    print(f"✅ Graphe ONNX fp32 : {model_path} ({os.path.getsize(model_path) / 1024 / 1024:.0f} Mo)")
+
+    if quantize:
+        int8_path = os.path.join(output_dir, INT8_MODEL_FILE)
+        quantize_dynamic(model_path, int8_path, weight_type=QuantType.QInt8)
+        print(f"✅ Graphe ONNX int8 : {int8_path} ({os.path.getsize(int8_path) / 1024 / 1024:.0f} Mo)")
+
+    with open(os.path.join(output_dir, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "opset": opset, "quantized": quantize}, f, indent=1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Exporte bge-large-en en ONNX (fp32 + int8) pour l'encodage sur CPU.")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--output", default=DEFAULT_ONNX_DIR)
+    parser.add_argument("--no-quantize", action="store_true", help="N'écrit que le graphe fp32.")
+    parser.add_argument("--opset", type=int, default=17)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    export_onnx(args.model, args.output, quantize=not args.no_quantize, opset=args.opset)
+    print(f"➡️ Vérifier la parité : python bench_embedding_backend.py --backend onnx-int8 --onnx-dir {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+parallel_loading.py
+
+Chargement des fichiers de `data/` en parallèle sur plusieurs processus.
+
+* Un fichier = une tâche ; les gros PDF sont découpés en tranches de pages.
+* Chaque tâche a un délai maximal : une alarme (SIGALRM) l'interrompt dans le
+  processus fils, et si le fils ne rend pas la main du tout (code C bloqué),
+  le pool est tué puis recréé pour les tâches encore en cours.
+* Un fichier en erreur ou hors délai est signalé et ignoré, sans arrêter le run.
+* Les résultats sont rendus dans l'ordre des chemins fournis, quel que soit
+  l'ordre de fin des tâches : les identifiants de chunks restent stables.
+* Le nombre de tâches en vol est borné : la mémoire ne dépend pas de la taille
+  du corpus et les résultats peuvent être consommés au fil de l'eau.
+"""
+import multiprocessing as mp
+import os
+import signal
+from collections import deque
+
+from token_chunker import pages_to_document
+
+# Marge laissée au processus fils pour lever son propre TimeoutError
+HARD_TIMEOUT_GRACE = 10
+
+
+class FileTimeout(Exception):
+    """Levée dans le processus fils quand une tâche dépasse son délai."""
+
+
+def _on_alarm(signum, frame):
+    raise FileTimeout()
+
+
+def _run_task(fn, args, timeout):
+    """Exécute `fn(*args)` dans le fils avec un délai maximal ; ne lève jamais."""
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.alarm(int(timeout))
+    try:
+        return "ok", fn(*args)
+    except FileTimeout:
+        return "error", f"délai de {timeout}s dépassé"
+    except Exception as e:
+        return "error", f"{type(e).__name__}: {e}"
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+def _iter_tasks(paths, pdf_page_count, pdf_pages_per_task):
+    """Découpe les fichiers en tâches (fichier entier ou tranche de pages PDF), à la demande."""
+    for file_index, path in enumerate(paths):
+        n_pages = 0
+        if pdf_pages_per_task and path.lower().endswith(".pdf"):
+            try:
+                n_pages = pdf_page_count(path)
+            except Exception:
+                n_pages = 0  # le chargement complet remontera l'erreur
+        if n_pages > pdf_pages_per_task:
+            for start in range(0, n_pages, pdf_pages_per_task):
+                yield file_index, path, "pages", (path, start, min(start + pdf_pages_per_task, n_pages))
+        else:
+            yield file_index, path, "file", (path,)
+
+
+def _iter_pool(tasks, funcs, workers, timeout, max_in_flight):
+    """Exécute les tâches sur un pool ; produit (tâche, (status, valeur)) dans l'ordre des tâches."""
+    hard_timeout = timeout + HARD_TIMEOUT_GRACE if timeout else None
+    tasks = iter(tasks)
+    in_flight = deque()
+    pool = mp.Pool(processes=workers)
+
+    def submit(task):
+        return pool.apply_async(_run_task, (funcs[task[2]], task[3], timeout))
+
+    try:
+        while True:
+            while len(in_flight) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                in_flight.append((task, submit(task)))
+            if not in_flight:
+                return
+
+            task, async_result = in_flight.popleft()
+            try:
+                result = async_result.get(hard_timeout)
+            except mp.TimeoutError:
+                result = ("error", f"processus bloqué au-delà de {hard_timeout}s, tué")
+                # Le pool est tué : on garde ce qui est déjà terminé, le reste repart
+                pool.terminate()
+                pool.join()
+                pool = mp.Pool(processes=workers)
+                in_flight = deque(
+                    (other, other_result if other_result.ready() else submit(other))
+                    for other, other_result in in_flight
+                )
+            yield task, result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _assemble(path, parts):
+    """Reconstitue les documents d'un fichier à partir de ses tâches terminées."""
+    if parts and parts[0][0] == "pages":
+        return pages_to_document(path, [page for _, pages in parts for page in pages])
+    return [doc for _, docs in parts for doc in docs]
+
+
+def iter_files_parallel(paths, load_file, load_pdf_pages, pdf_page_count,
+                        workers=None, timeout=300, pdf_pages_per_task=50, max_in_flight=None):
+    """
+    Charge `paths` avec `workers` processus et produit (path, documents) dans l'ordre.
+
+    `load_file(path)` retourne une liste de Document ; `load_pdf_pages(path, start, end)`
+    retourne les pages [start, end) nettoyées, en (numéro, texte) ; `pdf_page_count(path)` le nombre
+    de pages. documents vaut None pour un fichier en échec.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    tasks = _iter_tasks(paths, pdf_page_count, pdf_pages_per_task)
+    funcs = {"file": load_file, "pages": load_pdf_pages}
+
+    current_index, current_path, parts, failed = None, None, [], False
+    for (file_index, path, kind, args), (status, value) in _iter_pool(tasks, funcs, workers,
+                                                                     timeout, max_in_flight):
+        if file_index != current_index:
+            if current_index is not None:
+                yield current_path, None if failed else _assemble(current_path, parts)
+            current_index, current_path, parts, failed = file_index, path, [], False
+
+        if status != "ok":
+            print(f"❌ Erreur lors du chargement de {path} : {value}")
+            failed = True
+        else:
+            parts.append((kind, value))
+
+    if current_index is not None:
+        yield current_path, None if failed else _assemble(current_path, parts)
+
+
+def load_files_parallel(paths, load_file, load_pdf_pages, pdf_page_count,
+                        workers=None, timeout=300, pdf_pages_per_task=50):
+    """Variante non streamée d'`iter_files_parallel` : retourne la liste complète."""
+    return list(iter_files_parallel(paths, load_file, load_pdf_pages, pdf_page_count,
+                                    workers=workers, timeout=timeout,
+                                    pdf_pages_per_task=pdf_pages_per_task))
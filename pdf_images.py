@@ -0,0 +1,152 @@
+"""
+pdf_images.py
+
+Images intégrées aux PDF (cartes, graphiques, schémas) → segments indexables.
+
+`page.get_text("text")` ignore les images : les cartes et graphiques des
+documents d'urbanisme de l'AGAM n'étaient pas dans index_agam. Ici :
+
+  1. les images sont extraites avec PyMuPDF, une seule fois par xref (un logo
+     répété sur chaque page est un seul objet du PDF) puis par empreinte des
+     pixels (la même image enregistrée sous plusieurs xref) ;
+  2. les images trop petites (pictogrammes, puces, filets) sont écartées avant
+     même de décoder leurs pixels ;
+  3. les autres sont décrites par un pool de workers Gemma
+     (gemma_image_describe.py), par lots ; les descriptions sont mises en cache
+     par empreinte d'image (même JSONL que le script de description) : une
+     ré-ingestion ne décrit que les images jamais vues ;
+  4. chaque description devient un segment rattaché à sa page source.
+"""
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+from PIL import Image
+from langchain.docstore.document import Document
+
+from gemma_image_describe import DescriptionCache, describe_images, load_gemma_pipe, DEFAULT_OUTPUT, MODEL_ID
+
+# En dessous, l'image est un pictogramme ou un élément de mise en page
+MIN_IMAGE_SIDE = 100  # pixels
+MIN_IMAGE_AREA = 40000  # pixels²
+
+IMAGE_PROMPT = ("Décris cette image extraite d'un document d'urbanisme (carte, graphique, schéma, photo) : "
+                "type d'image, titre, légende, lieux, chiffres et tendances visibles.")
+
+
+def extract_pdf_images(pdf_path, min_side=MIN_IMAGE_SIDE, min_area=MIN_IMAGE_AREA):
+    """
+    Images distinctes d'un PDF, à la première page où elles apparaissent.
+
+    Retourne une liste de dicts {page, xref, sha256, width, height, png} ;
+    sha256 est l'empreinte des pixels (dimensions comprises).
+    """
+    images, seen_xrefs, seen_hashes = [], set(), set()
+    with fitz.open(pdf_path) as doc:
+        for page_index in range(doc.page_count):
+            for xref, _, width, height, *_ in doc.get_page_images(page_index):
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                if min(width, height) < min_side or width * height < min_area:
+                    continue
+                try:
+                    pix = fitz.Pixmap(doc, xref)
+                    if pix.colorspace is None:
+                        continue  # masque de transparence seul
+                    if pix.colorspace.n not in (1, 3):
+                        pix = fitz.Pixmap(fitz.csRGB, pix)  # CMJN...
+                    if pix.alpha:
+                        pix = fitz.Pixmap(pix, 0)
+                except Exception as e:
+                    print(f"⚠️ Image {xref} illisible dans {pdf_path} : {e}")
+                    continue
+                digest = hashlib.sha256(f"{pix.width}x{pix.height}x{pix.n}|".encode("ascii"))
+                digest.update(pix.samples)
+                sha256 = digest.hexdigest()
+                if sha256 in seen_hashes:
+                    continue
+                seen_hashes.add(sha256)
+                images.append({"page": page_index + 1, "xref": xref, "sha256": sha256,
+                               "width": pix.width, "height": pix.height, "png": pix.tobytes("png")})
+    return images
+
+
+class ImageDescriber:
+    """
+    Pool de workers Gemma avec cache des descriptions par empreinte d'image.
+
+    Chaque worker (thread) charge son propre pipeline à sa première image non
+    encore décrite : aucun modèle n'est chargé si tout est en cache. Sur un seul
+    GPU, garder workers=1 et augmenter batch_size ; sur CPU, plusieurs workers
+    occupent plusieurs cœurs (au prix d'un modèle en mémoire par worker).
+    """
+
+    def __init__(self, cache_path=DEFAULT_OUTPUT, model=MODEL_ID, prompt=IMAGE_PROMPT, workers=1, batch_size=4,
+                 max_new_tokens=160, device="auto", dtype="auto"):
+        self.cache = DescriptionCache(cache_path)
+        self.model = model
+        self.prompt = prompt
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.device = device
+        self.dtype = dtype
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemma")
+        self._lock = threading.Lock()
+        self.described = self.cached = 0
+
+    def _pipe(self):
+        pipe = getattr(self._local, "pipe", None)
+        if pipe is None:
+            pipe = self._local.pipe = load_gemma_pipe(self.model, device=self.device, dtype=self.dtype)
+        return pipe
+
+    def _describe_batch(self, source, batch):
+        images = [Image.open(io.BytesIO(image["png"])).convert("RGB") for image in batch]
+        descriptions = describe_images(self._pipe(), images, self.prompt, batch_size=len(images),
+                                       max_new_tokens=self.max_new_tokens)
+        records = [{"image_sha256": image["sha256"], "path": f"{source}#page={image['page']}",
+                    "model": self.model, "prompt": self.prompt, "description": description}
+                   for image, description in zip(batch, descriptions)]
+        self.cache.add_many(records)
+        return records
+
+    def describe(self, source, images):
+        """Descriptions des `images` (dans l'ordre) : cache d'abord, le reste par lots sur le pool."""
+        descriptions, missing = {}, []
+        for image in images:
+            record = self.cache.get(image["sha256"], self.model, self.prompt)
+            if record is not None:
+                descriptions[image["sha256"]] = record["description"]
+            else:
+                missing.append(image)
+
+        futures = [self._executor.submit(self._describe_batch, source, missing[i:i + self.batch_size])
+                   for i in range(0, len(missing), self.batch_size)]
+        for future in futures:
+            for record in future.result():
+                descriptions[record["image_sha256"]] = record["description"]
+
+        with self._lock:
+            self.described += len(missing)
+            self.cached += len(images) - len(missing)
+        return [descriptions[image["sha256"]] for image in images]
+
+    def stats(self):
+        return {"described": self.described, "cached": self.cached}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def image_documents(source, images, descriptions):
+    """Un segment par description, rattaché à la page où l'image apparaît."""
+    return [
+        Document(page_content=f"[Image, page {image['page']}] {description}",
+                 metadata={"source": source, "page": image["page"], "image_sha256": image["sha256"],
+                           "xref": image["xref"]})
+        for image, description in zip(images, descriptions) if description
+    ]
@@ -0,0 +1,325 @@
+"""
+qdrant_index.py
+
+Index servi par Qdrant (serveur, ou mode local de qdrant-client) à la place de FAISS.
+
+`script_rag2.py --vector-backend qdrant` garde index_agam comme référence
+(index plat, ChunkStore, BM25, bitmaps de métadonnées) et synchronise la
+collection à la fin de chaque run :
+
+  * chaque segment est un point dont l'identifiant est dérivé du chunk_id
+    (`stable_id`, comme les shards) : il ne bouge pas quand les positions
+    FAISS se décalent ;
+  * le payload porte le chunk_id, les champs filtrables de metadata_index.py
+    (source, page, dossier et dossiers parents, extension, année, date
+    d'ingestion, avec des index de payload ; source, dossier et extension
+    incluent ceux des quasi-doublons rattachés) et une empreinte (segment +
+    modèle d'embedding) : seuls les points nouveaux ou modifiés sont envoyés,
+    ceux des segments disparus sont supprimés ;
+  * les envois se font par lots, plusieurs en parallèle, avec reprise
+    (backoff exponentiel) en cas d'erreur réseau ou de surcharge du serveur.
+
+    index_agam/qdrant.json             collection, empreinte des segments synchronisés
+                                       (l'URL n'y est qu'à titre indicatif)
+    index_agam/qdrant_positions.npy    (identifiant, position) triés par identifiant
+
+Côté app.py, `QdrantIndex` se présente comme un index FAISS (d, ntotal,
+search → positions, distance L2 au carré) : le ChunkStore, BM25 et les filtres
+restent ceux d'index_agam, seuls les vecteurs quittent la mémoire du serveur
+web. Un filtre de metadata_index.py devient un filtre de payload Qdrant.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+from chunk_store import ChunkStore, open_lazy_vectorstore
+from index_manifest import manifest_embedding_model
+from metadata_index import DUPLICATE_FIELDS, FILTER_FIELDS, field_values, normalize_value
+from sharded_index import stable_id, write_positions
+
+DEFAULT_COLLECTION = "agam"
+QDRANT_STATE = "qdrant.json"
+QDRANT_POSITIONS = "qdrant_positions.npy"
+# Index de payload des champs filtrables (page entière, le reste en mot-clé)
+PAYLOAD_INDEXES = {field: models.PayloadSchemaType.INTEGER if field == "page" else models.PayloadSchemaType.KEYWORD
+                   for field in FILTER_FIELDS}
+
+
+def is_server(location):
+    return location.startswith(("http://", "https://"))
+
+
+def open_client(location, api_key=None, timeout=60):
+    """URL http(s) → serveur ; ":memory:" → mode en mémoire ; sinon dossier du mode local."""
+    if is_server(location):
+        return QdrantClient(url=location, api_key=api_key, timeout=timeout)
+    if location == ":memory:":
+        return QdrantClient(location=":memory:")
+    return QdrantClient(path=location)
+
+
+def _payload_values(field, values):
+    if field == "page":
+        return [int(value) for value in values if str(value).lstrip("-").isdigit()]
+    return values
+
+
+def point_payload(record, digest):
+    payload = {"chunk_id": record["id"], "digest": digest}
+    for field in FILTER_FIELDS:
+        values = _payload_values(field, field_values(record["metadata"], field))
+        if values:
+            # Dossiers parents, sources des quasi-doublons : liste, filtrée par MatchAny
+            payload[field] = values if field in DUPLICATE_FIELDS else values[0]
+    return payload
+
+
+def record_digest(record, embedding_model):
+    data = json.dumps(record, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(embedding_model.encode("utf-8") + b"\0" + data).hexdigest()
+
+
+def qdrant_filter(filters):
+    """
+    Filtre {champ: [valeurs]} de metadata_index.py → Filter Qdrant (OU dans un champ, ET entre champs).
+
+    None si une valeur n'a pas d'équivalent dans le payload (page=N/A : seules
+    les pages entières y sont) : le filtre ne reproduirait pas la sélection.
+    """
+    conditions = []
+    for field, values in filters.items():
+        payload_values = _payload_values(field, [normalize_value(field, value) for value in values])
+        if len(payload_values) != len(values):
+            return None
+        conditions.append(models.FieldCondition(key=field, match=models.MatchAny(any=payload_values)))
+    return models.Filter(must=conditions)
+
+
+def with_retry(action, retries=5, backoff=0.5, what="requête"):
+    """Exécute `action()` en réessayant (backoff exponentiel) ; la dernière erreur remonte."""
+    for attempt in range(retries + 1):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"⚠️ Qdrant : échec de la {what} ({e}), nouvel essai dans {delay:.1f} s")
+            time.sleep(delay)
+
+
+def _path(index_path, name):
+    return os.path.join(index_path, name)
+
+
+def store_fingerprint(index_path):
+    """Empreinte du ChunkStore (table des segments) et du modèle d'embedding d'index_agam."""
+    digest = hashlib.sha1((manifest_embedding_model(index_path) or "").encode("utf-8"))
+    with open(os.path.join(index_path, "chunks.idx"), "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_state(index_path):
+    if not os.path.exists(_path(index_path, QDRANT_STATE)):
+        return None
+    with open(_path(index_path, QDRANT_STATE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def collection_mismatch(index_path, collection):
+    """
+    Raison pour laquelle la collection ne correspond pas à l'index_agam actuel, None si elle y correspond.
+
+    Seuls le nom de la collection et l'empreinte des segments comptent : l'URL
+    du serveur diffère d'un poste à l'autre pour la même instance
+    (localhost pour script_rag2.py, host.docker.internal depuis le conteneur).
+    """
+    state = read_state(index_path)
+    if state is None:
+        return f"aucune synchronisation enregistrée ({QDRANT_STATE} absent)"
+    if state["collection"] != collection:
+        return f"{QDRANT_STATE} décrit la collection {state['collection']}"
+    if state["fingerprint"] != store_fingerprint(index_path):
+        return "segments modifiés depuis la dernière synchronisation"
+    return None
+
+
+def collection_current(index_path, collection):
+    """La collection a-t-elle été synchronisée avec l'index_agam actuel ?"""
+    return collection_mismatch(index_path, collection) is None
+
+
+# --- Côté ingestion (script_rag2.py) -----------------------------------------
+
+def ensure_collection(client, collection, dim, payload_indexes=True):
+    """Crée la collection (distance euclidienne, comme l'index plat L2) et ses index de payload."""
+    if client.collection_exists(collection):
+        size = client.get_collection(collection).config.params.vectors.size
+        if size == dim:
+            return
+        print(f"🛠 Collection {collection} en dimension {size} : recréée en dimension {dim}")
+        client.delete_collection(collection)
+    client.create_collection(collection, vectors_config=models.VectorParams(size=dim, distance=models.Distance.EUCLID))
+    if not payload_indexes:
+        return
+    for field, schema in PAYLOAD_INDEXES.items():
+        client.create_payload_index(collection, field, field_schema=schema)
+
+
+def existing_digests(client, collection, batch_size=1000):
+    """{identifiant: empreinte} des points de la collection (sans les vecteurs)."""
+    digests, offset = {}, None
+    while True:
+        points, offset = client.scroll(collection, limit=batch_size, offset=offset,
+                                       with_payload=["digest"], with_vectors=False)
+        digests.update((int(point.id), (point.payload or {}).get("digest")) for point in points)
+        if offset is None:
+            return digests
+
+
+def sync_collection(index_path, flat_index, client, location, collection=DEFAULT_COLLECTION, batch_size=256,
+                    workers=4, retries=5):
+    """
+    Aligne la collection sur index_agam (index plat + ChunkStore).
+
+    Retourne (points envoyés, points supprimés).
+    """
+    embedding_model = manifest_embedding_model(index_path) or ""
+    # Le mode local (mémoire / dossier) n'a ni index de payload ni écritures concurrentes
+    server = is_server(location)
+    workers = workers if server else 1
+    ensure_collection(client, collection, flat_index.d, payload_indexes=server)
+    known = existing_digests(client, collection)
+
+    store = ChunkStore(index_path)
+    ids = np.empty(len(store), dtype=np.int64)
+    sent = 0
+
+    def upsert(batch):
+        positions, payloads = zip(*batch)
+        vectors = flat_index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+        points = models.Batch(ids=[int(ids[p]) for p in positions], vectors=vectors.tolist(), payloads=list(payloads))
+        with_retry(lambda: client.upsert(collection, points=points, wait=True), retries=retries, what="écriture")
+        return len(batch)
+
+    # Lots envoyés en parallèle, avec au plus 2 lots en attente par worker (mémoire bornée)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="qdrant") as pool:
+        pending, batch = deque(), []
+        for position, record in enumerate(store):
+            ids[position] = stable_id(record["id"])
+            digest = record_digest(record, embedding_model)
+            if known.pop(int(ids[position]), None) == digest:
+                continue
+            batch.append((position, point_payload(record, digest)))
+            if len(batch) == batch_size:
+                pending.append(pool.submit(upsert, batch))
+                batch = []
+                while len(pending) > 2 * max(1, workers):
+                    sent += pending.popleft().result()
+        if batch:
+            pending.append(pool.submit(upsert, batch))
+        while pending:
+            sent += pending.popleft().result()
+    store.close()
+
+    # Points restants : segments retirés d'index_agam
+    stale = list(known)
+    for start in range(0, len(stale), batch_size):
+        selector = models.PointIdsList(points=stale[start:start + batch_size])
+        with_retry(lambda: client.delete(collection, points_selector=selector, wait=True), retries=retries,
+                   what="suppression")
+
+    write_positions(_path(index_path, QDRANT_POSITIONS), ids)
+    state = {"location": location, "collection": collection, "d": flat_index.d, "ntotal": len(ids),
+             "embedding_model": embedding_model, "fingerprint": store_fingerprint(index_path)}
+    with open(_path(index_path, QDRANT_STATE) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(_path(index_path, QDRANT_STATE) + ".tmp", _path(index_path, QDRANT_STATE))
+    return sent, len(stale)
+
+
+# --- Côté recherche (app.py) -------------------------------------------------
+
+class QdrantIndex:
+    """Façade « index FAISS » sur une collection Qdrant : `search` renvoie des positions d'index_agam."""
+
+    def __init__(self, client, collection, d, ids, positions, hnsw_ef=None, retries=2):
+        self.client = client
+        self.collection = collection
+        self.d = d
+        self.ntotal = len(ids)
+        self._ids = ids
+        self._positions = positions
+        self._params = models.SearchParams(hnsw_ef=hnsw_ef) if hnsw_ef else None
+        self.retries = retries
+        self._ids_by_position = None
+
+    @classmethod
+    def open(cls, index_path, client, collection=DEFAULT_COLLECTION, hnsw_ef=None):
+        state = read_state(index_path)
+        table = np.load(_path(index_path, QDRANT_POSITIONS))
+        return cls(client, collection, state["d"], table[:, 0].copy(), table[:, 1].copy(), hnsw_ef=hnsw_ef)
+
+    def _lookup(self, stable_ids):
+        stable_ids = np.asarray(stable_ids, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self._ids, stable_ids), len(self._ids) - 1)
+        # Point plus récent que la table : -1, segment ignoré
+        return np.where(self._ids[i] == stable_ids, self._positions[i], -1)
+
+    def selection_filter(self, selection):
+        """Filtre de payload de la sélection, ou à défaut filtre sur les identifiants des segments retenus."""
+        query_filter = qdrant_filter(selection.filters)
+        if query_filter is not None:
+            return query_filter
+        if self._ids_by_position is None:
+            ids_by_position = np.empty(self.ntotal, dtype=np.int64)
+            ids_by_position[self._positions] = self._ids
+            self._ids_by_position = ids_by_position
+        positions = selection.positions()
+        stable_ids = self._ids_by_position[positions[positions < self.ntotal]]
+        return models.Filter(must=[models.HasIdCondition(has_id=[int(i) for i in stable_ids])])
+
+    def search(self, queries, k, selection=None):
+        """(distances, positions) des k plus proches voisins ; `selection` (metadata_index) filtre les segments."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.d)
+        query_filter = self.selection_filter(selection) if selection is not None else None
+        requests = [models.QueryRequest(query=query.tolist(), filter=query_filter, limit=k, params=self._params,
+                                        with_payload=False) for query in queries]
+        responses = with_retry(lambda: self.client.query_batch_points(self.collection, requests=requests),
+                               retries=self.retries, what="recherche")
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, response in enumerate(responses):
+            if not response.points or not self.ntotal:
+                continue
+            found = self._lookup([point.id for point in response.points])
+            keep = found != -1
+            scores = np.array([point.score for point in response.points], dtype=np.float32)[keep]
+            positions[row, :keep.sum()] = found[keep]
+            distances[row, :keep.sum()] = scores ** 2  # distance euclidienne → L2 au carré, comme FAISS
+        return distances, positions
+
+    def stats(self):
+        return {"backend": "qdrant", "collection": self.collection, "vectors": self.ntotal}
+
+
+def load_qdrant_vectorstore(index_path, embeddings, client, location, collection=DEFAULT_COLLECTION,
+                            hnsw_ef=None):
+    """Vectorstore LangChain sur la collection, ou None si elle n'est pas synchronisée avec index_agam."""
+    mismatch = collection_mismatch(index_path, collection)
+    if mismatch is not None:
+        print(f"⚠️ Collection Qdrant {collection} ({location}) refusée : {mismatch} "
+              f"(relancer script_rag2.py --vector-backend qdrant).")
+        return None
+    store = ChunkStore(index_path)
+    index = QdrantIndex.open(index_path, client, collection, hnsw_ef=hnsw_ef)
+    print(f"📊 Index servi : collection Qdrant {collection} ({location}), {index.ntotal} vecteurs")
+    return open_lazy_vectorstore(index, store, embeddings)
@@ -0,0 +1,184 @@
+"""
+query_cache.py
+
+Caches du chemin de requête de `app.py` :
+
+  * QueryVectorCache : LRU question normalisée → vecteur de requête (évite de
+    ré-encoder la question avec bge-large-en) ;
+  * AnswerCache      : réponse du LLM indexée par (question normalisée, ids des
+    chunks récupérés), avec ses sources, et en option un « hit sémantique »
+    quand le vecteur d'une nouvelle question est assez proche (cosinus) de
+    celui d'une question déjà traitée.
+
+Les deux caches ont une durée de vie (TTL), une taille maximale (éviction LRU)
+et sont vidés dès que l'index FAISS sur disque change (reconstruction par
+`script_rag2.py`).
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_question(question):
+    """Normalise une question pour servir de clé (casse, espaces, ponctuation finale)."""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?!.")
+
+
+def index_fingerprint(index_path):
+    """Empreinte de l'index sur disque : change à chaque reconstruction."""
+    fingerprint = []
+    for name in ("index.faiss", "chunks.idx", "manifest.json", "index_config.json", "bm25_vocab.json",
+                 "shards/shards.json", "metadata_index.json", "qdrant.json"):
+        path = os.path.join(index_path, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+class LRUCache:
+    """Dictionnaire LRU borné avec durée de vie par entrée, sûr entre threads."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()  # clé → (horodatage, valeur)
+        self._lock = threading.Lock()
+
+    def _expired(self, stamp):
+        return self.ttl is not None and time.monotonic() - stamp > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[0]):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """Copie des entrées encore valides (clé, valeur)."""
+        with self._lock:
+            return [(key, value) for key, (stamp, value) in self._data.items() if not self._expired(stamp)]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+class QueryVectorCache(LRUCache):
+    """Question normalisée → vecteur de requête (np.float32)."""
+
+
+class AnswerCache:
+    """Réponses indexées par (question normalisée, ids des chunks), avec hit sémantique optionnel."""
+
+    def __init__(self, maxsize=256, ttl=3600, semantic_threshold=None):
+        self.semantic_threshold = semantic_threshold
+        self.semantic_hits = 0
+        self._entries = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def key(question, chunk_ids):
+        return normalize_question(question), tuple(chunk_ids)
+
+    def get(self, question, chunk_ids):
+        entry = self._entries.get(self.key(question, chunk_ids))
+        return entry["answer"] if entry else None
+
+    def get_semantic(self, query_vector):
+        """
+        Entrée d'une question déjà traitée dont le vecteur est à ≥ seuil (cosinus), sinon None.
+
+        L'entrée porte la réponse ("answer"), les chunks récupérés ("chunk_ids") et les
+        passages cités ("passages") : la réponse est renvoyée avec ses sources.
+        """
+        if self.semantic_threshold is None:
+            return None
+        entries = [entry for _, entry in self._entries.items()]
+        if not entries:
+            return None
+        # Les vecteurs bge sont normalisés : le produit scalaire est le cosinus
+        matrix = np.stack([entry["vector"] for entry in entries])
+        scores = matrix @ np.asarray(query_vector, dtype=np.float32).ravel()
+        best = int(np.argmax(scores))
+        if scores[best] < self.semantic_threshold:
+            return None
+        self.semantic_hits += 1
+        return entries[best]
+
+    def put(self, question, chunk_ids, query_vector, answer, passages=()):
+        self._entries.put(self.key(question, chunk_ids), {
+            "vector": np.asarray(query_vector, dtype=np.float32).ravel(),
+            "answer": answer,
+            "chunk_ids": list(chunk_ids),
+            "passages": list(passages),
+        })
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        stats = self._entries.stats()
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
+
+
+class QueryCaches:
+    """Regroupe les deux caches et les invalide quand l'index sur disque change."""
+
+    def __init__(self, index_path, query_cache_size=1024, answer_cache_size=256,
+                 answer_ttl=3600, semantic_threshold=None):
+        self.index_path = index_path
+        self.vectors = QueryVectorCache(maxsize=query_cache_size)
+        self.answers = AnswerCache(maxsize=answer_cache_size, ttl=answer_ttl,
+                                   semantic_threshold=semantic_threshold)
+        self._fingerprint = index_fingerprint(index_path)
+
+    def index_changed(self):
+        """True si l'index sur disque a changé depuis le dernier rechargement (sans rien vider)."""
+        return index_fingerprint(self.index_path) != self._fingerprint
+
+    def pending_fingerprint(self):
+        """Empreinte de l'index sur disque si elle diffère de celle de l'index chargé, sinon None."""
+        fingerprint = index_fingerprint(self.index_path)
+        return None if fingerprint == self._fingerprint else fingerprint
+
+    def index_reloaded(self, fingerprint):
+        """Enregistre l'empreinte de l'index rechargé et vide les caches (à appeler une fois le rechargement réussi)."""
+        self._fingerprint = fingerprint
+        self.vectors.clear()
+        self.answers.clear()
+
+    def check_index(self):
+        """Vide les caches si l'index a été reconstruit ; retourne True dans ce cas."""
+        fingerprint = self.pending_fingerprint()
+        if fingerprint is None:
+            return False
+        self.index_reloaded(fingerprint)
+        return True
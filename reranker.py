@@ -0,0 +1,75 @@
+"""
+reranker.py
+
+Reclassement optionnel des segments récupérés par un cross-encoder local,
+entre la recherche (FAISS / BM25) et la construction du prompt.
+
+On sur-échantillonne les candidats, on score toutes les paires (question,
+segment) en une seule passe batchée, puis on ne garde que les N meilleurs
+(et/ou ceux au-dessus d'un seuil). Au-delà d'un nombre de reclassements
+simultanés, on rend l'ordre de la recherche tel quel plutôt que d'attendre.
+"""
+import threading
+import time
+
+from sentence_transformers import CrossEncoder
+
+# Cross-encoder multilingue (les documents AGAM sont en français)
+DEFAULT_RERANKER_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name=DEFAULT_RERANKER_MODEL, top_n=5, min_score=None,
+                 max_concurrent=2, max_length=512, device=None):
+        self.model = CrossEncoder(model_name, max_length=max_length, device=device)
+        self.top_n = top_n
+        self.min_score = min_score
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+        # Compteurs mis à jour depuis les threads des requêtes
+        self._stats_lock = threading.Lock()
+        self.calls = self.fallbacks = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    def rerank(self, question, docs):
+        """
+        Retourne (docs retenus, scores, reclassé ?).
+
+        Sous charge (tous les créneaux occupés), renvoie les `top_n` premiers
+        documents dans l'ordre de la recherche, sans scores.
+        """
+        if not docs:
+            return docs, [], False
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self.fallbacks += 1
+            return docs[:self.top_n], [], False
+
+        try:
+            start = time.perf_counter()
+            pairs = [(question, doc.page_content) for doc in docs]
+            scores = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        finally:
+            self._slots.release()
+
+        with self._stats_lock:
+            self.calls += 1
+            self.total_ms += elapsed_ms
+            self.last_ms = elapsed_ms
+
+        ranked = sorted(zip(docs, scores.tolist()), key=lambda item: -item[1])
+        if self.min_score is not None:
+            ranked = [item for item in ranked if item[1] >= self.min_score]
+        ranked = ranked[:self.top_n]
+        return [doc for doc, _ in ranked], [score for _, score in ranked], True
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "calls": self.calls,
+                "fallbacks": self.fallbacks,
+                "last_ms": round(self.last_ms, 1),
+                "avg_ms": round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+            }
@@ -1,31 +1,52 @@
 import os
 import re
+import shutil
+import argparse
+import time
 import fitz  # PyMuPDF
+import faiss
 from dotenv import load_dotenv
 from langchain_community.document_loaders import (
     TextLoader, CSVLoader, Docx2txtLoader, UnstructuredMarkdownLoader,
     UnstructuredPowerPointLoader, UnstructuredExcelLoader, UnstructuredRTFLoader,
     JSONLoader, UnstructuredXMLLoader
 )
-from langchain.text_splitter import RecursiveCharacterTextSplitter, TokenTextSplitter
 from langchain.docstore.document import Document
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.chains import RetrievalQA
 from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage
-import tiktoken
 
-# Charger les variables d'environnement
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-
-if not openai_api_key:
-    raise ValueError("❌ Clé API OpenAI non définie. Vérifiez le fichier .env.")
+from parallel_loading import iter_files_parallel
+from token_chunker import TokenChunker, pages_to_document
+from context_packing import get_encoding
+from streaming_pipeline import threaded, batch_chunks
+from embedding_backends import BACKENDS, DEFAULT_ONNX_DIR, embedding_id, make_embeddings
+from embedding_cache import EmbeddingCache, CachedEmbeddings, DEFAULT_CACHE_DIR
+from chunk_store import (save_vectorstore, load_vectorstore_for_update, new_vectorstore_for_update, ChunkStore,
+                         interrupted_rewrite)
+from bm25_index import update_bm25_index
+from near_duplicates import NearDuplicateIndex
+from metadata_index import update_metadata_index, file_metadata
+from pdf_images import ImageDescriber, extract_pdf_images, image_documents, IMAGE_PROMPT, MIN_IMAGE_SIDE
+from gemma_image_describe import MODEL_ID as IMAGE_MODEL, DEFAULT_OUTPUT as IMAGE_CACHE
+import metrics
+from metrics import INGEST_STAGE_SECONDS, INGEST_ITEMS_TOTAL
+from faiss_index_factory import INDEX_TYPES
+from sharded_index import PARTITIONS
+from vector_backends import VECTOR_BACKENDS, FaissBackend, QdrantBackend
+from index_manifest import (
+    load_manifest, save_manifest, empty_manifest, scan_files, diff_manifest,
+    chunk_ids_for, chunk_id_prefix, manifest_embedding_model, manifest_version,
+    MANIFEST_NAME, MANIFEST_VERSION
+)
 
 # Définir le dossier contenant les fichiers
 DATA_DIR = "data"
 
+# Dossier de l'index FAISS et modèle d'embedding associé
+INDEX_PATH = "index_agam"
+EMBEDDING_MODEL = "BAAI/bge-large-en"
+
 # Définition des loaders pour différents formats de fichiers
 EXTENSION_LOADERS = {
     ".txt": TextLoader,
@@ -40,22 +61,27 @@ EXTENSION_LOADERS = {
     ".xml": UnstructuredXMLLoader
 }
 
-print(f"🔍 Recherche de fichiers dans {DATA_DIR}...")
-
-documents = []
-
-# Fonction pour extraire le texte et les tableaux d'un PDF avec PyMuPDF
-def extract_text_and_tables_pymupdf(pdf_path):
-    """ Extrait le texte et les tableaux d'un PDF avec PyMuPDF et nettoie les données. """
+# Fonction pour extraire le texte d'une plage de pages d'un PDF avec PyMuPDF
+def extract_pdf_pages(pdf_path, start=0, end=None):
+    """ Extrait et nettoie le texte des pages [start, end) d'un PDF : [(numéro de page, texte)], pages vides ignorées. """
     doc = fitz.open(pdf_path)
     full_text = []
-    for page in doc:
-        text = page.get_text("text")  # Extrait le texte brut
+    for page_number in range(start, doc.page_count if end is None else end):
+        text = doc[page_number].get_text("text")  # Extrait le texte brut
         text = clean_text(text)
         if text.strip():
-            full_text.append(text)
+            full_text.append((page_number + 1, text))
+    doc.close()
+    return full_text
 
-    return "\n\n".join(full_text)
+def pdf_page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+# Fonction pour extraire le texte et les tableaux d'un PDF avec PyMuPDF
+def extract_text_and_tables_pymupdf(pdf_path):
+    """ Extrait le texte et les tableaux d'un PDF avec PyMuPDF et nettoie les données. """
+    return "\n\n".join(text for _, text in extract_pdf_pages(pdf_path))
 
 # Fonction de nettoyage avancé du texte
 def clean_text(text):
@@ -77,105 +103,522 @@ def clean_text(text):
 # Fonction pour charger un fichier donné
 def load_file(filepath):
     ext = os.path.splitext(filepath)[1].lower()
-    
+
     if ext == ".pdf":
-        text = extract_text_and_tables_pymupdf(filepath)
-        return [Document(page_content=text)] if text.strip() else []
+        # Un document par PDF, avec la position de chaque page (numéros de page des segments)
+        return pages_to_document(filepath, extract_pdf_pages(filepath))
 
+    # Les erreurs de chargement remontent à load_documents, qui les signale sans
+    # enregistrer le fichier dans le manifeste (il sera retenté au prochain run).
     if ext in EXTENSION_LOADERS:
-        try:
-            loader = EXTENSION_LOADERS[ext](filepath)
-            return loader.load()
-        except Exception as e:
-            print(f"❌ Erreur lors du chargement de {filepath} : {e}")
-    
+        loader = EXTENSION_LOADERS[ext](filepath)
+        return loader.load()
+
     return []
 
-# Parcourir les fichiers dans le répertoire DATA_DIR
-file_count = 0
-for root, _, files in os.walk(DATA_DIR):
-    for file in files:
-        file_count += 1
-        filepath = os.path.join(root, file)
-        print(f"📄 Chargement du fichier {file_count} : {filepath}")
-        loaded_docs = load_file(filepath)
-        documents.extend(loaded_docs)
+# Charger une liste de fichiers, en série ou sur un pool de processus
+def iter_documents(paths, workers=1, timeout=300, pdf_pages_per_task=50):
+    """ Produit (path, documents) dans l'ordre de `paths` ; documents = None en cas d'échec. """
+    if workers and workers > 1:
+        print(f"⚙️ Chargement parallèle sur {workers} processus...")
+        loaded = iter_files_parallel(
+            paths, load_file, extract_pdf_pages, pdf_page_count,
+            workers=workers, timeout=timeout, pdf_pages_per_task=pdf_pages_per_task
+        )
+        while True:
+            # Temps passé par l'étape à attendre chaque fichier des processus de chargement
+            start = time.perf_counter()
+            try:
+                filepath, documents = next(loaded)
+            except StopIteration:
+                return
+            INGEST_STAGE_SECONDS.observe(time.perf_counter() - start, stage="load")
+            INGEST_ITEMS_TOTAL.inc(stage="load", status="error" if documents is None else "ok")
+            yield filepath, documents
 
-print(f"📂 **Total de documents chargés : {len(documents)}**")
+    for file_count, filepath in enumerate(paths, start=1):
+        print(f"📄 Chargement du fichier {file_count} : {filepath}")
+        start = time.perf_counter()
+        try:
+            documents = load_file(filepath)
+        except Exception as e:
+            print(f"❌ Erreur lors du chargement de {filepath} : {e}")
+            documents = None
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - start, stage="load")
+        INGEST_ITEMS_TOTAL.inc(stage="load", status="error" if documents is None else "ok")
+        yield filepath, documents
 
-# Fonction pour estimer le nombre de tokens
+# Fonction pour estimer le nombre de tokens (encodage chargé une seule fois)
 def estimate_tokens(text, encoding_name="cl100k_base"):
-    encoding = tiktoken.get_encoding(encoding_name)
-    return len(encoding.encode(text))
-
-# Étape 1 : Découpage structurel
-structured_splitter = RecursiveCharacterTextSplitter(
-    separators=["\n\n", "\n", ".", " "],  # Priorité : paragraphes > phrases > mots
-    chunk_size=2000,  # Segments larges pour conserver les sections
-    chunk_overlap=300  # Conserver du contexte
-)
+    return len(get_encoding(encoding_name).encode(text, disallowed_special=()))
 
-# Étape 2 : Raffinement par tokens
-token_splitter = TokenTextSplitter(
+# Découpage en une passe : chaque document est encodé une fois, coupures aux
+# paragraphes / phrases dans la suite de tokens
+chunker = TokenChunker(
     encoding_name="cl100k_base",  # Encodage utilisé par OpenAI
     chunk_size=300,  # Nombre de tokens maximum par chunk
     chunk_overlap=50  # Tokens de chevauchement pour garder du contexte
 )
 
-# Découpage hybride
-def hybrid_split(documents):
-    final_chunks = []
-    for doc in documents:
-        # Découper en gros chunks basés sur la structure
-        large_chunks = structured_splitter.split_text(doc.page_content)
-        
-        # Raffiner chaque chunk large en chunks basés sur les tokens
-        for chunk in large_chunks:
-            tokenized_chunks = token_splitter.split_text(chunk)
-            for token_chunk in tokenized_chunks:
-                final_chunks.append(
-                    Document(
-                        page_content=token_chunk,
-                        metadata={
-                            "source": doc.metadata.get("source", "Inconnu"),
-                            "page": doc.metadata.get("page", "N/A")
-                        }
-                    )
-                )
-    return final_chunks
-
-# Utiliser la fonction sur les documents chargés
-split_documents = hybrid_split(documents)
-
-print(f"📂 **Total de segments après découpage : {len(split_documents)}**")
-print(f"🔍 Exemple d'un chunk : {split_documents[0].page_content}")
-print(f"🔖 Métadonnées associées : {split_documents[0].metadata}")
-
-# Enregistrer les segments dans un fichier texte
-output_file = "documents_transformes.txt"
-with open(output_file, "w", encoding="utf-8") as f:
-    for i, doc in enumerate(split_documents):
+def split_documents(documents):
+    return chunker.split_documents(documents)
+
+# Découper les fichiers chargés au fil de l'eau, avec leurs identifiants de chunks
+def iter_split(loaded, modifies):
+    """ Produit (entry, chunks, ids) par fichier chargé avec succès. """
+    for entry, (filepath, documents) in zip(modifies, loaded):
+        if documents is None:
+            continue  # Fichier en échec : absent du manifeste, il sera retenté au prochain passage
+        with metrics.timed(INGEST_STAGE_SECONDS, stage="split"):
+            chunks = split_documents(documents)
+        INGEST_ITEMS_TOTAL.inc(len(chunks), stage="split")
+        yield entry, chunks, chunk_ids_for(filepath, entry["sha256"], len(chunks))
+
+# Décrire les images des PDF et ajouter leurs descriptions aux segments du fichier
+def iter_images(units, describer, min_side=MIN_IMAGE_SIDE):
+    """ Produit (entry, segments + descriptions d'images, ids) ; les ids couvrent tous les segments du fichier. """
+    for entry, chunks, chunk_ids in units:
+        filepath = entry["path"]
+        if os.path.splitext(filepath)[1].lower() == ".pdf":
+            try:
+                with metrics.timed(INGEST_STAGE_SECONDS, stage="images"):
+                    images = extract_pdf_images(filepath, min_side=min_side)
+                    described = image_documents(filepath, images, describer.describe(filepath, images))
+            except Exception as e:
+                # Comme un échec de chargement : absent du manifeste, le fichier sera retenté
+                print(f"❌ Erreur lors de la description des images de {filepath} : {e}")
+                continue
+            INGEST_ITEMS_TOTAL.inc(len(described), stage="images")
+            if described:
+                chunks = chunks + described
+                chunk_ids = chunk_ids_for(filepath, entry["sha256"], len(chunks))
+        yield entry, chunks, chunk_ids
+
+# Écarter les segments quasi identiques à un segment déjà retenu (versions republiées)
+def iter_dedup(units, dedup):
+    """ Produit (entry, segments retenus, ids) ; entry["duplicates"] liste les segments rattachés. """
+    for entry, chunks, chunk_ids in units:
+        kept, kept_ids, duplicates = [], [], []
+        with metrics.timed(INGEST_STAGE_SECONDS, stage="dedup"):
+            for chunk, chunk_id in zip(chunks, chunk_ids):
+                canonical = dedup.add_or_match(chunk_id, chunk.page_content)
+                if canonical is None:
+                    kept.append(chunk)
+                    kept_ids.append(chunk_id)
+                else:
+                    duplicates.append({"canonical": canonical, "source": chunk.metadata["source"],
+                                       "page": chunk.metadata["page"]})
+        INGEST_ITEMS_TOTAL.inc(len(duplicates), stage="dedup")
+        entry["duplicates"] = duplicates
+        yield entry, kept, kept_ids
+
+# Ajouter la source des segments rattachés aux métadonnées du segment indexé
+# (avec dossier et extension : les filtres de metadata_index.py s'y appliquent aussi).
+# Les segments relus sur disque sont des copies : la modification passe par `docstore.update`.
+def fold_duplicates(vectorstore, duplicates):
+    for duplicate in duplicates:
+        doc = vectorstore.docstore.search(duplicate["canonical"])
+        metadata = file_metadata(duplicate["source"], DATA_DIR, None)
+        folded = {"source": duplicate["source"], "page": duplicate["page"],
+                  "directory": metadata["directory"], "extension": metadata["extension"]}
+        sources = doc.metadata.setdefault("duplicate_sources", [])
+        # Déjà rattaché si un arrêt a eu lieu entre l'écriture de l'index et celle du manifeste
+        if not any((d["source"], d["page"]) == (folded["source"], folded["page"]) for d in sources):
+            sources.append(folded)
+            vectorstore.docstore.update(duplicate["canonical"], doc)
+
+def unfold_duplicates(vectorstore, path, canonical_ids):
+    for canonical in canonical_ids:
+        doc = vectorstore.docstore.search(canonical)
+        if isinstance(doc, Document) and "duplicate_sources" in doc.metadata:
+            doc.metadata["duplicate_sources"] = [
+                d for d in doc.metadata["duplicate_sources"] if d["source"] != path]
+            vectorstore.docstore.update(canonical, doc)
+
+# Enregistrer les segments dans un fichier texte, au fil de l'eau
+def open_segments_file(output_file="documents_transformes.txt"):
+    return open(output_file, "w", encoding="utf-8") if output_file else None
+
+def write_segments(f, split_documents, start):
+    for i, doc in enumerate(split_documents, start=start):
         f.write(f"--- Segment {i+1} ---\n")
         f.write(doc.page_content)
         f.write("\n\n")
 
-print(f"✅ Segments enregistrés dans le fichier '{output_file}'.")
 
-# Vérification de l'index FAISS
-index_path = "index_agam"
-if os.path.exists(index_path):
-    print("🛠 Suppression de l'index FAISS existant...")
-    os.system(f"rm -r {index_path}")
+# Mettre à jour l'index lexical BM25 sur les segments d'index_agam (mêmes positions que FAISS) :
+# seuls les segments nouveaux ou modifiés sont tokenisés
+def build_lexical_index():
+    store = ChunkStore(INDEX_PATH)
+    with metrics.timed(INGEST_STAGE_SECONDS, stage="bm25"):
+        result = update_bm25_index(INDEX_PATH, store)
+    store.close()
+    if result is None:
+        print("✅ Index BM25 déjà à jour")
+        return
+    n_docs, n_terms, n_tokenized = result
+    print(f"✅ Index BM25 : {n_docs} segments ({n_tokenized} tokenisé(s)), {n_terms} termes")
 
-print("⚠️ Création d'un nouvel index FAISS...")
+# Mettre à jour les bitmaps de métadonnées (filtres de recherche) sur les mêmes positions que FAISS
+def build_filter_index():
+    store = ChunkStore(INDEX_PATH)
+    with metrics.timed(INGEST_STAGE_SECONDS, stage="metadata_index"):
+        result = update_metadata_index(INDEX_PATH, store)
+    store.close()
+    if result is None:
+        print("✅ Index des métadonnées déjà à jour")
+        return
+    n_docs, n_values, n_read = result
+    print(f"✅ Index des métadonnées : {n_docs} segments ({n_read} relu(s)), {n_values} valeurs filtrables")
+
+# Backend des vecteurs servis par app.py : index FAISS d'index_agam ou collection Qdrant
+def served_backend(args):
+    if args.vector_backend == "qdrant":
+        return QdrantBackend(INDEX_PATH, args.qdrant_url, collection=args.qdrant_collection,
+                             api_key=os.getenv("QDRANT_API_KEY"), batch_size=args.qdrant_batch_size,
+                             workers=args.qdrant_workers, retries=args.qdrant_retries)
+    return FaissBackend(INDEX_PATH, index_type=args.index_type, shards=args.shards, shard_by=args.shard_by,
+                        data_dir=DATA_DIR, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m,
+                        train_size=args.train_size)
+
+# Construire l'index servi par app.py à partir de l'index plat (FAISS plat / approché / shards, ou Qdrant)
+def build_served_index(flat_index, args):
+    with metrics.timed(INGEST_STAGE_SECONDS, stage="served_index"):
+        served_backend(args).publish(flat_index)
+
+def served_index_current(args):
+    return served_backend(args).is_current()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Construit / met à jour l'index FAISS index_agam.")
+    parser.add_argument("--full", action="store_true",
+                        help="Supprime l'index existant et ré-encode tout le corpus.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Nombre de processus de chargement (0 = tous les cœurs, 1 = en série).")
+    parser.add_argument("--file-timeout", type=int, default=300,
+                        help="Délai maximal (s) de chargement d'un fichier ou d'une tranche de PDF.")
+    parser.add_argument("--pdf-pages-per-task", type=int, default=50,
+                        help="Taille des tranches de pages pour découper les gros PDF entre processus.")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="Nombre de segments encodés et ajoutés à l'index par lot.")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="Taille des files bornées entre les étapes du pipeline.")
+    parser.add_argument("--checkpoint-every", type=int, default=20,
+                        help="Sauvegarde de l'index et du manifeste tous les N lots (reprise après arrêt).")
+    parser.add_argument("--segments-file", default="",
+                        help="Fichier de contrôle des segments produits, ex. documents_transformes.txt "
+                             "(désactivé par défaut : le texte est déjà dans index_agam/chunks.bin).")
+    parser.add_argument("--embedding-backend", choices=BACKENDS, default="torch",
+                        help="Backend d'encodage : torch (fp32, référence), onnx ou onnx-int8 sur CPU. "
+                             "En changer reconstruit l'index.")
+    parser.add_argument("--onnx-dir", default=DEFAULT_ONNX_DIR,
+                        help="Dossier de l'export ONNX (onnx_embeddings.py).")
+    parser.add_argument("--embedding-batch-size", type=int, default=32,
+                        help="Segments par passage du modèle (lots triés par longueur, padding dynamique).")
+    parser.add_argument("--embedding-threads", type=int, default=None,
+                        help="Threads onnxruntime (défaut : tous les cœurs).")
+    parser.add_argument("--embedding-cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Cache disque des embeddings par contenu ('' pour désactiver).")
+    parser.add_argument("--embedding-cache-mb", type=int, default=2048,
+                        help="Taille maximale du cache d'embeddings (Mo) avant éviction.")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                        help="Type d'index servi par app.py (construit depuis l'index plat de référence).")
+    parser.add_argument("--nlist", type=int, default=None,
+                        help="Nombre de listes IVF (défaut : ~4·√n).")
+    parser.add_argument("--pq-m", type=int, default=64,
+                        help="Nombre de sous-quantificateurs PQ (doit diviser la dimension).")
+    parser.add_argument("--hnsw-m", type=int, default=32,
+                        help="Nombre de voisins par nœud du graphe HNSW.")
+    parser.add_argument("--train-size", type=int, default=50000,
+                        help="Taille de l'échantillon d'embeddings pour l'entraînement IVF / PQ.")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Nombre de shards de l'index servi (0 = index unique) ; seuls les shards "
+                             "dont les fichiers ont changé sont reconstruits.")
+    parser.add_argument("--shard-by", choices=PARTITIONS, default="directory",
+                        help="Répartition des fichiers entre shards : par dossier source ou par fichier.")
+    parser.add_argument("--vector-backend", choices=VECTOR_BACKENDS, default="faiss",
+                        help="Stockage des vecteurs servis : FAISS dans index_agam, ou collection Qdrant "
+                             "synchronisée avec index_agam.")
+    parser.add_argument("--qdrant-url", default=os.getenv("QDRANT_URL", "http://localhost:6333"),
+                        help="URL du serveur Qdrant, ':memory:' ou dossier du mode local de qdrant-client.")
+    parser.add_argument("--qdrant-collection", default=os.getenv("QDRANT_COLLECTION", "agam"))
+    parser.add_argument("--qdrant-batch-size", type=int, default=256,
+                        help="Points par requête d'écriture Qdrant.")
+    parser.add_argument("--qdrant-workers", type=int, default=4,
+                        help="Requêtes d'écriture Qdrant en parallèle.")
+    parser.add_argument("--qdrant-retries", type=int, default=5,
+                        help="Nouvelles tentatives d'une écriture en échec (backoff exponentiel).")
+    parser.add_argument("--dedup-threshold", type=float, default=0.9,
+                        help="Similarité de Jaccard (MinHash) au-delà de laquelle un segment est fusionné "
+                             "avec un segment déjà indexé (0 pour désactiver).")
+    parser.add_argument("--minhash-perm", type=int, default=128,
+                        help="Nombre de permutations des signatures MinHash.")
+    parser.add_argument("--describe-images", action="store_true",
+                        help="Extrait les images des PDF, les décrit avec Gemma et indexe les descriptions.")
+    parser.add_argument("--image-model", default=IMAGE_MODEL,
+                        help="Modèle Hugging Face utilisé pour décrire les images.")
+    parser.add_argument("--image-workers", type=int, default=1,
+                        help="Workers de description (un pipeline Gemma chacun ; 1 sur un seul GPU).")
+    parser.add_argument("--image-batch-size", type=int, default=4,
+                        help="Images décrites par appel au pipeline.")
+    parser.add_argument("--image-min-side", type=int, default=MIN_IMAGE_SIDE,
+                        help="Côté minimal (pixels) d'une image décrite ; les plus petites sont ignorées.")
+    parser.add_argument("--image-cache", default=IMAGE_CACHE,
+                        help="Fichier JSONL du cache des descriptions (partagé avec gemma_image_describe.py).")
+    parser.add_argument("--image-device", choices=["auto", "cuda", "cpu"], default="auto")
+    parser.add_argument("--image-dtype", choices=["auto", "bfloat16", "float16", "float32"], default="auto")
+    parser.add_argument("--metrics-file", default="",
+                        help="Fichier où écrire les compteurs d'ingestion au format Prometheus "
+                             "(collecteur textfile de node_exporter).")
+    return parser.parse_args()
+
+
+# Résumé des compteurs d'ingestion (et export Prometheus si demandé)
+def report_ingestion_metrics(args, elapsed):
+    INGEST_STAGE_SECONDS.observe(elapsed, stage="total")
+    print("⏱ Temps par étape (cumulés ; chargement, découpage et encodage se recouvrent) :")
+    for line in metrics.stage_summary(INGEST_STAGE_SECONDS):
+        print(line)
+    items = ", ".join(f"{'/'.join(str(value) for _, value in key)}={count}"
+                      for key, count in sorted(INGEST_ITEMS_TOTAL.snapshot().items()))
+    if items:
+        print(f"📊 Éléments traités : {items}")
+    if args.metrics_file:
+        metrics.write_metrics_file(args.metrics_file)
+        print(f"📈 Compteurs d'ingestion écrits dans '{args.metrics_file}'.")
+
+
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    try:
+        ingest(args)
+    finally:
+        report_ingestion_metrics(args, time.perf_counter() - start)
+
+
+def ingest(args):
+    # Charger les variables d'environnement
+    load_dotenv()
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+
+    if not openai_api_key:
+        raise ValueError("❌ Clé API OpenAI non définie. Vérifiez le fichier .env.")
+
+    # Identifiant des vecteurs : modèle + backend (un autre backend → index reconstruit)
+    embedding_model = embedding_id(args.embedding_backend, EMBEDDING_MODEL)
+
+    # Vérification de l'index FAISS : sans manifeste, on ne sait pas quels
+    # vecteurs appartiennent à quel fichier → reconstruction complète.
+    manifest = load_manifest(INDEX_PATH, embedding_model)
+    index_exists = os.path.exists(os.path.join(INDEX_PATH, "index.faiss"))
+    legacy_index = index_exists and not os.path.exists(os.path.join(INDEX_PATH, MANIFEST_NAME))
+    indexed_with = manifest_embedding_model(INDEX_PATH)
+    model_changed = index_exists and indexed_with not in (None, embedding_model)
+    if model_changed:
+        print(f"🛠 Index encodé avec {indexed_with} : reconstruction avec {embedding_model}")
+    # Manifeste d'un autre format : ses chunk_ids ne décrivent plus l'index (segments supprimés
+    # jamais retirés, fichiers inchangés ajoutés en double) → reconstruction complète
+    indexed_version = manifest_version(INDEX_PATH)
+    version_changed = index_exists and indexed_version not in (None, MANIFEST_VERSION)
+    if version_changed:
+        print(f"🛠 Manifeste v{indexed_version} (format actuel : v{MANIFEST_VERSION}) : reconstruction complète")
+    # Arrêt pendant une réécriture de chunks.* / index.faiss : positions possiblement désalignées
+    interrupted = index_exists and interrupted_rewrite(INDEX_PATH)
+    if interrupted:
+        print(f"🛠 Index interrompu pendant une réécriture ({interrupted}) : reconstruction complète")
+    if args.full or legacy_index or model_changed or version_changed or interrupted:
+        if os.path.exists(INDEX_PATH):
+            print("🛠 Suppression de l'index FAISS existant...")
+            shutil.rmtree(INDEX_PATH)
+        manifest = empty_manifest(embedding_model)
+        index_exists = False
+
+    print(f"🔍 Recherche de fichiers dans {DATA_DIR}...")
+    paths = scan_files(DATA_DIR)
+    modifies, inchanges, supprimes = diff_manifest(manifest, paths)
+    # Activer / désactiver la description des images (ou changer de modèle) change
+    # les segments des PDF : ils sont ré-ingérés (embeddings relus dans le cache).
+    image_setting = {"model": args.image_model, "prompt": IMAGE_PROMPT} if args.describe_images else None
+    if manifest.get("images") != image_setting:
+        pdfs = [path for path in inchanges if path.lower().endswith(".pdf")]
+        if pdfs:
+            print(f"🖼 Réglage de description des images modifié : ré-ingestion de {len(pdfs)} PDF")
+        for path in pdfs:
+            record = manifest["files"][path]
+            modifies.append({"path": path, "size": record["size"], "mtime": record["mtime"],
+                             "sha256": record["sha256"]})
+        inchanges = [path for path in inchanges if path not in set(pdfs)]
+        manifest["images"] = image_setting
+
+    print(f"📂 {len(modifies)} fichier(s) nouveau(x) ou modifié(s), "
+          f"{len(inchanges)} inchangé(s), {len(supprimes)} supprimé(s)")
+
+    if index_exists and not modifies and not supprimes:
+        save_manifest(INDEX_PATH, manifest)
+        print("✅ Index FAISS déjà à jour, rien à ré-encoder.")
+        if not served_index_current(args):
+            build_served_index(faiss.read_index(os.path.join(INDEX_PATH, "index.faiss")), args)
+        build_lexical_index()
+        build_filter_index()
+        return
+
+    # Initialiser les embeddings BGE (PyTorch fp32 ou ONNX sur CPU)
+    bge_embeddings = make_embeddings(args.embedding_backend, EMBEDDING_MODEL, onnx_dir=args.onnx_dir,
+                                     batch_size=args.embedding_batch_size, threads=args.embedding_threads)
+
+    # Les segments dont le texte a déjà été encodé sont relus dans le cache disque
+    embedding_cache = None
+    embeddings = bge_embeddings
+    if args.embedding_cache_dir:
+        embedding_cache = EmbeddingCache(embedding_model, normalize=True,
+                                         cache_dir=args.embedding_cache_dir,
+                                         max_mb=args.embedding_cache_mb)
+        embeddings = CachedEmbeddings(bge_embeddings, embedding_cache)
+
+    vectorstore = None
+    if index_exists:
+        vectorstore = load_vectorstore_for_update(INDEX_PATH, bge_embeddings)
+
+    # Retirer de l'index les vecteurs des fichiers supprimés ou modifiés
+    removed = {path: manifest["files"].pop(path) for path in supprimes}
+    for entry in modifies:
+        if entry["path"] in manifest["files"]:
+            removed[entry["path"]] = manifest["files"].pop(entry["path"])
+
+    # Un fichier dont des segments avaient été fusionnés avec un vecteur retiré
+    # est ré-ingéré (ses embeddings sont relus dans le cache disque).
+    stale = set()
+    pending = list(removed.values())
+    while pending:
+        stale.update(chunk_id for record in pending for chunk_id in record["chunk_ids"])
+        pending = []
+        for path, record in list(manifest["files"].items()):
+            if stale.intersection(record.get("duplicate_of", [])):
+                removed[path] = manifest["files"].pop(path)
+                modifies.append({"path": path, "size": record["size"], "mtime": record["mtime"],
+                                 "sha256": record["sha256"]})
+                pending.append(record)
+                print(f"🔁 Ré-ingestion de {path} (segments fusionnés avec un vecteur retiré)")
+    stale_ids = list(stale)
+
+    if vectorstore is not None:
+        # Les fichiers retirés ne sont plus des sources des segments qu'ils doublaient
+        for path, record in removed.items():
+            unfold_duplicates(vectorstore, path, set(record.get("duplicate_of", [])) - stale)
+
+        # Après un arrêt entre l'écriture de l'index et celle du manifeste, des
+        # vecteurs peuvent déjà porter les identifiants des fichiers modifiés.
+        known_ids = set(vectorstore.index_to_docstore_id.values())
+        prefixes = {chunk_id_prefix(entry["path"], entry["sha256"]) for entry in modifies}
+        stale_ids.extend(i for i in known_ids if i.split("-")[0] in prefixes)
+        stale_ids = sorted(known_ids.intersection(stale_ids))
+        if stale_ids:
+            print(f"🗑 Suppression de {len(stale_ids)} vecteur(s) obsolète(s)...")
+            vectorstore.delete(stale_ids)
+
+    # Détection des quasi-doublons : signatures MinHash des segments déjà indexés
+    dedup = None
+    if args.dedup_threshold > 0:
+        dedup = NearDuplicateIndex(threshold=args.dedup_threshold, num_perm=args.minhash_perm)
+        if vectorstore is not None:
+            computed = dedup.restore(INDEX_PATH, list(vectorstore.index_to_docstore_id.values()),
+                                     lambda chunk_id: vectorstore.docstore.search(chunk_id).page_content)
+            print(f"🧬 {len(dedup)} signature(s) MinHash chargée(s), {computed} recalculée(s)")
+
+    @metrics.timed(INGEST_STAGE_SECONDS, stage="checkpoint")
+    def checkpoint():
+        # L'index est écrit avant le manifeste : un arrêt entre les deux ne fait que
+        # provoquer un ré-encodage des mêmes fichiers au prochain passage.
+        save_vectorstore(vectorstore, INDEX_PATH)
+        if dedup is not None:
+            dedup.save(INDEX_PATH)
+        save_manifest(INDEX_PATH, manifest)
+        if embedding_cache is not None:
+            embedding_cache.flush()
+
+    # Pipeline en flux : chargement → découpage → lots d'embeddings → index.
+    # Le chargement et le découpage tournent dans des threads reliés par des
+    # files bornées ; seul un lot de segments est en mémoire à la fois.
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    loaded = threaded(iter_documents([entry["path"] for entry in modifies], workers=workers,
+                                     timeout=args.file_timeout,
+                                     pdf_pages_per_task=args.pdf_pages_per_task),
+                      maxsize=args.queue_size)
+    units = iter_split(loaded, modifies)
+    describer = None
+    if args.describe_images:
+        # Étape dans son propre thread : la description (GPU) recouvre chargement et encodage
+        describer = ImageDescriber(cache_path=args.image_cache, model=args.image_model,
+                                   workers=args.image_workers, batch_size=args.image_batch_size,
+                                   device=args.image_device, dtype=args.image_dtype)
+        units = threaded(iter_images(units, describer, min_side=args.image_min_side), maxsize=args.queue_size)
+    if dedup is not None:
+        units = iter_dedup(units, dedup)
+    units = threaded(units, maxsize=args.queue_size)
+
+    segments_file = open_segments_file(args.segments_file)
+    segment_count = 0
+    ingested_at = time.strftime("%Y-%m-%d")
+    try:
+        for batch_number, (docs, ids, done) in enumerate(batch_chunks(units, args.batch_size), start=1):
+            if docs:
+                # Métadonnées structurées (filtres de recherche) : dossier, extension, date d'ingestion
+                for doc in docs:
+                    doc.metadata.update(file_metadata(doc.metadata["source"], DATA_DIR, ingested_at))
+                if segments_file:
+                    write_segments(segments_file, docs, segment_count)
+                with metrics.timed(INGEST_STAGE_SECONDS, stage="embed"):
+                    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+                INGEST_ITEMS_TOTAL.inc(len(docs), stage="embed")
+                text_embeddings = list(zip([doc.page_content for doc in docs], vectors))
+                metadatas = [doc.metadata for doc in docs]
+                with metrics.timed(INGEST_STAGE_SECONDS, stage="index"):
+                    if vectorstore is None:
+                        print("⚠️ Création d'un nouvel index FAISS...")
+                        vectorstore = new_vectorstore_for_update(INDEX_PATH, bge_embeddings, len(vectors[0]))
+                    vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+                segment_count += len(docs)
+
+            # Un fichier n'entre au manifeste qu'une fois tous ses segments dans l'index
+            for entry, chunk_ids in done:
+                duplicates = entry.get("duplicates", [])
+                fold_duplicates(vectorstore, duplicates)
+                manifest["files"][entry["path"]] = {
+                    "size": entry["size"], "mtime": entry["mtime"], "sha256": entry["sha256"],
+                    "chunk_ids": chunk_ids,
+                    "duplicate_of": sorted({duplicate["canonical"] for duplicate in duplicates})
+                }
+
+            print(f"➕ Lot {batch_number} : {segment_count} segment(s) indexé(s)")
+            if vectorstore is not None and batch_number % args.checkpoint_every == 0:
+                checkpoint()
+                print(f"💾 Point de reprise enregistré ({len(manifest['files'])} fichier(s))")
+    finally:
+        if segments_file:
+            segments_file.close()
+        if describer is not None:
+            describer.close()
+
+    print(f"📂 **Total de segments encodés : {segment_count}**")
+    if dedup is not None:
+        print(f"🧬 Quasi-doublons fusionnés : {dedup.matches} segment(s) non encodé(s)")
+    if describer is not None:
+        print(f"🖼 Images : {describer.stats()}")
+    if embedding_cache is not None:
+        print(f"🗃 Cache d'embeddings : {embedding_cache.stats()}")
+    if vectorstore is None:
+        print("ℹ️ Aucun segment à indexer.")
+        return
+
+    checkpoint()
+    print(f"✅ Index FAISS enregistré dans '{INDEX_PATH}/' !")
+    if not served_index_current(args):
+        build_served_index(vectorstore.index, args)
+    build_lexical_index()
+    build_filter_index()
 
-# Initialiser les embeddings BGE
-bge_embeddings = HuggingFaceEmbeddings(
-    model_name="BAAI/bge-large-en",
-    encode_kwargs={'normalize_embeddings': True}
-)
 
-# Créer le vectorstore avec les nouveaux embeddings
-vectorstore = FAISS.from_documents(split_documents, bge_embeddings)
-vectorstore.save_local(index_path)
-print("✅ Index FAISS enregistré dans 'index_agam/' !")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+sharded_index.py
+
+Index servi découpé en N shards FAISS, cherchés en parallèle.
+
+`script_rag2.py --shards N` répartit les segments d'index_agam par dossier
+source (`--shard-by directory`) ou par fichier (`--shard-by hash`) : tous les
+segments d'un fichier tombent dans le même shard, si bien qu'un fichier ajouté
+ou modifié ne fait reconstruire que son shard. Chaque shard est un IndexIDMap
+dont les identifiants sont dérivés du chunk_id : ils ne bougent pas quand les
+positions FAISS se décalent (suppression d'un autre fichier). Une table
+(identifiant → position) fait le lien avec le ChunkStore et l'index BM25, qui
+restent globaux.
+
+    index_agam/shards/shards.json        partition, dimension, empreinte de chaque shard et des segments
+    index_agam/shards/shard_000.faiss    IndexIDMap (plat ou approché) d'un shard
+    index_agam/shards/positions.npy      (identifiant, position) triés par identifiant
+
+Côté app.py, `ShardedIndex` se présente comme un index FAISS (d, ntotal,
+search → positions) : les shards sont cherchés dans un pool de threads (FAISS
+relâche le GIL) et leurs top-k fusionnés par un tas. Un shard n'est lu qu'à sa
+première recherche ; au rechargement, seuls les shards dont l'empreinte a changé
+sont relus, les autres restent en mémoire.
+"""
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from chunk_store import ChunkStore, open_lazy_vectorstore
+from faiss_index_factory import (factory_spec, build_index, build_options, set_search_params, search_parameters,
+                                 flat_vectors)
+from metadata_index import normalize_value
+
+SHARDS_DIR = "shards"
+SHARDS_CONFIG = "shards.json"
+POSITIONS_NAME = "positions.npy"
+PARTITIONS = ("directory", "hash")
+# En dessous, un shard reste plat : trop peu de vecteurs pour entraîner IVF / PQ
+MIN_APPROXIMATE_SHARD = 10000
+
+
+def stable_id(chunk_id):
+    """Identifiant int64 positif, stable, d'un segment (dérivé de son chunk_id)."""
+    return int(hashlib.sha1(chunk_id.encode("utf-8")).hexdigest()[:15], 16)
+
+
+def shard_key(source, partition, data_dir="data"):
+    """Clé de partition d'un segment : son dossier (relatif à data/) ou son fichier."""
+    if partition == "directory":
+        return os.path.dirname(os.path.relpath(source, data_dir)) or "."
+    return source
+
+
+def shard_of(key, n_shards):
+    return zlib.crc32(key.encode("utf-8")) % n_shards
+
+
+def _path(index_path, name):
+    return os.path.join(index_path, SHARDS_DIR, name)
+
+
+def has_shards(index_path):
+    return os.path.exists(_path(index_path, SHARDS_CONFIG))
+
+
+def read_shards_config(index_path):
+    if not has_shards(index_path):
+        return None
+    with open(_path(index_path, SHARDS_CONFIG), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def shards_config_matches(index_path, n_shards, partition, index_type, nlist=None, pq_m=64, hnsw_m=32,
+                          train_size=50000):
+    """Les shards sur disque ont-ils été construits avec ces réglages, sur l'index actuel ?"""
+    config = read_shards_config(index_path)
+    if config is None:
+        return False
+    store = ChunkStore(index_path)
+    current = config.get("chunk_store") == store.snapshot()
+    store.close()
+    return current and (config["n_shards"], config["partition"], config["index_type"], config.get("options")) == (
+        n_shards, partition, index_type, build_options(nlist, pq_m, hnsw_m, train_size))
+
+
+def remove_shards(index_path):
+    if os.path.exists(os.path.join(index_path, SHARDS_DIR)):
+        shutil.rmtree(os.path.join(index_path, SHARDS_DIR))
+
+
+def write_positions(path, ids):
+    """Table (identifiant, position) triée par identifiant ; `ids[i]` est l'identifiant de la position i."""
+    order = np.argsort(ids, kind="stable")
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, np.stack([ids[order], order.astype(np.int64)], axis=1))
+    os.replace(path + ".tmp", path)
+
+
+# --- Côté ingestion (script_rag2.py) -----------------------------------------
+
+def write_shards(index_path, flat_index, n_shards, partition="directory", index_type="flat", data_dir="data",
+                 nlist=None, pq_m=64, hnsw_m=32, train_size=50000):
+    """
+    Écrit les N shards à partir de l'index plat et du ChunkStore d'index_agam.
+
+    Un shard n'est reconstruit que si ses segments ou ses réglages ont changé.
+    Retourne le nombre de shards reconstruits.
+    """
+    os.makedirs(os.path.join(index_path, SHARDS_DIR), exist_ok=True)
+    previous = read_shards_config(index_path) or {}
+    options = build_options(nlist, pq_m, hnsw_m, train_size)
+    reusable = previous.get("n_shards") == n_shards and previous.get("partition") == partition \
+        and previous.get("options") == options
+    previous_shards = previous.get("shards", []) if reusable else []
+
+    store = ChunkStore(index_path)
+    ids = np.empty(len(store), dtype=np.int64)
+    members = [[] for _ in range(n_shards)]
+    keys = [set() for _ in range(n_shards)]
+    for position, record in enumerate(store):
+        ids[position] = stable_id(record["id"])
+        key = shard_key(record["metadata"].get("source", ""), partition, data_dir)
+        number = shard_of(key, n_shards)
+        members[number].append(position)
+        keys[number].add(key)
+    snapshot = store.snapshot()
+    store.close()
+
+    # Table identifiant → position, relue par app.py à chaque rechargement
+    write_positions(_path(index_path, POSITIONS_NAME), ids)
+
+    vectors = flat_vectors(flat_index) if flat_index.ntotal else None
+    shards, rebuilt = [], 0
+    for number, positions in enumerate(members):
+        shard_ids = ids[positions]
+        shard_type = index_type if len(positions) >= MIN_APPROXIMATE_SHARD else "flat"
+        spec = factory_spec(shard_type, len(positions), flat_index.d, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+        digest = hashlib.sha1(spec.encode("utf-8"))
+        digest.update(np.sort(shard_ids).tobytes())
+        entry = {"file": f"shard_{number:03d}.faiss", "ntotal": len(positions), "spec": spec,
+                 "fingerprint": digest.hexdigest()}
+        if partition == "directory":
+            entry["directories"] = sorted(keys[number])
+
+        old = previous_shards[number] if number < len(previous_shards) else None
+        if old and old["fingerprint"] == entry["fingerprint"] and \
+                (not positions or os.path.exists(_path(index_path, entry["file"]))):
+            shards.append(entry)
+            continue
+        if positions:
+            index = build_index(vectors[positions], spec, train_size=train_size, ids=shard_ids)
+            faiss.write_index(index, _path(index_path, entry["file"]) + ".tmp")
+            os.replace(_path(index_path, entry["file"]) + ".tmp", _path(index_path, entry["file"]))
+        elif os.path.exists(_path(index_path, entry["file"])):
+            os.remove(_path(index_path, entry["file"]))
+        shards.append(entry)
+        rebuilt += 1
+
+    # Shards en trop d'un découpage précédent
+    for name in os.listdir(os.path.join(index_path, SHARDS_DIR)):
+        if name.startswith("shard_") and name.endswith(".faiss") and name not in {s["file"] for s in shards}:
+            os.remove(_path(index_path, name))
+
+    config = {"n_shards": n_shards, "partition": partition, "index_type": index_type, "options": options,
+              "d": flat_index.d, "ntotal": int(flat_index.ntotal), "shards": shards, "chunk_store": snapshot}
+    with open(_path(index_path, SHARDS_CONFIG) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=1)
+    os.replace(_path(index_path, SHARDS_CONFIG) + ".tmp", _path(index_path, SHARDS_CONFIG))
+    return rebuilt
+
+
+# --- Côté recherche (app.py) -------------------------------------------------
+
+class Shard:
+    """Un shard, lu depuis le disque à sa première recherche."""
+
+    def __init__(self, path, entry, nprobe=None, ef_search=None):
+        self.path = path
+        self.entry = entry
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._index is not None
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    index = faiss.read_index(self.path)
+                    set_search_params(index, nprobe=self.nprobe, ef_search=self.ef_search)
+                    self._index = index
+        return self._index
+
+    def search(self, queries, k, selector=None):
+        if selector is None:
+            return self.index.search(queries, min(k, self.entry["ntotal"]))
+        return self.index.search(queries, min(k, self.entry["ntotal"]),
+                                 params=search_parameters(self.index, selector))
+
+    def may_contain(self, directories):
+        """Faux si le shard ne contient aucun des dossiers (ni sous-dossiers) demandés."""
+        if "directories" not in self.entry:
+            return True
+        return any(d == wanted or d.startswith(wanted + "/")
+                   for d in self.entry["directories"] for wanted in directories)
+
+
+class ShardedIndex:
+    """
+    Façade « index FAISS » sur les shards : `search` renvoie des positions d'index_agam.
+
+    Instantané immuable : un rechargement crée un nouvel objet qui reprend les
+    shards inchangés, les recherches en cours gardent l'ancien.
+    """
+
+    def __init__(self, config, shards, ids, positions, pool):
+        self.config = config
+        self.shards = shards
+        self.d = config["d"]
+        self.ntotal = config["ntotal"]
+        self._ids = ids
+        self._positions = positions
+        self._by_position = np.empty(len(ids), dtype=np.int64)
+        self._by_position[positions] = ids
+        self._pool = pool
+
+    @classmethod
+    def open(cls, index_path, previous=None, threads=None, nprobe=None, ef_search=None, lazy=True):
+        config = read_shards_config(index_path)
+        table = np.load(_path(index_path, POSITIONS_NAME))
+
+        reused = {}
+        if previous is not None:
+            reused = {(shard.entry["file"], shard.entry["fingerprint"]): shard for shard in previous.shards}
+        shards = []
+        for entry in config["shards"]:
+            if not entry["ntotal"]:
+                continue
+            shard = reused.get((entry["file"], entry["fingerprint"]))
+            if shard is None:
+                shard = Shard(_path(index_path, entry["file"]), entry, nprobe=nprobe, ef_search=ef_search)
+            shards.append(shard)
+        if not lazy:
+            for shard in shards:
+                shard.index
+
+        pool = previous._pool if previous is not None else ThreadPoolExecutor(
+            max_workers=threads or min(len(shards), os.cpu_count() or 1) or 1, thread_name_prefix="shard")
+        return cls(config, shards, table[:, 0].copy(), table[:, 1].copy(), pool)
+
+    def _position(self, stable):
+        i = np.searchsorted(self._ids, stable)
+        if i < len(self._ids) and self._ids[i] == stable:
+            return int(self._positions[i])
+        return None  # shard plus récent que la table : segment ignoré
+
+    def search(self, queries, k, selection=None):
+        """(distances, positions) des k plus proches voisins ; `selection` (metadata_index) filtre les segments."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.d)
+        shards, selector = self.shards, None
+        if selection is not None:
+            # Les shards portent des identifiants stables : sélecteur sur ces identifiants
+            selected = np.ascontiguousarray(self._by_position[selection.positions()])
+            selector = faiss.IDSelectorBatch(len(selected), faiss.swig_ptr(selected))
+            directories = selection.filters.get("directory")
+            if directories:
+                wanted = [normalize_value("directory", d) for d in directories]
+                shards = [shard for shard in shards if shard.may_contain(wanted)]
+        results = list(self._pool.map(lambda shard: shard.search(queries, k, selector), shards))
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        for row in range(len(queries)):
+            # Chaque top-k est trié par distance croissante : fusion par tas des N listes
+            merged = heapq.merge(*[zip(shard_distances[row], shard_ids[row])
+                                   for shard_distances, shard_ids in results])
+            found = 0
+            for distance, stable in merged:
+                if found == k:
+                    break
+                position = self._position(stable) if stable != -1 else None
+                if position is not None:
+                    distances[row, found], positions[row, found] = distance, position
+                    found += 1
+        return distances, positions
+
+    def stats(self):
+        return {"shards": len(self.shards), "loaded": sum(shard.loaded for shard in self.shards),
+                "partition": self.config["partition"]}
+
+
+def load_sharded_vectorstore(index_path, embeddings, previous=None, threads=None, nprobe=None, ef_search=None,
+                             lazy=True):
+    """Vectorstore LangChain sur les shards, ou None s'ils ne correspondent plus à l'index (repli)."""
+    config = read_shards_config(index_path)
+    store = ChunkStore(index_path)
+    # Segments modifiés depuis l'écriture des shards (positions décalées, même à nombre égal)
+    if config is None or config.get("chunk_store") != store.snapshot():
+        store.close()
+        print("⚠️ Shards absents ou périmés, repli sur l'index unique.")
+        return None
+
+    index = ShardedIndex.open(index_path, previous=previous if isinstance(previous, ShardedIndex) else None,
+                              threads=threads, nprobe=nprobe, ef_search=ef_search, lazy=lazy)
+    kept = sum(shard.loaded for shard in index.shards)
+    print(f"📊 Index FAISS servi : {len(index.shards)} shard(s) par {config['partition']}, "
+          f"{index.ntotal} vecteurs ({kept} shard(s) déjà en mémoire)")
+    return open_lazy_vectorstore(index, store, embeddings)
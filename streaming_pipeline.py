@@ -0,0 +1,69 @@
+"""
+streaming_pipeline.py
+
+Briques du pipeline d'ingestion en flux de `script_rag2.py` :
+
+    parcours → chargement → découpage → lots d'embeddings → ajout à l'index
+
+Chaque étape est un générateur ; `threaded()` fait tourner une étape dans un
+thread et la relie à la suivante par une file bornée, de sorte que le
+chargement, le découpage et l'encodage se recouvrent sans que la mémoire
+n'augmente avec la taille de `data/`.
+"""
+import queue
+import threading
+
+_FIN = object()
+
+
+class _StageError:
+    """Transporte une exception d'un thread d'étape vers le consommateur."""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def threaded(iterable, maxsize=8):
+    """Consomme `iterable` dans un thread et re-produit ses éléments via une file bornée."""
+    q = queue.Queue(maxsize=maxsize)
+
+    def producer():
+        try:
+            for item in iterable:
+                q.put(item)
+        except BaseException as e:  # remonte l'erreur au consommateur
+            q.put(_StageError(e))
+            return
+        q.put(_FIN)
+
+    # Thread démon : si le consommateur s'arrête, le producteur bloqué ne retient pas le process
+    threading.Thread(target=producer, daemon=True).start()
+
+    while True:
+        item = q.get()
+        if item is _FIN:
+            return
+        if isinstance(item, _StageError):
+            raise item.exc
+        yield item
+
+
+def batch_chunks(units, batch_size):
+    """
+    Regroupe des unités par fichier (entry, chunks, ids) en lots de taille fixe.
+
+    Produit (documents, ids, termines) : termines liste les couples (entry, ids)
+    des fichiers dont le dernier chunk figure dans le lot (ou qui n'ont aucun
+    chunk), à enregistrer au manifeste une fois le lot ajouté à l'index.
+    """
+    docs, ids, done = [], [], []
+    for entry, chunks, chunk_ids in units:
+        for doc, chunk_id in zip(chunks, chunk_ids):
+            docs.append(doc)
+            ids.append(chunk_id)
+            if len(docs) == batch_size:
+                yield docs, ids, done
+                docs, ids, done = [], [], []
+        done.append((entry, chunk_ids))
+    if docs or done:
+        yield docs, ids, done
@@ -0,0 +1,70 @@
+"""
+test_llm_gateway.py
+
+Mutualisation des générations (llm_gateway.py) contre le faux Ollama de bench_stubs.py :
+    python -m pytest test_llm_gateway.py
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bench_stubs import StubOllamaServer
+from llm_gateway import OllamaGateway
+
+N_WAITERS = 8
+
+
+def join_all(gateway, key, prompt):
+    """N requêtes identiques lancées ensemble pendant la génération ; réponse ou erreur de chacune."""
+    barrier = threading.Barrier(N_WAITERS)
+
+    def request():
+        barrier.wait()
+        try:
+            return gateway.generate(key, prompt)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=N_WAITERS) as pool:
+        return list(pool.map(lambda _: request(), range(N_WAITERS)))
+
+
+@pytest.fixture
+def stub():
+    # Premier token après 300 ms : toutes les requêtes arrivent pendant la génération
+    with StubOllamaServer(tokens_per_s=0, first_token_ms=300, answer_tokens=20) as server:
+        yield server
+
+
+def test_identical_prompts_share_one_generation(stub):
+    gateway = OllamaGateway(stub.url, "deepseek-r1")
+    completed = []
+    try:
+        first = gateway.join("clé", "Quelle est la question ?", on_complete=completed.append)
+        answers = join_all(gateway, "clé", "Quelle est la question ?")
+        assert "".join(first.iter_fragments()) == answers[0]
+    finally:
+        gateway.close()
+
+    assert stub.requests == 1
+    assert answers == [answers[0]] * N_WAITERS
+    assert answers[0] == "".join(stub.tokens("Quelle est la question ?"))
+    assert completed == [answers[0]]
+    assert gateway.stats()["coalesced"] == N_WAITERS
+
+
+def test_error_reaches_every_waiter(stub):
+    stub.error = "model 'deepseek-r1' not found"
+    gateway = OllamaGateway(stub.url, "deepseek-r1")
+    completed = []
+    try:
+        gateway.join("clé", "Quelle est la question ?", on_complete=completed.append)
+        results = join_all(gateway, "clé", "Quelle est la question ?")
+    finally:
+        gateway.close()
+
+    assert stub.requests == 1
+    assert all(isinstance(result, RuntimeError) and stub.error in str(result) for result in results)
+    assert completed == []
+    assert gateway.stats()["failed"] == 1
@@ -0,0 +1,41 @@
+"""
+test_llm_streaming.py
+
+Filtrage de la réflexion <think> de deepseek-r1 (llm_streaming.py) :
+    python -m pytest test_llm_streaming.py
+"""
+from llm_streaming import ThinkFilter, strip_think
+
+
+def stream(fragments):
+    think_filter = ThinkFilter()
+    return "".join(think_filter.feed(fragment) for fragment in fragments) + think_filter.flush()
+
+
+def test_think_section_removed():
+    assert strip_think("<think>Je cherche.</think>La réponse.") == "La réponse."
+
+
+def test_tags_split_across_fragments():
+    assert stream(["<thi", "nk>Je cherche.</th", "ink>La ", "réponse."]) == "La réponse."
+
+
+def test_closing_tag_without_opening_tag():
+    assert strip_think("Je cherche dans les extraits.</think>La réponse.") == "La réponse."
+
+
+def test_answer_without_tags_streams_immediately():
+    think_filter = ThinkFilter()
+    assert think_filter.feed("  ") == ""
+    assert think_filter.feed("La ") == "  La "
+    assert think_filter.feed("réponse.") == "réponse."
+
+
+def test_possible_opening_tag_held():
+    think_filter = ThinkFilter()
+    assert think_filter.feed("\n<thi") == ""
+    assert think_filter.feed("nk>Je cherche.</think>La réponse.") == "\nLa réponse."
+
+
+def test_answer_without_tags():
+    assert stream(["La ", "réponse ", "< 3 pages."]) == "La réponse < 3 pages."
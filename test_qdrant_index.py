@@ -0,0 +1,100 @@
+"""
+test_qdrant_index.py
+
+Synchronisation et recherche filtrée de la collection Qdrant (qdrant_index.py),
+en mode mémoire de qdrant-client :
+    python -m pytest test_qdrant_index.py
+"""
+import faiss
+import numpy as np
+import pytest
+
+pytest.importorskip("qdrant_client")
+
+from chunk_store import write_chunk_store
+from metadata_index import MetadataIndex, build_metadata_index
+from qdrant_index import QdrantIndex, collection_current, open_client, sync_collection
+
+DIM = 8
+
+
+def chunk(i, directory, page):
+    source = f"data/{directory}/doc{i // 3}.pdf"
+    metadata = {"source": source, "page": page, "directory": directory, "extension": ".pdf",
+                "ingested_at": "2024-05-01T00:00:00"}
+    return f"doc{i}-0", f"segment {i}", metadata
+
+
+def write_index(index_path, records, vectors):
+    """index_agam minimal : ChunkStore, index plat et bitmaps de métadonnées."""
+    write_chunk_store(index_path, records)
+    flat_index = faiss.IndexFlatL2(DIM)
+    flat_index.add(vectors)
+    build_metadata_index(index_path, (metadata for _, _, metadata in records))
+    return flat_index
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    rng = np.random.default_rng(0)
+    records = [chunk(i, "PLUi" if i % 2 else "SCoT", i % 4 if i % 5 else "N/A") for i in range(20)]
+    vectors = rng.random((len(records), DIM), dtype=np.float32)
+    index_path = str(tmp_path)
+    return index_path, records, vectors, write_index(index_path, records, vectors)
+
+
+def search_positions(index, vectors, selection, k=50):
+    _, positions = index.search(vectors, k, selection=selection)
+    return [set(int(p) for p in row if p != -1) for row in positions]
+
+
+def test_sync_sends_only_changed_points(corpus):
+    index_path, records, vectors, flat_index = corpus
+    client = open_client(":memory:")
+    assert sync_collection(index_path, flat_index, client, ":memory:") == (len(records), 0)
+    assert collection_current(index_path, "agam")
+    assert sync_collection(index_path, flat_index, client, ":memory:") == (0, 0)
+
+    # Un segment modifié, un retiré (positions suivantes décalées), un ajouté
+    records = list(records)
+    records[3] = (records[3][0], "segment 3 modifié", records[3][2])
+    del records[7]
+    vectors = np.delete(vectors, 7, axis=0)
+    records.append(chunk(20, "PLUi", 2))
+    vectors = np.vstack([vectors, np.full((1, DIM), 0.5, dtype=np.float32)])
+    flat_index = write_index(index_path, records, vectors)
+    assert not collection_current(index_path, "agam")
+    assert sync_collection(index_path, flat_index, client, ":memory:") == (2, 1)
+    assert client.count("agam").count == len(records)
+
+    # Positions relues après le décalage : chaque vecteur retrouve son propre segment
+    index = QdrantIndex.open(index_path, client)
+    _, positions = index.search(vectors, 1)
+    assert positions[:, 0].tolist() == list(range(len(records)))
+
+
+def test_payload_filter_matches_metadata_selection(corpus):
+    index_path, records, vectors, flat_index = corpus
+    client = open_client(":memory:")
+    sync_collection(index_path, flat_index, client, ":memory:")
+    index = QdrantIndex.open(index_path, client)
+    selection = MetadataIndex(index_path).select({"directory": "PLUi", "page": [1, 3]})
+
+    assert selection.count
+    for found in search_positions(index, vectors[:3], selection):
+        assert found == set(selection.positions().tolist())
+
+
+@pytest.mark.parametrize("pages", [["N/A"], [1, "N/A"]])
+def test_untranslatable_page_falls_back_to_selected_ids(corpus, pages):
+    index_path, records, vectors, flat_index = corpus
+    client = open_client(":memory:")
+    sync_collection(index_path, flat_index, client, ":memory:")
+    index = QdrantIndex.open(index_path, client)
+    selection = MetadataIndex(index_path).select({"page": pages})
+
+    # page=N/A n'est pas dans le payload : un MatchAny vide ne renverrait rien
+    expected = {position for position, (_, _, metadata) in enumerate(records) if metadata["page"] in pages}
+    assert set(selection.positions().tolist()) == expected
+    for found in search_positions(index, vectors[:3], selection):
+        assert found == expected
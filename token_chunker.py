@@ -0,0 +1,133 @@
+"""
+token_chunker.py
+
+Découpage des documents en segments de tokens, en une seule passe.
+
+L'ancien `hybrid_split` découpait d'abord en blocs de 2000 caractères (qui se
+chevauchaient de 300), puis ré-encodait chaque bloc avec TokenTextSplitter :
+le même texte passait plusieurs fois dans tiktoken. Ici chaque document est
+encodé une seule fois (cl100k_base) ; les coupures sont choisies directement
+dans la suite de tokens, en préférant dans l'ordre une fin de paragraphe, de
+ligne, de phrase, puis de mot, dans la seconde moitié de la fenêtre.
+
+Chaque segment garde sa position exacte en caractères (start / end) et, pour
+les PDF, le numéro de la page où il commence (`pages_to_document` note le
+début de chaque page dans le texte du document).
+"""
+from bisect import bisect_right
+
+from langchain.docstore.document import Document
+
+from context_packing import get_encoding
+
+# Qualité d'une coupure juste après un token
+PARAGRAPH, LINE, SENTENCE, WORD = 4, 3, 2, 1
+SENTENCE_END = (".", "!", "?", ";", ":")
+PAGE_SEPARATOR = "\n\n"
+
+
+def pages_to_document(path, pages):
+    """
+    Document d'un PDF à partir de ses pages [(numéro de page, texte)].
+
+    metadata["page_offsets"] = [[début de la page dans le texte, numéro], ...]
+    """
+    texts, page_offsets, offset = [], [], 0
+    for page_number, text in pages:
+        page_offsets.append([offset, page_number])
+        texts.append(text)
+        offset += len(text) + len(PAGE_SEPARATOR)
+    text = PAGE_SEPARATOR.join(texts)
+    if not text.strip():
+        return []
+    return [Document(page_content=text, metadata={"source": path, "page_offsets": page_offsets})]
+
+
+def _boundary_levels(pieces):
+    """levels[i] : qualité d'une coupure entre le token i et le token i + 1."""
+    levels = []
+    for i, piece in enumerate(pieces):
+        following = pieces[i + 1] if i + 1 < len(pieces) else " "
+        if "\n\n" in piece or (piece.endswith("\n") and following.startswith("\n")):
+            levels.append(PARAGRAPH)
+        elif "\n" in piece:
+            levels.append(LINE)
+        elif piece.rstrip().endswith(SENTENCE_END) and following[:1].isspace():
+            levels.append(SENTENCE)
+        elif piece[-1:].isspace() or following[:1].isspace():
+            levels.append(WORD)
+        else:
+            levels.append(0)
+    return levels
+
+
+class TokenChunker:
+    """Segments d'au plus `chunk_size` tokens, chevauchement de `chunk_overlap` tokens."""
+
+    def __init__(self, encoding_name="cl100k_base", chunk_size=300, chunk_overlap=50):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap doit être inférieur à chunk_size")
+        self.encoding = get_encoding(encoding_name)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        # Une coupure n'est cherchée que dans la seconde moitié de la fenêtre
+        self.min_chunk = max(chunk_size // 2, chunk_overlap + 1)
+
+    def _choose_end(self, levels, start, n_tokens):
+        limit = start + self.chunk_size
+        if limit >= n_tokens:
+            return n_tokens
+        best = {}
+        for i in range(limit - 1, start + self.min_chunk - 2, -1):
+            best.setdefault(levels[i], i)
+            if PARAGRAPH in best:
+                break
+        for level in (PARAGRAPH, LINE, SENTENCE, WORD):
+            if level in best:
+                return best[level] + 1
+        return limit
+
+    def split_text(self, text):
+        """Liste de (texte du segment, début, fin) en caractères dans `text`."""
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if not tokens:
+            return []
+        decoded, offsets = self.encoding.decode_with_offsets(tokens)
+        n_tokens = len(tokens)
+        bounds = offsets + [len(decoded)]
+        levels = _boundary_levels([decoded[bounds[i]:bounds[i + 1]] for i in range(n_tokens)])
+
+        spans, start = [], 0
+        while start < n_tokens:
+            end = self._choose_end(levels, start, n_tokens)
+            char_start, char_end = bounds[start], bounds[end]
+            chunk = decoded[char_start:char_end]
+            stripped = chunk.strip()
+            if stripped:
+                char_start += len(chunk) - len(chunk.lstrip())
+                spans.append((stripped, char_start, char_start + len(stripped)))
+            if end >= n_tokens:
+                break
+            start = max(end - self.chunk_overlap, start + 1)
+        return spans
+
+    def split_documents(self, documents):
+        """Segments (Document) des documents d'un fichier, avec source, page, part, start, end."""
+        chunks = []
+        for part, doc in enumerate(documents):
+            page_offsets = doc.metadata.get("page_offsets")
+            page_starts = [offset for offset, _ in page_offsets] if page_offsets else None
+            for text, start, end in self.split_text(doc.page_content):
+                if page_starts:
+                    page = page_offsets[max(bisect_right(page_starts, start) - 1, 0)][1]
+                else:
+                    page = doc.metadata.get("page", "N/A")
+                metadata = {
+                    "source": doc.metadata.get("source", "Inconnu"),
+                    "page": page,
+                    "part": part,  # rang du document dans le fichier (lignes CSV...)
+                    "start": start,
+                    "end": end,
+                }
+                chunks.append(Document(page_content=text, metadata=metadata))
+        return chunks
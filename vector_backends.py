@@ -0,0 +1,136 @@
+"""
+vector_backends.py
+
+Où vivent les vecteurs servis par app.py : FAISS (index_agam) ou Qdrant.
+
+* "faiss"  : index plat ou approché, unique ou en shards, écrit dans index_agam
+             (faiss_index_factory.py, sharded_index.py) ;
+* "qdrant" : collection Qdrant synchronisée avec index_agam (qdrant_index.py),
+             pour un corpus qui ne tient plus dans la mémoire d'un processus.
+
+Dans les deux cas index_agam reste la référence de l'ingestion (index plat,
+ChunkStore, BM25, bitmaps de métadonnées) et app.py reçoit la même façade : un
+vectorstore LangChain dont l'index a d, ntotal et search(queries, k) → positions
+d'index_agam, avec filtre optionnel par une sélection de metadata_index.py.
+
+    script_rag2.py   backend.is_current() / backend.publish(flat_index) en fin de run
+    app.py           backend.open(embeddings, previous) au démarrage et aux rechargements
+"""
+from chunk_store import ChunkStore
+from faiss_index_factory import write_approximate_index, approximate_index_current, load_vectorstore
+from sharded_index import write_shards, remove_shards, has_shards, shards_config_matches, load_sharded_vectorstore
+
+VECTOR_BACKENDS = ("faiss", "qdrant")
+
+
+class FaissBackend:
+    """Index FAISS d'index_agam, tel que construit par script_rag2.py (--index-type, --shards)."""
+
+    name = "faiss"
+
+    def __init__(self, index_path, index_type="flat", shards=0, shard_by="directory", data_dir="data",
+                 nlist=None, pq_m=64, hnsw_m=32, train_size=50000, nprobe=None, ef_search=None,
+                 use_shards=True, shard_threads=None, shard_lazy=True):
+        self.index_path = index_path
+        self.index_type = index_type
+        self.shards = shards
+        self.shard_by = shard_by
+        self.data_dir = data_dir
+        self.build_options = {"nlist": nlist, "pq_m": pq_m, "hnsw_m": hnsw_m, "train_size": train_size}
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.use_shards = use_shards
+        self.shard_threads = shard_threads
+        self.shard_lazy = shard_lazy
+
+    def is_current(self):
+        if self.shards:
+            return shards_config_matches(self.index_path, self.shards, self.shard_by, self.index_type,
+                                         **self.build_options)
+        if has_shards(self.index_path):
+            return False
+        return approximate_index_current(self.index_path, self.index_type, **self.build_options)
+
+    def publish(self, flat_index):
+        """Construit l'index servi (plat ou approché, unique ou en shards) à partir de l'index plat."""
+        if self.shards:
+            # Le type d'index s'applique à chaque shard ; l'index unique reste plat (repli)
+            print(f"⚙️ Découpage en {self.shards} shard(s) {self.index_type} par {self.shard_by}...")
+            write_approximate_index(self.index_path, flat_index, "flat")
+            rebuilt = write_shards(self.index_path, flat_index, self.shards, partition=self.shard_by,
+                                   index_type=self.index_type, data_dir=self.data_dir, **self.build_options)
+            print(f"✅ Index servi : {self.shards} shard(s), {rebuilt} reconstruit(s)")
+            return
+
+        remove_shards(self.index_path)
+        if self.index_type != "flat":
+            print(f"⚙️ Construction de l'index {self.index_type} sur {flat_index.ntotal} vecteurs...")
+        config = write_approximate_index(self.index_path, flat_index, self.index_type, **self.build_options)
+        print(f"✅ Index servi : {config['type']} ({config['spec']})")
+
+    def open(self, embeddings, previous=None):
+        if self.use_shards and has_shards(self.index_path):
+            # Au rechargement, seuls les shards modifiés sont relus
+            sharded = load_sharded_vectorstore(self.index_path, embeddings,
+                                               previous=previous.index if previous is not None else None,
+                                               threads=self.shard_threads, nprobe=self.nprobe,
+                                               ef_search=self.ef_search, lazy=self.shard_lazy)
+            if sharded is not None:
+                return sharded
+        return load_vectorstore(self.index_path, embeddings, nprobe=self.nprobe, ef_search=self.ef_search)
+
+
+class QdrantBackend:
+    """
+    Collection Qdrant synchronisée avec index_agam.
+
+    `location` : URL du serveur, ":memory:" ou dossier du mode local de qdrant-client.
+    """
+
+    name = "qdrant"
+
+    def __init__(self, index_path, location, collection=None, api_key=None, batch_size=256, workers=4,
+                 retries=5, hnsw_ef=None):
+        # Import paresseux : qdrant-client n'est requis qu'avec ce backend
+        import qdrant_index
+
+        self._qdrant = qdrant_index
+        self.index_path = index_path
+        self.location = location
+        self.collection = collection or qdrant_index.DEFAULT_COLLECTION
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.workers = workers
+        self.retries = retries
+        self.hnsw_ef = hnsw_ef
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._qdrant.open_client(self.location, api_key=self.api_key)
+        return self._client
+
+    def is_current(self):
+        return self._qdrant.collection_current(self.index_path, self.collection)
+
+    def publish(self, flat_index):
+        """Envoie les segments nouveaux ou modifiés, supprime ceux qui ont disparu d'index_agam."""
+        store = ChunkStore(self.index_path)
+        total = len(store)
+        store.close()
+        print(f"⚙️ Synchronisation de la collection Qdrant {self.collection} ({total} segments)...")
+        sent, deleted = self._qdrant.sync_collection(self.index_path, flat_index, self.client, self.location,
+                                                     self.collection, batch_size=self.batch_size,
+                                                     workers=self.workers, retries=self.retries)
+        print(f"✅ Index servi : collection Qdrant {self.collection}, {sent} point(s) envoyé(s), "
+              f"{deleted} supprimé(s)")
+
+    def open(self, embeddings, previous=None):
+        vectorstore = self._qdrant.load_qdrant_vectorstore(self.index_path, embeddings, self.client, self.location,
+                                                           self.collection, hnsw_ef=self.hnsw_ef)
+        if vectorstore is not None:
+            return vectorstore
+        # Collection en retard sur index_agam : positions désalignées, repli sur l'index FAISS plat
+        print("⚠️ Repli sur l'index FAISS d'index_agam.")
+        return FaissBackend(self.index_path, use_shards=False).open(embeddings)